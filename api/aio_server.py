@@ -0,0 +1,243 @@
+"""asyncio模式的LINE webhook服務
+
+提供與api/index.py(Flask)相同的webhook，但簽章驗證、Ollama生成、工具呼叫與LINE回覆
+都在同一個event loop上以非同步I/O進行：等待模型生成的對話不佔用執行緒，
+一台小主機就能同時保持大量等待中的對話。
+
+    python -m api.aio_server
+    gunicorn api.aio_server:create_app --worker-class aiohttp.GunicornWebWorker --bind 0.0.0.0:8000
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+from aiohttp import web
+from linebot import AsyncLineBotApi, WebhookParser
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import MessageEvent, TextMessage, TextSendMessage
+from api.chatgpt import ChatGPT
+from api.session import SessionManager, get_session_id
+from api.transport import pool_config, close_async_clients
+from api.tools import AVAILABLE_TOOLS, get_tool_cache_stats
+from api.worker import SHUTDOWN_DRAIN_TIMEOUT
+from api.log import setup_logging, new_request_id, log_event
+from api.deadline import start_deadline, REPLY_DEADLINE
+from api import metrics
+import os
+import json
+import time
+import asyncio
+import aiohttp
+import functools
+import contextvars
+import traceback
+import logging
+
+# 設定logging(LOG_LEVEL、LOG_FORMAT=text/json、LOG_DEBUG_SAMPLE_RATE)
+setup_logging()
+logger = logging.getLogger(__name__)
+
+AIO_HOST = os.getenv("AIO_HOST", default="0.0.0.0")
+AIO_PORT = int(os.getenv("AIO_PORT", default=8000))
+# 同時處理中(含等待生成)的訊息上限，超過時回覆忙碌
+AIO_MAX_CONVERSATIONS = int(os.getenv("AIO_MAX_CONVERSATIONS", default=1000))
+
+BUSY_TEXT = "⏳ 目前詢問人數眾多，請稍後再試"
+THINKING_TEXT = "🤔 正在思考中，請稍等..."
+UNAVAILABLE_TEXT = "❌ AI服務暫時無法使用，請稍後再試"
+ERROR_TEXT = "❌ 處理訊息時發生錯誤，請稍後再試"
+
+
+class LineWebhookApp:
+    """asyncio模式的webhook處理：每則訊息一個task，同一段對話以asyncio.Lock依序處理"""
+
+    def __init__(self):
+        self.chatgpt = ChatGPT()
+        self.sessions = SessionManager()
+        self.parser = WebhookParser(os.getenv("LINE_CHANNEL_SECRET"))
+        self.use_sync_mode = os.getenv("USE_SYNC_MODE", "true").lower() == "true"
+        self.max_conversations = AIO_MAX_CONVERSATIONS
+        self.line_bot_api = None  # 需要event loop，在on_startup建立
+        self._http = None
+        self._tasks = set()
+        self.completed = 0
+        self.rejected = 0
+
+    async def on_startup(self, app):
+        line_pool = pool_config("line")
+        self._http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=line_pool["pool_size"]))
+        self.line_bot_api = AsyncLineBotApi(
+            os.getenv("LINE_CHANNEL_ACCESS_TOKEN"),
+            AiohttpAsyncHttpClient(self._http, timeout=line_pool["read_timeout"]),
+            endpoint=os.getenv("LINE_API_ENDPOINT", default=AsyncLineBotApi.DEFAULT_API_ENDPOINT)
+        )
+        self.chatgpt.balancer.start_health_monitor()
+        # 在背景執行緒中預載入模型，不延遲開始服務
+        self.chatgpt.start_preload()
+        logger.info(f"🚀 asyncio模式啟動，同時處理上限 {self.max_conversations} 則訊息")
+
+    async def on_cleanup(self, app):
+        """等待處理中的訊息完成後關閉所有連線"""
+        if self._tasks:
+            logger.info(f"🛑 等待 {len(self._tasks)} 則處理中的訊息完成")
+            _, pending = await asyncio.wait(set(self._tasks), timeout=SHUTDOWN_DRAIN_TIMEOUT)
+            if pending:
+                logger.warning(f"⚠️ 等待逾時，仍有 {len(pending)} 則訊息未完成")
+        self.chatgpt.balancer.stop_health_monitor()
+        await self._http.close()
+        await close_async_clients()
+        await self.chatgpt.balancer.aclose()
+
+    async def home(self, request):
+        return web.Response(text="Hello, World!")
+
+    async def status(self, request):
+        return web.json_response(
+            {
+                "status": "運行中",
+                "server": "asyncio",
+                "mode": "同步模式" if self.use_sync_mode else "異步模式",
+                "line_configured": bool(os.getenv("LINE_CHANNEL_ACCESS_TOKEN")),
+                "ollama_host": self.chatgpt.ollama_hosts,
+                "ollama_model": self.chatgpt.model,
+                "model_ready": self.chatgpt.ready.is_set(),
+                "model_preload": self.chatgpt.preload_state,
+                "reply_deadline": REPLY_DEADLINE,
+                "available_tools": list(AVAILABLE_TOOLS),
+                "conversations": {
+                    "in_flight": len(self._tasks),
+                    "max": self.max_conversations,
+                    "completed": self.completed,
+                    "rejected": self.rejected
+                },
+                "sessions": self.sessions.stats(),
+                "tool_cache": get_tool_cache_stats(),
+                "ollama_scheduler": self.chatgpt.async_scheduler.stats(),
+                "ollama_backends": self.chatgpt.balancer.stats(),
+                "ollama_healthy": self.chatgpt.balancer.healthy,
+                "answer_cache": self.chatgpt.answer_cache.stats(),
+                "summarizer": self.chatgpt.summarizer.stats()
+            },
+            dumps=functools.partial(json.dumps, ensure_ascii=False)
+        )
+
+    async def metrics_endpoint(self, request):
+        return web.Response(body=metrics.render().encode("utf-8"), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+    async def callback(self, request):
+        logger.debug("🔄 收到webhook請求")
+        signature = request.headers.get("X-Line-Signature", "")
+        body = await request.text()
+        try:
+            events = self.parser.parse(body, signature)
+        except InvalidSignatureError:
+            logger.error("❌ 無效的簽名")
+            raise web.HTTPBadRequest()
+
+        for event in events:
+            if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+                await self.dispatch(event)
+        return web.Response(text="OK")
+
+    async def dispatch(self, event):
+        """建立處理訊息的task，webhook立即回應LINE"""
+        user_id = event.source.user_id
+        session_id = get_session_id(event.source)
+        received = time.monotonic()
+        if len(self._tasks) >= self.max_conversations:
+            self.rejected += 1
+            metrics.MESSAGES.inc(server="asyncio", result="rejected")
+            logger.warning(f"⚠️ 處理中的訊息已達上限({self.max_conversations})，拒絕新訊息")
+            await self.send(user_id, event.reply_token, BUSY_TEXT)
+            return
+
+        # correlation ID與回覆時限設定在這則訊息自己的context中，task建立時沿用；
+        # 不設定在webhook請求的context上，同一個webhook的其他事件與同一條連線的後續請求才不會沿用
+        context = contextvars.copy_context()
+        context.run(new_request_id, getattr(event, "webhook_event_id", None))
+        context.run(start_deadline, started=received)
+        context.run(log_event, logger, "message_received", session_id=session_id, chars=len(event.message.text))
+        task = context.run(
+            asyncio.create_task,
+            self.handle_message(user_id, session_id, event.message.text, event.reply_token, received)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        if not self.use_sync_mode:
+            # 先回覆"正在思考"，AI回應之後以push_message發送
+            await self.send(user_id, event.reply_token, THINKING_TEXT)
+
+    async def generate_reply(self, session_id, message_text):
+        """在該對話的鎖內加入用戶訊息、取得AI回應並記錄回應"""
+        session = self.sessions.get(session_id)
+        async with session.async_lock:
+            # 對話紀錄的storage可能是SQLite(等待寫入鎖最多30秒)，讀寫放到執行緒中以免卡住event loop；
+            # 持有async_lock，同一段對話不會有其他task同時修改
+            await asyncio.to_thread(session.prompt.sync)
+            session.prompt.apply_summary()
+            await asyncio.to_thread(self.chatgpt.add_msg, f"{message_text}?", session.prompt, role="user")
+
+            start = time.monotonic()
+            reply_msg = (await self.chatgpt.get_response_async(session.prompt)).replace("AI:", "", 1)
+            logger.debug("🤖 AI回應: %s", reply_msg)
+
+            await asyncio.to_thread(self.chatgpt.add_msg, reply_msg, session.prompt, role="assistant")
+            log_event(logger, "reply_generated", session_id=session_id,
+                      elapsed_ms=round((time.monotonic() - start) * 1000), reply_chars=len(reply_msg))
+            self.chatgpt.summarizer.schedule_async(session.prompt)
+        return reply_msg
+
+    async def handle_message(self, user_id, session_id, message_text, reply_token, received):
+        # 異步模式已用掉reply token回覆"正在思考"，結果改用push_message
+        token = reply_token if self.use_sync_mode else None
+        try:
+            if self.use_sync_mode and not self.chatgpt.balancer.can_serve():
+                logger.error("❌ Ollama目前無可用主機")
+                metrics.MESSAGES.inc(server="asyncio", result="unavailable")
+                await self.send(user_id, token, UNAVAILABLE_TEXT)
+                return
+            reply_msg = await self.generate_reply(session_id, message_text)
+            await self.send(user_id, token, reply_msg)
+            self.completed += 1
+            metrics.WEBHOOK_REPLY_SECONDS.observe(
+                time.monotonic() - received, server="asyncio", mode="sync" if self.use_sync_mode else "async"
+            )
+            metrics.MESSAGES.inc(server="asyncio", result="success")
+        except Exception as e:
+            logger.error(f"❌ 處理訊息時發生錯誤: {e}")
+            logger.error(f"❌ 詳細錯誤: {traceback.format_exc()}")
+            metrics.MESSAGES.inc(server="asyncio", result="error")
+            await self.send(user_id, token, ERROR_TEXT)
+
+    async def send(self, user_id, reply_token, text):
+        """有reply token時以reply_message回覆，失敗或沒有時改用push_message"""
+        message = TextSendMessage(text=text)
+        if reply_token:
+            try:
+                with metrics.LINE_API_SECONDS.time(method="reply"):
+                    await self.line_bot_api.reply_message(reply_token, message)
+                return
+            except Exception as reply_error:
+                logger.error(f"❌ Reply message發送失敗: {reply_error}")
+        try:
+            with metrics.LINE_API_SECONDS.time(method="push"):
+                await self.line_bot_api.push_message(user_id, message)
+        except Exception as push_error:
+            logger.error(f"❌ 所有訊息發送方式都失敗: {push_error}")
+
+
+def create_app():
+    bot = LineWebhookApp()
+    app = web.Application()
+    app.router.add_get("/", bot.home)
+    app.router.add_get("/status", bot.status)
+    app.router.add_get("/metrics", bot.metrics_endpoint)
+    app.router.add_post("/webhook", bot.callback)
+    app.on_startup.append(bot.on_startup)
+    app.on_cleanup.append(bot.on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host=AIO_HOST, port=AIO_PORT)
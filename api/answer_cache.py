@@ -0,0 +1,72 @@
+from api.cache import TTLCache
+import os
+import re
+import json
+import hashlib
+import unicodedata
+import logging
+
+# 設定logging
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", default=600))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", default=500))
+ANSWER_CACHE_CONTEXT = int(os.getenv("ANSWER_CACHE_CONTEXT", default=2))  # 納入key的前幾則對話
+
+_TRAILING_PUNCTUATION = re.compile(r"[\s?？!！。.,，~～]+$")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_message(text):
+    """正規化用戶訊息：全半形統一、忽略大小寫、多餘空白與結尾標點"""
+    text = unicodedata.normalize("NFKC", text).lower().strip()
+    text = _TRAILING_PUNCTUATION.sub("", text)
+    return _WHITESPACE.sub(" ", text)
+
+
+class AnswerCache:
+    """常見問題的回答快取，key為(模型, 最近幾則對話, 正規化後的用戶訊息)"""
+
+    def __init__(self, enabled=ANSWER_CACHE_ENABLED, ttl=ANSWER_CACHE_TTL,
+                 maxsize=ANSWER_CACHE_SIZE, context=ANSWER_CACHE_CONTEXT):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.context = context
+        self._cache = TTLCache(maxsize, name="answer")
+
+    def key(self, messages, model, *options):
+        """以最後一則用戶訊息及其前面幾則對話計算key；最後一則不是用戶訊息時回傳None"""
+        if not self.enabled or not messages or messages[-1]["role"] != "user":
+            return None
+        # 系統訊息(含工具結果)不納入，前面的對話只取最近幾則
+        context = [m for m in messages[:-1] if m["role"] in ("user", "assistant")]
+        context = context[-self.context:] if self.context > 0 else []
+        payload = json.dumps(
+            {
+                "model": model,
+                "options": options,
+                "context": [[m["role"], normalize_message(m["content"])] for m in context],
+                "message": normalize_message(messages[-1]["content"])
+            },
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if key is None:
+            return None
+        answer = self._cache.get(key)
+        if answer is not None:
+            logger.info("⚡ 回答快取命中")
+        return answer
+
+    def put(self, key, answer):
+        if key is None:
+            return
+        self._cache.set(key, answer, self.ttl)
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats["enabled"] = self.enabled
+        return stats
@@ -0,0 +1,274 @@
+from api.transport import get_session, ollama_client_options
+import os
+import hashlib
+import threading
+import time
+import ollama
+import logging
+
+# 設定logging
+logger = logging.getLogger(__name__)
+
+# 連續失敗幾次後暫停使用該主機(斷路)，以及暫停多久後再探測
+BREAKER_THRESHOLD = int(os.getenv("OLLAMA_BREAKER_THRESHOLD", default=3))
+BREAKER_COOLDOWN = float(os.getenv("OLLAMA_BREAKER_COOLDOWN", default=30))
+LATENCY_EWMA_ALPHA = 0.3
+# 背景健康檢查的間隔(秒)與探測路徑；/api/version不需讀取磁碟上的模型列表
+HEALTH_CHECK_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", default=15))
+HEALTH_CHECK_PATH = os.getenv("OLLAMA_HEALTH_PATH", default="/api/version")
+
+
+def get_ollama_hosts():
+    """OLLAMA_HOSTS以逗號分隔多台主機，未設定時使用OLLAMA_HOST"""
+    hosts = os.getenv("OLLAMA_HOSTS") or os.getenv("OLLAMA_HOST", default="http://localhost:11434")
+    return [host.strip().rstrip("/") for host in hosts.split(",") if host.strip()]
+
+
+class Backend:
+    """單一Ollama主機的連線與健康狀態"""
+
+    def __init__(self, host):
+        self.host = host
+        self.client = ollama.Client(host=host, **ollama_client_options())
+        self.outstanding = 0  # 進行中的請求數
+        self.latency = None  # 請求耗時的指數移動平均(秒)
+        self.failures = 0  # 連續失敗次數
+        self.open_until = 0.0  # 斷路到期時間，0表示正常
+        self._async_client = None
+
+    @property
+    def async_client(self):
+        """asyncio模式使用的ollama.AsyncClient，第一次使用時才建立"""
+        if self._async_client is None:
+            self._async_client = ollama.AsyncClient(host=self.host, **ollama_client_options(asynchronous=True))
+        return self._async_client
+
+    @property
+    def available(self):
+        return self.open_until == 0.0
+
+    def score(self):
+        """越小越好：進行中請求數乘上平均延遲"""
+        return (self.outstanding + 1) * (self.latency or 1.0)
+
+    def state(self):
+        return {
+            "host": self.host,
+            "available": self.available,
+            "outstanding": self.outstanding,
+            "latency_ewma": round(self.latency, 3) if self.latency is not None else None,
+            "failures": self.failures
+        }
+
+
+class OllamaBalancer:
+    """把生成請求分散到多台Ollama主機
+
+    有對話ID時以rendezvous hashing固定同一段對話到同一台主機，讓主機上已快取的
+    prompt前綴可以重複使用；主機斷路時該對話才會移到其他主機。沒有對話ID時
+    選擇(進行中請求數 x 平均延遲)最小的主機。
+    """
+
+    def __init__(self, hosts=None):
+        hosts = hosts or get_ollama_hosts()
+        self.backends = [Backend(host) for host in hosts]
+        self._lock = threading.Lock()
+        # 是否有任何可用主機；webhook經由can_serve()讀取，不需每則訊息探測
+        self.healthy = True
+        self._monitor = None
+        self._stop = threading.Event()
+        logger.info(f"⚖️ Ollama負載平衡: {', '.join(hosts)}")
+
+    @staticmethod
+    def _rendezvous(route_key, backend):
+        digest = hashlib.md5(f"{route_key}|{backend.host}".encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def _candidates(self):
+        """可用的主機；斷路到期的主機先探測，通過才恢復使用"""
+        now = time.monotonic()
+        candidates = []
+        for backend in self.backends:
+            if not backend.available and backend.open_until <= now:
+                # 半開：同時間只讓一個請求去探測
+                with self._lock:
+                    probing = backend.open_until <= now
+                    if probing:
+                        backend.open_until = now + BREAKER_COOLDOWN
+                if probing and self.probe(backend):
+                    self.record_success(backend, None)
+            if backend.available:
+                candidates.append(backend)
+        return candidates
+
+    def pick(self, route_key=None):
+        candidates = self._candidates()
+        if not candidates:
+            # 全部斷路時仍嘗試最早恢復的主機，而不是直接拒絕
+            candidates = [min(self.backends, key=lambda b: b.open_until)]
+        if route_key and len(candidates) > 1:
+            return max(candidates, key=lambda b: self._rendezvous(route_key, b))
+        with self._lock:
+            return min(candidates, key=lambda b: b.score())
+
+    def probe(self, backend, path=HEALTH_CHECK_PATH, timeout=2):
+        """探測主機是否可用"""
+        try:
+            response = get_session("ollama").get(f"{backend.host}{path}", timeout=timeout)
+            ok = response.status_code == 200
+        except Exception as e:
+            logger.warning(f"⚠️ Ollama主機探測失敗 {backend.host}: {e}")
+            ok = False
+        logger.debug(f"🩺 Ollama主機探測 {backend.host}: {'正常' if ok else '異常'}")
+        return ok
+
+    def check_health(self):
+        """探測所有主機並更新斷路狀態，回傳可用主機數"""
+        healthy = 0
+        for backend in self.backends:
+            if self.probe(backend):
+                self.record_success(backend, None)
+                healthy += 1
+            else:
+                self.record_failure(backend, force_open=True)
+        return healthy
+
+    def start_health_monitor(self, interval=HEALTH_CHECK_INTERVAL):
+        """在背景定期探測所有主機，interval<=0時不啟動"""
+        if interval <= 0 or self._monitor is not None:
+            return
+        self._monitor = threading.Thread(
+            target=self._monitor_loop, args=(interval,), name="ollama-health", daemon=True
+        )
+        self._monitor.start()
+        logger.info(f"🩺 Ollama背景健康檢查啟動，每 {interval} 秒一次")
+
+    def _monitor_loop(self, interval):
+        while not self._stop.is_set():
+            try:
+                self.check_health()
+            except Exception as e:
+                logger.error(f"❌ Ollama健康檢查失敗: {e}")
+            self._stop.wait(interval)
+
+    def stop_health_monitor(self):
+        self._stop.set()
+
+    def can_serve(self):
+        """是否接受新的生成請求：有可用主機，或有主機的斷路已到期、可由pick()探測恢復
+
+        沒有背景健康檢查(OLLAMA_HEALTH_INTERVAL<=0)時，只有pick()的半開探測會讓healthy恢復，
+        不能只看healthy旗標，否則所有主機斷路過一次後就再也不會送出請求。
+        """
+        if self.healthy:
+            return True
+        now = time.monotonic()
+        return any(backend.open_until <= now for backend in self.backends)
+
+    def _update_healthy(self):
+        """更新可用旗標（呼叫前需持有鎖）"""
+        healthy = any(backend.available for backend in self.backends)
+        if healthy != self.healthy:
+            logger.warning(f"{'✅ Ollama服務恢復可用' if healthy else '❌ Ollama服務目前無可用主機'}")
+        self.healthy = healthy
+
+    def record_success(self, backend, elapsed):
+        with self._lock:
+            if not backend.available:
+                logger.info(f"✅ Ollama主機恢復: {backend.host}")
+            backend.failures = 0
+            backend.open_until = 0.0
+            self._update_healthy()
+            if elapsed is not None:
+                if backend.latency is None:
+                    backend.latency = elapsed
+                else:
+                    backend.latency += LATENCY_EWMA_ALPHA * (elapsed - backend.latency)
+
+    def record_failure(self, backend, force_open=False):
+        with self._lock:
+            backend.failures += 1
+            if force_open or backend.failures >= BREAKER_THRESHOLD:
+                if backend.available:
+                    logger.warning(f"🔌 Ollama主機暫停使用 {BREAKER_COOLDOWN} 秒: {backend.host}")
+                backend.open_until = time.monotonic() + BREAKER_COOLDOWN
+                self._update_healthy()
+
+    def _begin(self, backend):
+        with self._lock:
+            backend.outstanding += 1
+        return time.monotonic()
+
+    def _end(self, backend, start, ok):
+        with self._lock:
+            backend.outstanding -= 1
+        if ok:
+            self.record_success(backend, time.monotonic() - start)
+        else:
+            self.record_failure(backend)
+
+    def chat(self, backend, route_key=None, **kwargs):
+        """在已由pick()選定的主機上執行，其他參數與ollama.Client.chat相同
+
+        route_key只在pick()時用來決定主機，這裡不再使用。
+        """
+        if kwargs.get("stream"):
+            return self._chat_stream(backend, kwargs)
+        start = self._begin(backend)
+        ok = False
+        try:
+            response = backend.client.chat(**kwargs)
+            ok = True
+            return response
+        except ollama.ResponseError as e:
+            # 模型或參數錯誤不代表主機故障
+            ok = e.status_code < 500
+            raise
+        finally:
+            self._end(backend, start, ok)
+
+    async def achat(self, backend, route_key=None, **kwargs):
+        """chat的asyncio版本，使用各主機的ollama.AsyncClient(不支援串流)"""
+        start = self._begin(backend)
+        ok = False
+        try:
+            response = await backend.async_client.chat(**kwargs)
+            ok = True
+            return response
+        except ollama.ResponseError as e:
+            ok = e.status_code < 500
+            raise
+        finally:
+            self._end(backend, start, ok)
+
+    async def aclose(self):
+        for backend in self.backends:
+            if backend._async_client is not None:
+                await backend._async_client.close()
+                backend._async_client = None
+
+    def _chat_stream(self, backend, kwargs):
+        start = self._begin(backend)
+        ok = False
+        try:
+            stream = backend.client.chat(**kwargs)
+            try:
+                yield from stream
+            finally:
+                close = getattr(stream, "close", None)
+                if close:
+                    close()
+            ok = True
+        except GeneratorExit:
+            # 呼叫端提前停止讀取(例如已取得工具呼叫)，不算失敗
+            ok = True
+            raise
+        except ollama.ResponseError as e:
+            ok = e.status_code < 500
+            raise
+        finally:
+            self._end(backend, start, ok)
+
+    def stats(self):
+        with self._lock:
+            return [backend.state() for backend in self.backends]
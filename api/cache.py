@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+import time
+import logging
+
+# 設定logging
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """有大小上限(LRU)與逐筆TTL的執行緒安全快取
+
+    get_or_load 提供 single-flight：同一個key同時多個未命中時，只有第一個呼叫者
+    實際載入，其餘等待同一個結果。
+    """
+
+    def __init__(self, maxsize, name="cache"):
+        self.maxsize = maxsize
+        self.name = name
+        self._data = OrderedDict()  # key -> (到期時間, 值)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0  # 等待其他呼叫者載入結果的次數
+
+    def _lookup(self, key, now):
+        """查詢快取（呼叫前需持有鎖），過期的項目直接移除"""
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at <= now:
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._lookup(key, time.monotonic())
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_load(self, key, loader, ttl_for):
+        """命中時直接回傳；未命中時呼叫loader()，並依ttl_for(值)決定保存秒數(<=0不保存)"""
+        with self._lock:
+            found, value = self._lookup(key, time.monotonic())
+            if found:
+                self.hits += 1
+                return value
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return flight.result()
+
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.set_exception(e)
+            raise
+
+        self.set(key, value, ttl_for(value))
+        with self._lock:
+            self._inflight.pop(key, None)
+        flight.set_result(value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
@@ -1,8 +1,17 @@
 from api.prompt import Prompt
-from api.tools import AVAILABLE_TOOLS, execute_tool, get_tools_description
+from api.transport import get_session
+from api.scheduler import OllamaScheduler, AsyncOllamaScheduler, PRIORITY_FOLLOWUP, PRIORITY_NEW
+from api.balancer import OllamaBalancer, get_ollama_hosts
+from api.answer_cache import AnswerCache
+from api.summarizer import ConversationSummarizer
+from api.metrics import OLLAMA_PREFILL_SECONDS, OLLAMA_GENERATION_SECONDS, OLLAMA_REQUEST_SECONDS, OLLAMA_TOKENS, PROMPT_CHARS, PROMPT_TOKENS, TOOL_ROUNDS, DEADLINE_EXCEEDED
+from api import deadline
+from api.tools import AVAILABLE_TOOLS, execute_tools, execute_tools_async, format_tool_result, submit_tool, tool_call_key, parse_tool_arguments, get_tool_schemas, get_tools_description
 import os
+import copy
+import time
+import threading
 import ollama
-import requests
 import logging
 import json
 import re
@@ -10,39 +19,153 @@ import re
 # 設定logging
 logger = logging.getLogger(__name__)
 
+# 工具呼叫格式: [TOOL:tool_name:parameters]
+# parameters可以是JSON物件/陣列，或到第一個 ] 為止的簡單字串
+TOOL_MARKER_START = re.compile(r'\[TOOL:(\w+):')
+_json_decoder = json.JSONDecoder()
+
+
+def find_tool_markers(text, pos=0, complete=True):
+    """依序找出text中(從pos開始)的工具標記，產生(工具名稱, 參數字串, 標記起點, 標記終點)
+
+    JSON參數以JSON語法找出結尾，其中的 ] 不會被當成標記結束。
+    complete=False(串流中的部分回應)時，尚無法解析的JSON參數可能還沒生成完，停在該標記等待後續內容；
+    complete=True時改以簡單字串處理，交由解析步驟回報錯誤。
+    """
+    while True:
+        match = TOOL_MARKER_START.search(text, pos)
+        if not match:
+            return
+        begin = match.end()
+        end = None
+        if text[begin:begin + 1] in ("{", "["):
+            try:
+                _, value_end = _json_decoder.raw_decode(text, begin)
+            except ValueError:
+                if not complete:
+                    return
+            else:
+                if text.startswith("]", value_end):
+                    end = value_end
+        if end is None:
+            end = text.find("]", begin)
+            if end == -1:
+                return
+            if end == begin:
+                # 沒有參數的標記不是工具呼叫
+                pos = begin
+                continue
+        yield match.group(1), text[begin:end], match.start(), end + 1
+        pos = end + 1
+
+
+def strip_tool_markers(text):
+    """去除text中所有的工具標記"""
+    parts = []
+    pos = 0
+    for _, _, start, end in find_tool_markers(text):
+        parts.append(text[pos:start])
+        pos = end
+    parts.append(text[pos:])
+    return "".join(parts)
+
+# 回覆時限快到時附加在最後的系統訊息(不寫入對話紀錄)，要求模型以已取得的資料回答
+DEADLINE_NOTE = "回覆時間即將用完，請不要再呼叫工具，直接根據目前已取得的資料回答；沒有取得的資料請說明查詢逾時。"
+DEADLINE_FALLBACK = "查詢時間過長，目前無法取得完整資料，請稍後再試。"
+# 模型預載入方式：background在背景執行緒進行(不延遲啟動)，sync等待完成，off不預載入
+OLLAMA_PRELOAD = os.getenv("OLLAMA_PRELOAD", default="background").lower()
+
 class ChatGPT:
     def __init__(self):
         logger.info("🔧 初始化ChatGPT類別")
         self.prompt = Prompt()
         self.model = os.getenv("OLLAMA_MODEL", default="qwen3:7b-instruct-q4_0")  # 使用較小的模型
-        self.ollama_host = os.getenv("OLLAMA_HOST", default="http://localhost:11434")
+        # OLLAMA_HOSTS可設定多台主機(逗號分隔)
+        self.ollama_hosts = get_ollama_hosts()
+        self.ollama_host = self.ollama_hosts[0]
         logger.info(f"🤖 使用模型: {self.model}")
-        logger.info(f"🌐 Ollama主機: {self.ollama_host}")
+        logger.info(f"🌐 Ollama主機: {', '.join(self.ollama_hosts)}")
         
         # 檢查thinking設定
         self.enable_thinking = os.getenv("ENABLE_THINKING", "false").lower() == "true"
         logger.info(f"🧠 Thinking模式設定: {'啟用' if self.enable_thinking else '禁用'}")
         
-        self.client = ollama.Client(host=self.ollama_host, timeout=300)  # 5分鐘timeout
+        # 串流模式：邊生成邊解析工具呼叫，完整的工具標記一出現就開始執行
+        self.enable_stream = os.getenv("OLLAMA_STREAM", "false").lower() == "true"
+        # 串流中偵測到工具呼叫且模型開始輸出其他文字時，提前停止生成
+        self.stream_stop_on_tool = os.getenv("STREAM_STOP_ON_TOOL", "true").lower() == "true"
+        logger.info(f"🌊 串流模式設定: {'啟用' if self.enable_stream else '禁用'}")
+        
+        # 工具呼叫方式：native使用Ollama的tools參數與結構化tool_calls，marker使用文字標記
+        # 模型不支援tools時會自動改回marker
+        self.native_tools = os.getenv("TOOL_CALLING_MODE", "marker").lower() == "native"
+        logger.info(f"🛠️ 工具呼叫方式: {'native' if self.native_tools else 'marker'}")
+        
+        # 常見問題的回答快取(ANSWER_CACHE_ENABLED)，用到即時性工具(例如庫存)的回答不快取
+        self.answer_cache = AnswerCache()
+        
+        # 每台主機一個共用keep-alive連線池的client，讀取timeout預設5分鐘(HTTP_READ_TIMEOUT_OLLAMA)
+        self.balancer = OllamaBalancer(self.ollama_hosts)
+        # 所有生成請求都經過排程器：限制每台主機的同時數量(OLLAMA_MAX_CONCURRENT)、依優先順序排隊
+        self.scheduler = OllamaScheduler(self.balancer)
+        # asyncio模式(api/aio_server.py)使用的排程器，只在event loop中使用
+        self.async_scheduler = AsyncOllamaScheduler(self.balancer)
         logger.info("✅ Ollama客戶端創建成功")
         
-        # 預先載入模型到記憶體中
-        logger.info("🚀 開始預載入模型")
-        self._preload_model()
+        # 舊對話的背景摘要(SUMMARY_ENABLED)
+        self.summarizer = ConversationSummarizer(self.scheduler, self.model, async_scheduler=self.async_scheduler)
+        
+        # 模型預載入由start_preload另外啟動，建立實例時不呼叫Ollama
+        # 狀態：pending -> loading -> ready / failed，或off
+        self.preload_state = "pending"
+        self.ready = threading.Event()
+        self._preload_lock = threading.Lock()
         logger.info("✅ ChatGPT初始化完成")
 
+    def fork(self, **overrides):
+        """共用連線、排程器與快取的複本，有自己的對話與設定（供測試路由使用）"""
+        clone = copy.copy(self)
+        clone.prompt = Prompt()
+        for name, value in overrides.items():
+            setattr(clone, name, value)
+        return clone
+
+    def start_preload(self, mode=OLLAMA_PRELOAD):
+        """開始預載入模型；重複呼叫不會重複載入"""
+        with self._preload_lock:
+            if self.preload_state != "pending":
+                return
+            if mode == "off":
+                self.preload_state = "off"
+                return
+            self.preload_state = "loading"
+        logger.info(f"🚀 開始預載入模型 ({mode})")
+        if mode == "sync":
+            self._preload_model()
+        else:
+            threading.Thread(target=self._preload_model, name="ollama-preload", daemon=True).start()
+
     def _preload_model(self):
-        """預先載入模型到記憶體中，避免每次呼叫時重新載入"""
-        logger.info("🔍 開始預載入模型流程")
+        """預先在每台主機上載入模型到記憶體中，避免每次呼叫時重新載入"""
+        results = [self._preload_backend(backend) for backend in self.balancer.backends]
+        if all(results):
+            self.preload_state = "ready"
+            self.ready.set()
+            logger.info("✅ 模型預載入完成")
+        else:
+            self.preload_state = "failed"
+
+    def _preload_backend(self, backend):
+        logger.info(f"🔍 開始預載入模型流程: {backend.host}")
         try:
             # 1. 先檢查模型是否已載入
             logger.info("🔍 檢查模型是否已載入")
-            is_loaded = self._check_model_loaded()
+            is_loaded = self._check_model_loaded(backend.host)
             
             if not is_loaded:
                 # 2. 如果沒有載入，進行預載入
                 logger.info(f"📥 開始預載入模型 {self.model}...")
-                response = self.client.chat(
+                response = backend.client.chat(
                     model=self.model,
                     messages=[{"role": "user", "content": "ready"}],
                     keep_alive=-1  # 永遠保持在記憶體中
@@ -52,20 +175,22 @@ class ChatGPT:
                 
                 # 3. 設定模型永久保持載入
                 logger.info("🔧 設定模型永久保持載入")
-                self._set_model_keep_alive()
+                self._set_model_keep_alive(backend.host)
             else:
                 logger.info("✅ 模型已經在記憶體中，無需重新載入")
+            return True
             
         except Exception as e:
             logger.error(f"❌ 預載入模型時發生錯誤: {e}")
             import traceback
             logger.error(f"❌ 詳細錯誤: {traceback.format_exc()}")
+            return False
 
-    def _check_model_loaded(self):
+    def _check_model_loaded(self, host):
         """檢查模型是否已載入到記憶體中"""
         logger.info("🔍 檢查模型載入狀態")
         try:
-            response = requests.get(f"{self.ollama_host}/api/ps")
+            response = get_session("ollama").get(f"{host}/api/ps")
             logger.info(f"📡 API請求狀態碼: {response.status_code}")
             
             if response.status_code == 200:
@@ -86,12 +211,12 @@ class ChatGPT:
             logger.error(f"❌ 檢查模型狀態時發生錯誤: {e}")
             return False
 
-    def _set_model_keep_alive(self):
+    def _set_model_keep_alive(self, host):
         """設定模型永久保持在記憶體中"""
         logger.info("🔧 設定模型永久保持在記憶體中")
         try:
             # 使用ollama的keep_alive API
-            response = requests.post(f"{self.ollama_host}/api/generate", json={
+            response = get_session("ollama").post(f"{host}/api/generate", json={
                 "model": self.model,
                 "keep_alive": -1  # 永遠保持
             })
@@ -100,74 +225,47 @@ class ChatGPT:
         except Exception as e:
             logger.error(f"❌ 設定keep_alive時發生錯誤: {e}")
 
-    def get_response(self):
-        logger.info("🧠 開始獲取AI回應")
+    def get_response(self, prompt=None):
+        logger.debug("🧠 開始獲取AI回應")
+        # 未指定對話時使用本實例自己的對話（供測試路由使用）
+        if prompt is None:
+            prompt = self.prompt
         
         # 最大工具呼叫次數，避免無限循環
         max_tool_calls = int(os.getenv("MAX_TOOL_CALLS", default=3))
         tool_call_count = 0
-        logger.info(f"🔧 最大工具呼叫次數設定為: {max_tool_calls}")
+        logger.debug("🔧 最大工具呼叫次數設定為: %s", max_tool_calls)
+        
+        answer_key = self.answer_cache.key(prompt.get_messages(), self.model, self.enable_thinking)
+        cached_answer = self.answer_cache.get(answer_key)
+        if cached_answer is not None:
+            return cached_answer
+        answer_cacheable = True
         
         while tool_call_count < max_tool_calls:
-            messages = []
-            
-            logger.info("📝 處理對話訊息")
-            for i, msg in enumerate(self.prompt.msg_list):
-                logger.info(f"📝 處理訊息 {i+1}: {msg[:50]}...")
-                
-                if msg.startswith("system:"):
-                    role = "system"
-                    content = msg[7:].strip()
-                elif msg.startswith("Human:"):
-                    role = "user"
-                    content = msg[6:].strip()
-                elif msg.startswith("AI:"):
-                    role = "assistant"
-                    content = msg[3:].strip()
-                else:
-                    logger.warning(f"⚠️ 跳過無效的訊息格式: {msg[:30]}...")
-                    continue  # 跳過無效的消息格式
-                
-                messages.append({"role": role, "content": content})
-                logger.info(f"✅ 已加入 {role} 訊息")
-
-            logger.info(f"📋 總共處理 {len(messages)} 條訊息")
-            logger.info("🚀 開始向Ollama請求回應")
-            
             try:
-                response = self.client.chat(
-                    model=self.model,
-                    messages=messages,
-                    keep_alive=-1,  # 永遠保持在記憶體中
-                    think=self.enable_thinking  # 控制thinking模式
-                )
-                logger.info("✅ 成功獲取Ollama回應")
-                
-                ai_response = response['message']['content'].strip()
-                logger.info(f"🤖 AI回應內容: {ai_response}")
-                
-                # 檢查是否包含工具呼叫
-                tool_calls = self._extract_tool_calls(ai_response)
+                # 工具結果回來後的回答優先於新的對話，縮短已在進行中的對話的等待
+                priority = PRIORITY_FOLLOWUP if tool_call_count else PRIORITY_NEW
+                # 剩餘時間不足以再呼叫工具時，以目前取得的結果直接回答
+                final = self._out_of_time(tool_call_count)
+                answer_cacheable = answer_cacheable and not final
+                ai_response, tool_calls, native = self._request(prompt, priority, final)
                 
                 if tool_calls:
-                    logger.info(f"🛠️ 檢測到 {len(tool_calls)} 個工具呼叫")
+                    logger.debug("🛠️ 檢測到 %s 個工具呼叫", len(tool_calls))
                     tool_call_count += 1
+                    answer_cacheable = answer_cacheable and self._answer_cacheable(tool_calls)
                     
-                    # 執行工具並加入結果
-                    tool_results = []
-                    for tool_call in tool_calls:
-                        result = execute_tool(tool_call["name"], tool_call["parameters"])
-                        tool_results.append(result)
-                        
-                        # 將工具結果加入對話
-                        tool_result_msg = f"system:工具執行結果 [{tool_call['name']}]: {json.dumps(result, ensure_ascii=False, indent=2)}"
-                        self.prompt.add_msg(tool_result_msg)
-                        logger.info(f"📝 已加入工具結果: {tool_call['name']}")
+                    # 同時執行所有工具，結果依原本順序加入對話
+                    self._add_tool_results(prompt, ai_response, tool_calls, execute_tools(tool_calls), native)
                     
                     # 繼續循環以取得最終回應
                     continue
                 else:
                     # 沒有工具呼叫，回傳最終回應
+                    if answer_cacheable:
+                        self.answer_cache.put(answer_key, ai_response)
+                    TOOL_ROUNDS.observe(tool_call_count)
                     return ai_response
                     
             except Exception as e:
@@ -177,43 +275,303 @@ class ChatGPT:
                 raise
         
         logger.warning("⚠️ 達到最大工具呼叫次數限制")
+        TOOL_ROUNDS.observe(tool_call_count)
         return "處理過程中達到工具呼叫次數限制，請稍後再試。"
 
-    def _extract_tool_calls(self, text):
-        """從AI回應中提取工具呼叫"""
-        logger.info("🔍 分析AI回應中的工具呼叫")
-        tool_calls = []
+    async def get_response_async(self, prompt):
+        """get_response的asyncio版本：生成與工具呼叫都在event loop上等待，不佔用執行緒
+
+        asyncio模式不使用串流，工具在模型回應完成後同時執行。
+        """
+        logger.debug("🧠 開始獲取AI回應(asyncio)")
+        max_tool_calls = int(os.getenv("MAX_TOOL_CALLS", default=3))
+        tool_call_count = 0
         
-        # 匹配工具呼叫模式: [TOOL:tool_name:parameters]
-        pattern = r'\[TOOL:(\w+):([^\]]+)\]'
-        matches = re.findall(pattern, text)
+        answer_key = self.answer_cache.key(prompt.get_messages(), self.model, self.enable_thinking)
+        cached_answer = self.answer_cache.get(answer_key)
+        if cached_answer is not None:
+            return cached_answer
+        answer_cacheable = True
         
-        for tool_name, params_str in matches:
-            logger.info(f"🛠️ 發現工具呼叫: {tool_name} 參數: {params_str}")
+        while tool_call_count < max_tool_calls:
+            priority = PRIORITY_FOLLOWUP if tool_call_count else PRIORITY_NEW
+            final = self._out_of_time(tool_call_count)
+            answer_cacheable = answer_cacheable and not final
+            ai_response, tool_calls, native = await self._request_async(prompt, priority, final)
+            if not tool_calls:
+                if answer_cacheable:
+                    self.answer_cache.put(answer_key, ai_response)
+                TOOL_ROUNDS.observe(tool_call_count)
+                return ai_response
             
-            if tool_name in AVAILABLE_TOOLS:
-                try:
-                    # 解析參數
-                    if params_str.startswith('{') and params_str.endswith('}'):
-                        # JSON格式參數
-                        parameters = json.loads(params_str)
-                    else:
-                        # 簡單字串參數，預設為itemnum
-                        parameters = {"itemnum": params_str}
-                    
-                    tool_calls.append({
-                        "name": tool_name,
-                        "parameters": parameters
-                    })
-                    logger.info(f"✅ 工具呼叫解析成功: {tool_name}")
-                except Exception as e:
-                    logger.error(f"❌ 工具參數解析失敗: {e}")
+            logger.debug("🛠️ 檢測到 %s 個工具呼叫", len(tool_calls))
+            tool_call_count += 1
+            answer_cacheable = answer_cacheable and self._answer_cacheable(tool_calls)
+            self._add_tool_results(prompt, ai_response, tool_calls, await execute_tools_async(tool_calls), native)
+        
+        logger.warning("⚠️ 達到最大工具呼叫次數限制")
+        TOOL_ROUNDS.observe(tool_call_count)
+        return "處理過程中達到工具呼叫次數限制，請稍後再試。"
+
+    @staticmethod
+    def _out_of_time(tool_call_count):
+        """這則回覆剩餘的時間是否已不足以再進行一回合工具呼叫"""
+        if deadline.tools_allowed():
+            return False
+        DEADLINE_EXCEEDED.inc(stage="tool_rounds")
+        logger.warning(f"⏰ 回覆時限快到(剩餘 {deadline.remaining():.1f} 秒)，經過 {tool_call_count} 回合工具呼叫後直接回答")
+        return True
+
+    @staticmethod
+    def _final_answer(ai_response):
+        """時限快到時的回答不再執行工具，去除其中的工具標記"""
+        return strip_tool_markers(ai_response).strip() or DEADLINE_FALLBACK
+
+    @staticmethod
+    def _answer_cacheable(tool_calls):
+        return all(AVAILABLE_TOOLS[c["name"]].get("answer_cacheable", True) for c in tool_calls)
+
+    def _add_tool_results(self, prompt, ai_response, tool_calls, tool_results, native):
+        # 重複的呼叫只加入一次結果
+        unique = {}
+        for tool_call, result in zip(tool_calls, tool_results):
+            unique.setdefault(tool_call_key(tool_call["name"], tool_call["parameters"]), (tool_call, result))
+        if native:
+            # 原生模式需先記錄模型的工具呼叫(同樣去除重複)，每個呼叫都有一則對應的role: tool結果
+            prompt.add_tool_calls(ai_response, [tool_call for tool_call, _ in unique.values()])
+        for tool_call, result in unique.values():
+            # 只保留該工具設定的欄位，整理成精簡表格後加入對話（過長的結果會被截斷）
+            prompt.add_tool_result(tool_call['name'], format_tool_result(tool_call['name'], result), native=native)
+            logger.debug("📝 已加入工具結果: %s", tool_call['name'])
+
+    def _build_request(self, prompt, priority, final=False):
+        """組出送給排程器的請求，回傳(請求參數, 是否使用原生工具呼叫)
+
+        final=True時不提供tools參數，並在訊息最後附上DEADLINE_NOTE；
+        文字版工具說明保持不變，以免改變前綴而無法重用prompt快取。
+        """
+        native = self.native_tools
+        # 原生模式以tools參數描述工具，不需在系統訊息中附上文字版工具說明
+        prompt.set_tool_instructions(not native)
+        # Prompt已維護好可直接送出的訊息列表，不需逐則解析
+        messages = prompt.get_messages()
+        logger.debug("📋 總共 %s 條訊息", len(messages))
+        if final:
+            messages = messages + [{"role": "system", "content": DEADLINE_NOTE}]
+        PROMPT_CHARS.observe(sum(len(message.get("content") or "") for message in messages))
+        
+        request = {
+            "priority": priority,
+            "route_key": prompt.session_id,  # 同一段對話固定在同一台主機
+            "model": self.model,
+            "messages": messages,
+            "keep_alive": -1,  # 永遠保持在記憶體中
+            "think": self.enable_thinking  # 控制thinking模式
+        }
+        if native and not final:
+            request["tools"] = get_tool_schemas()
+        return request, native
+
+    def _record_generation(self, response, start):
+        """記錄一次生成的時間與token數；prefill/生成時間取自Ollama回報的duration(奈秒)"""
+        OLLAMA_REQUEST_SECONDS.observe(time.monotonic() - start, model=self.model)
+        if response.get('prompt_eval_duration'):
+            OLLAMA_PREFILL_SECONDS.observe(response['prompt_eval_duration'] / 1e9, model=self.model)
+        if response.get('eval_duration'):
+            OLLAMA_GENERATION_SECONDS.observe(response['eval_duration'] / 1e9, model=self.model)
+        if response.get('prompt_eval_count'):
+            PROMPT_TOKENS.observe(response['prompt_eval_count'])
+            OLLAMA_TOKENS.inc(response['prompt_eval_count'], model=self.model, kind="prompt")
+        if response.get('eval_count'):
+            OLLAMA_TOKENS.inc(response['eval_count'], model=self.model, kind="generated")
+
+    def _parse_response(self, response, native):
+        """從非串流回應取出(回應文字, 工具呼叫)"""
+        logger.debug("✅ 成功獲取Ollama回應")
+        ai_response = (response['message'].get('content') or "").strip()
+        logger.debug("🤖 AI回應內容: %s", ai_response)
+        
+        # 檢查是否包含工具呼叫
+        if native:
+            tool_calls = self._native_tool_calls(response['message'].get('tool_calls'))
+        else:
+            tool_calls = self._extract_tool_calls(ai_response)
+        return ai_response, tool_calls
+
+    def _tools_unsupported(self, error, native):
+        """模型不支援tools參數時改用文字標記，回傳是否需要重送"""
+        if native and "does not support tools" in str(error):
+            logger.warning(f"⚠️ 模型 {self.model} 不支援tools參數，改用文字標記呼叫工具")
+            self.native_tools = False
+            return True
+        return False
+
+    def _request(self, prompt, priority, final=False):
+        """向Ollama請求一次回應，回傳(回應文字, 工具呼叫, 是否為原生工具呼叫)
+
+        final=True時為時限快到的最後回答，不回傳工具呼叫。
+        """
+        request, native = self._build_request(prompt, priority, final)
+        logger.debug("🚀 開始向Ollama請求回應")
+        try:
+            if self.enable_stream:
+                # 串流模式下工具呼叫在生成過程中就已送出執行
+                ai_response, tool_calls = self._chat_stream(request, detect_tools=not final)
+            else:
+                start = time.monotonic()
+                response = self.scheduler.chat(**request)
+                self._record_generation(response, start)
+                ai_response, tool_calls = self._parse_response(response, native)
+        except ollama.ResponseError as e:
+            if self._tools_unsupported(e, native):
+                return self._request(prompt, priority, final)
+            raise
+        if final:
+            return self._final_answer(ai_response), [], native
+        return ai_response, tool_calls, native
+
+    async def _request_async(self, prompt, priority, final=False):
+        request, native = self._build_request(prompt, priority, final)
+        logger.debug("🚀 開始向Ollama請求回應(asyncio)")
+        try:
+            start = time.monotonic()
+            response = await self.async_scheduler.chat(**request)
+            self._record_generation(response, start)
+        except ollama.ResponseError as e:
+            if self._tools_unsupported(e, native):
+                return await self._request_async(prompt, priority, final)
+            raise
+        ai_response, tool_calls = self._parse_response(response, native)
+        if final:
+            return self._final_answer(ai_response), [], native
+        return ai_response, tool_calls, native
+
+    def _chat_stream(self, request, detect_tools=True):
+        """以串流方式取得回應，完整的工具呼叫一出現就送出執行，不等生成結束
+
+        detect_tools=False時(時限快到的最後回答)只取得文字，不執行工具。
+        """
+        logger.debug("🌊 以串流模式請求Ollama回應")
+        # 不能命名為start：下面送出工具的內部函式也叫start
+        requested = time.monotonic()
+        stream = self.scheduler.chat(stream=True, **request)
+        
+        content = ""
+        scanned = 0  # 已解析到的位置，之前的工具標記不重複處理
+        tool_calls = []
+        submitted = {}
+        
+        def start(tool_call):
+            key = tool_call_key(tool_call["name"], tool_call["parameters"])
+            if key not in submitted:
+                submitted[key] = submit_tool(tool_call["name"], tool_call["parameters"])
+                logger.debug("⚡ 串流中已開始執行工具: %s", tool_call['name'])
+            tool_call["future"] = submitted[key]
+            tool_calls.append(tool_call)
+        
+        try:
+            for chunk in stream:
+                if chunk.get('done'):
+                    # 最後一個chunk帶有duration與token數；提前停止生成時沒有這些資訊
+                    self._record_generation(chunk, requested)
+                message = chunk['message']
+                # 原生模式的工具呼叫以結構化欄位回傳
+                if detect_tools:
+                    for tool_call in self._native_tool_calls(message.get('tool_calls')):
+                        start(tool_call)
+                
+                piece = message.get('content') or ""
+                if not piece:
+                    continue
+                content += piece
+                
+                if detect_tools and "tools" not in request:
+                    for tool_name, params_str, _, end in find_tool_markers(content, scanned, complete=False):
+                        tool_call = self._parse_tool_call(tool_name, params_str)
+                        if tool_call:
+                            start(tool_call)
+                        scanned = end
+                
+                # 工具標記之後出現非標記的文字，代表模型已不會再呼叫工具
+                if tool_calls and self.stream_stop_on_tool:
+                    rest = content[scanned:].lstrip()
+                    if rest and not rest.startswith("["):
+                        logger.debug("⏹️ 已取得工具呼叫，提前停止生成")
+                        break
             else:
+                # 生成完畢：剩下無法解析成JSON的參數改以簡單字串處理
+                if detect_tools and "tools" not in request:
+                    for tool_name, params_str, _, _ in find_tool_markers(content, scanned):
+                        tool_call = self._parse_tool_call(tool_name, params_str)
+                        if tool_call:
+                            start(tool_call)
+        finally:
+            close = getattr(stream, "close", None)
+            if close:
+                close()
+        
+        ai_response = content.strip()
+        logger.debug("🤖 AI回應內容: %s", ai_response)
+        return ai_response, tool_calls
+
+    def _native_tool_calls(self, raw_calls):
+        """將Ollama回傳的結構化tool_calls轉成內部的工具呼叫格式"""
+        tool_calls = []
+        for raw_call in raw_calls or []:
+            function = raw_call['function']
+            tool_name = function['name']
+            if tool_name not in AVAILABLE_TOOLS:
                 logger.warning(f"⚠️ 未知的工具: {tool_name}")
+                continue
+            parameters = dict(function.get('arguments') or {})
+            logger.debug("🛠️ 發現工具呼叫: %s 參數: %s", tool_name, parameters)
+            tool_calls.append({"name": tool_name, "parameters": parameters})
+        return tool_calls
+
+    @staticmethod
+    def _parse_tool_call(tool_name, params_str):
+        """解析單一工具呼叫，工具不存在或參數錯誤時回傳None"""
+        logger.debug("🛠️ 發現工具呼叫: %s 參數: %s", tool_name, params_str)
+        
+        if tool_name not in AVAILABLE_TOOLS:
+            logger.warning(f"⚠️ 未知的工具: {tool_name}")
+            return None
+        
+        try:
+            # 解析參數
+            if (params_str[0], params_str[-1]) in (('{', '}'), ('[', ']')):
+                # JSON格式參數；JSON陣列對應工具的主要參數(例如itemnums)
+                parameters = json.loads(params_str)
+                if isinstance(parameters, list):
+                    parameters = parse_tool_arguments(tool_name, parameters)
+            else:
+                # 簡單字串參數，對應工具的主要參數(itemnum或以逗號分隔的itemnums)
+                parameters = parse_tool_arguments(tool_name, params_str)
+        except Exception as e:
+            logger.error(f"❌ 工具參數解析失敗: {e}")
+            return None
+        
+        logger.debug("✅ 工具呼叫解析成功: %s", tool_name)
+        return {
+            "name": tool_name,
+            "parameters": parameters
+        }
+
+    def _extract_tool_calls(self, text):
+        """從AI回應中提取工具呼叫"""
+        logger.debug("🔍 分析AI回應中的工具呼叫")
+        tool_calls = []
+        
+        for tool_name, params_str, _, _ in find_tool_markers(text):
+            tool_call = self._parse_tool_call(tool_name, params_str)
+            if tool_call:
+                tool_calls.append(tool_call)
         
         return tool_calls
 
-    def add_msg(self, text):
-        logger.info(f"📝 加入訊息到對話: {text}")
-        self.prompt.add_msg(text)
-        logger.info(f"✅ 訊息已加入，目前對話長度: {len(self.prompt.msg_list)}")
+    def add_msg(self, text, prompt=None, role=None):
+        if prompt is None:
+            prompt = self.prompt
+        logger.debug("📝 加入訊息到對話: %s", text)
+        prompt.add_msg(text, role)
+        logger.debug("✅ 訊息已加入，目前對話長度: %s", len(prompt))
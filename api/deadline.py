@@ -0,0 +1,41 @@
+import contextvars
+import time
+import os
+
+# 收到訊息到送出回覆的時間上限(秒)；LINE的reply token大約1分鐘後失效
+REPLY_DEADLINE = float(os.getenv("REPLY_DEADLINE", default=50))
+# 保留給最終回答生成的秒數：剩餘時間低於這個值時不再呼叫工具，以目前取得的結果回答
+REPLY_DEADLINE_RESERVE = float(os.getenv("REPLY_DEADLINE_RESERVE", default=12))
+
+# 目前請求的截止時間(time.monotonic())；asyncio task與copy_context()後交給執行緒的工作會沿用
+_deadline = contextvars.ContextVar("reply_deadline", default=None)
+
+
+def start_deadline(seconds=REPLY_DEADLINE, started=None):
+    """從started(預設為現在)起算，設定目前請求的截止時間；seconds <= 0時不設限"""
+    if seconds and seconds > 0:
+        _deadline.set((started if started is not None else time.monotonic()) + seconds)
+    else:
+        _deadline.set(None)
+
+
+def remaining():
+    """距離截止時間的秒數，沒有設定截止時間時回傳None"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def tool_budget():
+    """工具呼叫還能使用的秒數(已扣除保留給最終回答的時間)，沒有設定截止時間時回傳None"""
+    left = remaining()
+    if left is None:
+        return None
+    return max(left - REPLY_DEADLINE_RESERVE, 0.0)
+
+
+def tools_allowed():
+    """剩餘時間是否還足夠再進行一回合工具呼叫"""
+    budget = tool_budget()
+    return budget is None or budget > 0
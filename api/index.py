@@ -1,27 +1,63 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 from api.chatgpt import ChatGPT
+from api.session import SessionManager, get_session_id
+from api.transport import get_session, pool_config, PooledRequestsHttpClient
+from api.tools import AVAILABLE_TOOLS, get_tool_cache_stats
+from api.worker import create_message_queue
+from api.log import setup_logging, new_request_id, log_event
+from api.deadline import start_deadline, REPLY_DEADLINE
+from api import metrics
 import os
-import threading
 import time
+import functools
+import contextvars
+import threading
 import logging
 
-# 設定logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# 設定logging(LOG_LEVEL、LOG_FORMAT=text/json、LOG_DEBUG_SAMPLE_RATE)
+setup_logging()
 logger = logging.getLogger(__name__)
-line_bot_api = LineBotApi(os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+_started = time.monotonic()
+_line_pool = pool_config("line")
+line_bot_api = LineBotApi(
+    os.getenv("LINE_CHANNEL_ACCESS_TOKEN"),
+    endpoint=os.getenv("LINE_API_ENDPOINT", default=LineBotApi.DEFAULT_API_ENDPOINT),
+    timeout=(_line_pool["connect_timeout"], _line_pool["read_timeout"]),
+    http_client=PooledRequestsHttpClient
+)
 line_handler = WebhookHandler(os.getenv("LINE_CHANNEL_SECRET"))
 working_status = os.getenv("DEFALUT_TALKING", default = "true").lower() == "true"
 app = Flask(__name__)
-chatgpt = ChatGPT()
+# 共用的ChatGPT在第一次使用時才建立，模型在背景預載入，不延遲服務啟動
+_chatgpt = None
+_chatgpt_lock = threading.Lock()
+
+def get_chatgpt():
+    global _chatgpt
+    if _chatgpt is None:
+        with _chatgpt_lock:
+            if _chatgpt is not None:
+                return _chatgpt
+            chatgpt = ChatGPT()
+            chatgpt.balancer.start_health_monitor()
+            _chatgpt = chatgpt
+        # 在鎖外預載入：OLLAMA_PRELOAD=sync時只有建立的執行緒等待，其他請求不被擋住
+        chatgpt.start_preload()
+    return _chatgpt
+
+# 不等第一個請求，匯入後立即在背景建立並開始預載入
+threading.Thread(target=get_chatgpt, name="chatgpt-init", daemon=True).start()
+
+# 每個用戶/群組各自一段對話，共用同一個ChatGPT(模型連線)
+sessions = SessionManager()
+# 固定數量的worker處理訊息，取代每則訊息一個執行緒
+message_queue = create_message_queue()
 # domain root
 @app.route('/')
 def home():
@@ -31,23 +67,43 @@ def home():
 @app.route('/status', methods=['GET'])
 def status():
     """顯示目前的設定狀態"""
+    from api.tool_plugins.maximo import MAXIMO_SCRIPT_URL
     use_sync_mode = os.getenv("USE_SYNC_MODE", "true").lower() == "true"
+    chatgpt = get_chatgpt()
     
     return {
         "status": "運行中",
         "mode": "同步模式" if use_sync_mode else "異步模式",
         "line_configured": bool(os.getenv("LINE_CHANNEL_ACCESS_TOKEN")),
-        "ollama_host": os.getenv("OLLAMA_HOST", "http://localhost:11434"),
+        "ollama_host": chatgpt.ollama_hosts,
         "ollama_model": os.getenv("OLLAMA_MODEL", "qwen3:7b-instruct-q4_0"),
         "sync_mode_enabled": use_sync_mode,
         "tools_enabled": True,
-        "available_tools": ["get_inventory_info", "get_item_info"],
-        "tool_api_base": "http://tra.webtw.xyz:8888/maximo/oslc/script/",
+        "tool_calling_mode": "native" if chatgpt.native_tools else "marker",
+        "available_tools": list(AVAILABLE_TOOLS),
+        "tool_api_base": f"{MAXIMO_SCRIPT_URL}/",
+        "reply_deadline": REPLY_DEADLINE,
         "maxauth_configured": bool(os.getenv("MAXAUTH")),
         "max_tool_calls": int(os.getenv("MAX_TOOL_CALLS", default=3)),
-        "thinking_enabled": os.getenv("ENABLE_THINKING", "false").lower() == "true"
+        "thinking_enabled": os.getenv("ENABLE_THINKING", "false").lower() == "true",
+        "model_ready": chatgpt.ready.is_set(),
+        "model_preload": chatgpt.preload_state,
+        "uptime_seconds": round(time.monotonic() - _started, 1),
+        "sessions": sessions.stats(),
+        "tool_cache": get_tool_cache_stats(),
+        "message_queue": message_queue.stats(),
+        "ollama_scheduler": chatgpt.scheduler.stats(),
+        "ollama_backends": chatgpt.balancer.stats(),
+        "ollama_healthy": chatgpt.balancer.healthy,
+        "answer_cache": chatgpt.answer_cache.stats(),
+        "summarizer": chatgpt.summarizer.stats()
     }
 
+# Prometheus指標
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 # 測試endpoint
 @app.route('/test', methods=['GET'])
 def test_line_api():
@@ -66,9 +122,8 @@ def test_line_api():
     
     # 測試ollama連接
     try:
-        import requests
         ollama_host = os.getenv("OLLAMA_HOST", "http://localhost:11434")
-        test_response = requests.get(f"{ollama_host}/api/tags", timeout=5)
+        test_response = get_session("ollama").get(f"{ollama_host}/api/tags", timeout=5)
         results["ollama_connection"] = f"成功 - 狀態碼: {test_response.status_code}"
         results["ollama_models"] = test_response.json()
     except Exception as e:
@@ -76,8 +131,7 @@ def test_line_api():
     
     # 測試ChatGPT初始化
     try:
-        test_chatgpt = ChatGPT()
-        results["chatgpt_init"] = "成功"
+        results["chatgpt_init"] = f"成功 - 模型預載入: {get_chatgpt().preload_state}"
     except Exception as e:
         results["chatgpt_init"] = f"失敗: {str(e)}"
     
@@ -121,69 +175,42 @@ def test_tool(tool_name, itemnum):
 def test_maximo():
     """測試Maximo API連接和認證"""
     logger.info("🔍 測試Maximo API連接")
+    from api.tool_plugins.maximo import MAXIMO_SCRIPT_URL
     
     results = {
         "maxauth_configured": bool(os.getenv("MAXAUTH")),
-        "api_base": "http://tra.webtw.xyz:8888/maximo/oslc/script/",
+        "api_base": f"{MAXIMO_SCRIPT_URL}/",
         "tests": []
     }
     
-    # 測試庫存API
-    try:
-        import requests
-        url = "http://tra.webtw.xyz:8888/maximo/oslc/script/ZZ_ITEM_GETINVB?itemnum=TEST123"
-        
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
-        maxauth = os.getenv("MAXAUTH")
-        if maxauth:
-            headers["maxauth"] = maxauth
-        
-        response = requests.get(url, headers=headers, timeout=10)
-        
-        results["tests"].append({
-            "api": "ZZ_ITEM_GETINVB",
-            "status_code": response.status_code,
-            "success": response.status_code == 200,
-            "message": "連接成功" if response.status_code == 200 else f"HTTP {response.status_code}"
-        })
-        
-    except Exception as e:
-        results["tests"].append({
-            "api": "ZZ_ITEM_GETINVB",
-            "success": False,
-            "error": str(e)
-        })
-    
-    # 測試料號API
-    try:
-        url = "http://tra.webtw.xyz:8888/maximo/oslc/script/ZZ_ITEM_GETITEM?itemnum=TEST123"
-        
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
-        maxauth = os.getenv("MAXAUTH")
-        if maxauth:
-            headers["maxauth"] = maxauth
-        
-        response = requests.get(url, headers=headers, timeout=10)
-        
-        results["tests"].append({
-            "api": "ZZ_ITEM_GETITEM",
-            "status_code": response.status_code,
-            "success": response.status_code == 200,
-            "message": "連接成功" if response.status_code == 200 else f"HTTP {response.status_code}"
-        })
-        
-    except Exception as e:
-        results["tests"].append({
-            "api": "ZZ_ITEM_GETITEM",
-            "success": False,
-            "error": str(e)
-        })
+    # 測試庫存API與料號API
+    for script in ("ZZ_ITEM_GETINVB", "ZZ_ITEM_GETITEM"):
+        try:
+            headers = {
+                "Content-Type": "application/json"
+            }
+            
+            maxauth = os.getenv("MAXAUTH")
+            if maxauth:
+                headers["maxauth"] = maxauth
+            
+            response = get_session("maximo").get(
+                f"{MAXIMO_SCRIPT_URL}/{script}", params={"itemnum": "TEST123"}, headers=headers
+            )
+            
+            results["tests"].append({
+                "api": script,
+                "status_code": response.status_code,
+                "success": response.status_code == 200,
+                "message": "連接成功" if response.status_code == 200 else f"HTTP {response.status_code}"
+            })
+            
+        except Exception as e:
+            results["tests"].append({
+                "api": script,
+                "success": False,
+                "error": str(e)
+            })
     
     logger.info(f"📋 Maximo API測試完成: {results}")
     return results
@@ -208,8 +235,8 @@ def test_thinking():
         # 測試thinking啟用
         try:
             logger.info("🧠 測試thinking啟用模式")
-            temp_chatgpt = ChatGPT()
-            temp_chatgpt.enable_thinking = True
+            # 共用同一組連線，只換掉對話與thinking設定
+            temp_chatgpt = get_chatgpt().fork(enable_thinking=True)
             temp_chatgpt.add_msg(f"user:{test_message}")
             
             thinking_response = temp_chatgpt.get_response()
@@ -229,8 +256,7 @@ def test_thinking():
         # 測試thinking禁用
         try:
             logger.info("🚫 測試thinking禁用模式")
-            temp_chatgpt2 = ChatGPT()
-            temp_chatgpt2.enable_thinking = False
+            temp_chatgpt2 = get_chatgpt().fork(enable_thinking=False)
             temp_chatgpt2.add_msg(f"user:{test_message}")
             
             no_thinking_response = temp_chatgpt2.get_response()
@@ -255,17 +281,17 @@ def test_thinking():
         return {"error": str(e)}
 @app.route("/webhook", methods=['POST'])
 def callback():
-    logger.info("🔄 收到webhook請求")
+    logger.debug("🔄 收到webhook請求")
     # get X-Line-Signature header value
     signature = request.headers['X-Line-Signature']
     # get request body as text
     body = request.get_data(as_text=True)
-    logger.info(f"📝 Request body: {body}")
+    logger.debug("📝 Request body: %s", body)
     # handle webhook body
     try:
-        logger.info("🔍 開始處理webhook body")
+        logger.debug("🔍 開始處理webhook body")
         line_handler.handle(body, signature)
-        logger.info("✅ Webhook處理完成")
+        logger.debug("✅ Webhook處理完成")
     except InvalidSignatureError:
         logger.error("❌ 無效的簽名")
         abort(400)
@@ -273,36 +299,53 @@ def callback():
         logger.error(f"❌ Webhook處理時發生錯誤: {e}")
         abort(500)
     return 'OK'
-def process_message_async(user_id, message_text):
+def generate_reply(session_id, message_text):
+    """在該對話的鎖內加入用戶訊息、取得AI回應並記錄回應"""
+    chatgpt = get_chatgpt()
+    session = sessions.get(session_id)
+    with session.lock:
+        session.prompt.sync()
+        # 套用上一回合結束後在背景完成的對話摘要
+        session.prompt.apply_summary()
+        chatgpt.add_msg(f"{message_text}?", session.prompt, role="user")
+        
+        start = time.monotonic()
+        reply_msg = chatgpt.get_response(session.prompt).replace("AI:", "", 1)
+        logger.debug("🤖 AI回應: %s", reply_msg)
+        
+        chatgpt.add_msg(reply_msg, session.prompt, role="assistant")
+        # 每則訊息一筆摘要事件，完整內容只在DEBUG輸出
+        log_event(logger, "reply_generated", session_id=session_id,
+                  elapsed_ms=round((time.monotonic() - start) * 1000), reply_chars=len(reply_msg))
+        # 有舊訊息被移除時在背景摘要，不佔用本次回覆的時間
+        chatgpt.summarizer.schedule(session.prompt)
+    return reply_msg
+
+def process_message_async(user_id, session_id, message_text, received):
     """異步處理訊息，避免timeout（備用方案）"""
-    logger.info(f"🚀 開始異步處理訊息 - 用戶ID: {user_id}")
-    logger.info(f"💬 用戶訊息: {message_text}")
+    logger.debug("🚀 開始異步處理訊息 - 用戶ID: %s, 對話ID: %s", user_id, session_id)
+    logger.debug("💬 用戶訊息: %s", message_text)
     
     try:
         # 處理AI回應
-        logger.info("🧠 開始處理AI回應")
-        chatgpt.add_msg(f"user:{message_text}?\n")
-        logger.info("📝 已將用戶訊息加入對話")
-        
-        logger.info("🔍 正在獲取AI回應...")
-        reply_msg = chatgpt.get_response().replace("AI:", "", 1)
-        logger.info(f"🤖 AI回應: {reply_msg}")
-        
-        chatgpt.add_msg(f"assistant:{reply_msg}\n")
-        logger.info("📝 已將AI回應加入對話")
+        logger.debug("🧠 開始處理AI回應")
+        reply_msg = generate_reply(session_id, message_text)
         
         # 發送實際回應
-        logger.info("📤 發送AI回應給用戶")
+        logger.debug("📤 發送AI回應給用戶")
         final_response = line_bot_api.push_message(
             user_id,
             TextSendMessage(text=reply_msg)
         )
-        logger.info(f"✅ AI回應已成功發送，回應: {final_response}")
+        logger.debug("✅ AI回應已成功發送，回應: %s", final_response)
+        metrics.WEBHOOK_REPLY_SECONDS.observe(time.monotonic() - received, server="flask", mode="async")
+        metrics.MESSAGES.inc(server="flask", result="success")
         
     except Exception as e:
         logger.error(f"❌ 處理訊息時發生錯誤: {e}")
         import traceback
         logger.error(f"❌ 詳細錯誤: {traceback.format_exc()}")
+        metrics.MESSAGES.inc(server="flask", result="error")
         
         # 發送錯誤訊息
         try:
@@ -314,121 +357,121 @@ def process_message_async(user_id, message_text):
         except Exception as send_error:
             logger.error(f"❌ 發送錯誤訊息時也發生錯誤: {send_error}")
 
+def process_message_sync(user_id, session_id, message_text, reply_token, received):
+    """同步模式：處理完成後以reply_message回覆（由訊息佇列的worker執行）"""
+    logger.debug("🔄 使用同步模式處理")
+    try:
+        # 讀取背景健康檢查與實際請求結果維護的狀態，不再每則訊息探測ollama
+        if not get_chatgpt().balancer.can_serve():
+            logger.error("❌ Ollama目前無可用主機")
+            metrics.MESSAGES.inc(server="flask", result="unavailable")
+            line_bot_api.reply_message(
+                reply_token,
+                TextSendMessage(text="❌ AI服務暫時無法使用，請稍後再試")
+            )
+            return
+        
+        # 處理AI回應
+        logger.debug("🧠 開始同步處理AI回應")
+        reply_msg = generate_reply(session_id, message_text)
+        
+        # 直接用reply_message發送AI回應
+        line_bot_api.reply_message(
+            reply_token,
+            TextSendMessage(text=reply_msg)
+        )
+        logger.debug("✅ 同步模式處理完成")
+        metrics.WEBHOOK_REPLY_SECONDS.observe(time.monotonic() - received, server="flask", mode="sync")
+        metrics.MESSAGES.inc(server="flask", result="success")
+        
+    except Exception as sync_error:
+        logger.error(f"❌ 同步模式處理失敗: {sync_error}")
+        import traceback
+        logger.error(f"❌ 詳細錯誤: {traceback.format_exc()}")
+        metrics.MESSAGES.inc(server="flask", result="error")
+        
+        # 發送錯誤訊息
+        try:
+            line_bot_api.reply_message(
+                reply_token,
+                TextSendMessage(text="❌ 處理訊息時發生錯誤，請稍後再試")
+            )
+        except Exception as reply_error:
+            logger.error(f"❌ 發送錯誤訊息失敗: {reply_error}")
+            # 如果reply_message失敗，嘗試用push_message
+            try:
+                line_bot_api.push_message(
+                    user_id,
+                    TextSendMessage(text="❌ 處理訊息時發生錯誤，請稍後再試")
+                )
+            except:
+                logger.error("❌ 所有訊息發送方式都失敗")
+
 @line_handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
+    # correlation ID與回覆時限只設定在這則訊息自己的context中(交給worker時再複製一份)，
+    # 不留在處理webhook的執行緒上，之後由同一個執行緒處理的其他請求才不會沿用
+    contextvars.copy_context().run(_handle_message, event)
+
+def _handle_message(event):
     global working_status
+    received = time.monotonic()
     
-    logger.info("📨 收到LINE訊息事件")
-    logger.info(f"📝 事件類型: {event.type}")
-    logger.info(f"📝 訊息類型: {event.message.type}")
+    # 之後的log(包含交給worker處理的部分)都帶有這個correlation ID
+    new_request_id(getattr(event, "webhook_event_id", None))
+    # 回覆時限從收到webhook起算，訊息在佇列中等待的時間也計入
+    start_deadline(started=received)
+    logger.debug("📨 收到LINE訊息事件: %s / %s", event.type, event.message.type)
     
     if event.message.type != "text":
         logger.info("⚠️ 非文字訊息，略過處理")
         return
     
     user_id = event.source.user_id
+    session_id = get_session_id(event.source)
     message_text = event.message.text
     reply_token = event.reply_token
     
-    logger.info(f"👤 用戶ID: {user_id}")
-    logger.info(f"💬 收到訊息: {message_text}")
-    logger.info(f"🔑 Reply Token: {reply_token}")
+    log_event(logger, "message_received", session_id=session_id, chars=len(message_text))
+    logger.debug("💬 收到訊息: %s (reply token: %s)", message_text, reply_token)
     
     working_status = True
     if working_status:
-        logger.info("✅ 系統處於工作狀態，開始處理訊息")
+        logger.debug("✅ 系統處於工作狀態，開始處理訊息")
         
         # 檢查是否使用同步模式（預設為true）
         use_sync_mode = os.getenv("USE_SYNC_MODE", "true").lower() == "true"
         
+        # 交給訊息佇列處理，webhook立即回應LINE
         if use_sync_mode:
-            logger.info("🔄 使用同步模式處理")
+            job = functools.partial(process_message_sync, user_id, session_id, message_text, reply_token, received)
+        else:
+            job = functools.partial(process_message_async, user_id, session_id, message_text, received)
+        
+        if not message_queue.submit(session_id, job):
+            metrics.MESSAGES.inc(server="flask", result="rejected")
             try:
-                # 快速檢查ollama是否可用
-                logger.info("🔍 快速檢查ollama連接")
-                import requests
-                ollama_host = os.getenv("OLLAMA_HOST", "http://localhost:11434")
-                
-                # 設定較短的timeout避免webhook超時
-                try:
-                    test_response = requests.get(f"{ollama_host}/api/tags", timeout=2)
-                    if test_response.status_code != 200:
-                        raise Exception("Ollama服務不可用")
-                    logger.info("✅ Ollama連接正常")
-                except Exception as ollama_error:
-                    logger.error(f"❌ Ollama連接失敗: {ollama_error}")
-                    line_bot_api.reply_message(
-                        reply_token,
-                        TextSendMessage(text="❌ AI服務暫時無法使用，請稍後再試")
-                    )
-                    return
-                
-                # 處理AI回應（同步執行）
-                logger.info("🧠 開始同步處理AI回應")
-                chatgpt.add_msg(f"user:{message_text}?\n")
-                logger.info("📝 已將用戶訊息加入對話")
-                
-                # 獲取AI回應
-                reply_msg = chatgpt.get_response().replace("AI:", "", 1)
-                logger.info(f"🤖 獲得AI回應: {reply_msg}")
-                
-                chatgpt.add_msg(f"assistant:{reply_msg}\n")
-                logger.info("📝 已將AI回應加入對話")
-                
-                # 直接用reply_message發送AI回應
                 line_bot_api.reply_message(
                     reply_token,
-                    TextSendMessage(text=reply_msg)
+                    TextSendMessage(text="⏳ 目前詢問人數眾多，請稍後再試")
                 )
-                logger.info("✅ 同步模式處理完成")
-                
-            except Exception as sync_error:
-                logger.error(f"❌ 同步模式處理失敗: {sync_error}")
-                import traceback
-                logger.error(f"❌ 詳細錯誤: {traceback.format_exc()}")
-                
-                # 發送錯誤訊息
-                try:
-                    line_bot_api.reply_message(
-                        reply_token,
-                        TextSendMessage(text="❌ 處理訊息時發生錯誤，請稍後再試")
-                    )
-                except Exception as reply_error:
-                    logger.error(f"❌ 發送錯誤訊息失敗: {reply_error}")
-                    # 如果reply_message失敗，嘗試用push_message
-                    try:
-                        line_bot_api.push_message(
-                            user_id,
-                            TextSendMessage(text="❌ 處理訊息時發生錯誤，請稍後再試")
-                        )
-                    except:
-                        logger.error("❌ 所有訊息發送方式都失敗")
-        else:
-            logger.info("🔄 使用異步模式處理")
-            # 先用reply_message立即回應"正在思考"
+            except Exception as reply_error:
+                logger.error(f"❌ 忙碌訊息發送失敗: {reply_error}")
+            return
+        logger.debug("📥 訊息已加入處理佇列")
+        
+        if not use_sync_mode:
+            logger.debug("🔄 使用異步模式處理")
+            # 先用reply_message立即回應"正在思考"，AI回應之後以push_message發送
             try:
-                logger.info("📤 使用reply_message發送思考中訊息")
+                logger.debug("📤 使用reply_message發送思考中訊息")
                 line_bot_api.reply_message(
                     reply_token,
                     TextSendMessage(text="🤔 正在思考中，請稍等...")
                 )
-                logger.info("✅ 思考中訊息已透過reply_message發送")
+                logger.debug("✅ 思考中訊息已透過reply_message發送")
             except Exception as reply_error:
                 logger.error(f"❌ Reply message發送失敗: {reply_error}")
-            
-            # 在背景執行緒中處理AI回應
-            logger.info("🧵 創建背景執行緒處理AI回應")
-            thread = threading.Thread(
-                target=process_message_async,
-                args=(user_id, message_text)
-            )
-            thread.daemon = True
-            thread.start()
-            logger.info("🚀 背景執行緒已啟動")
-            
-            # 等待一小段時間確保背景執行緒開始執行
-            time.sleep(0.1)
-            logger.info("⏰ 已等待背景執行緒啟動")
     else:
         logger.info("⚠️ 系統未處於工作狀態，略過處理")
 if __name__ == "__main__":
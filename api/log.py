@@ -0,0 +1,87 @@
+import contextvars
+import logging
+import random
+import json
+import time
+import uuid
+import os
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", default="INFO").upper()
+# text: 原本的文字格式；json: 每行一個JSON事件，方便收集與查詢
+LOG_FORMAT = os.getenv("LOG_FORMAT", default="text").lower()
+# LOG_LEVEL=DEBUG時，只保留這個比例的請求的DEBUG事件(以請求為單位取樣，同一請求的事件完整保留)
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", default=1.0))
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+
+# 目前請求的correlation ID；asyncio task與copy_context()後交給執行緒的工作會沿用
+_request_id = contextvars.ContextVar("request_id", default="-")
+_sampled = contextvars.ContextVar("log_sampled", default=True)
+
+
+def new_request_id(request_id=None):
+    """設定目前請求的correlation ID，並決定這個請求的DEBUG事件是否取樣"""
+    request_id = request_id or uuid.uuid4().hex[:12]
+    _request_id.set(request_id)
+    _sampled.set(LOG_DEBUG_SAMPLE_RATE >= 1 or random.random() < LOG_DEBUG_SAMPLE_RATE)
+    return request_id
+
+
+def get_request_id():
+    return _request_id.get()
+
+
+class _Event:
+    """結構化事件的訊息，只有實際輸出時才組成 "event key=value" 字串"""
+    __slots__ = ("event", "fields")
+
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        return " ".join([self.event] + [f"{key}={value}" for key, value in self.fields.items()])
+
+
+def log_event(logger, event, level=logging.INFO, **fields):
+    """輸出結構化事件；json格式時fields成為獨立的欄位"""
+    if logger.isEnabledFor(level):
+        logger.log(level, "%s", _Event(event, fields), extra={"event": event, "fields": fields})
+
+
+class ContextFilter(logging.Filter):
+    """加上correlation ID，並丟棄未被取樣的請求的DEBUG事件(在格式化之前)"""
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return record.levelno > logging.DEBUG or _sampled.get()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+        }
+        event = getattr(record, "event", None)
+        if event:
+            payload["event"] = event
+            payload.update(record.fields)
+        else:
+            payload["msg"] = record.getMessage()
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def setup_logging():
+    """設定root logger；取代各進入點原本的logging.basicConfig"""
+    handler = logging.StreamHandler()
+    handler.addFilter(ContextFilter())
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+    logging.basicConfig(level=LOG_LEVEL, handlers=[handler])
+    if LOG_LEVEL != "DEBUG":
+        # httpx/httpcore每個HTTP請求都會輸出一行INFO
+        for name in ("httpx", "httpcore"):
+            logging.getLogger(name).setLevel(logging.WARNING)
@@ -0,0 +1,147 @@
+import threading
+import bisect
+import time
+
+# 秒數的預設分界：涵蓋本機工具查詢(數十毫秒)到模型生成(數十秒)
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label值的tuple -> 數值
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._samples(items))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self, items):
+        return [f"{self.name}{self._labels(key)} {value}" for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # 每個分界一格，最後一格是+Inf，再加上總和
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """with metric.time(...): 量測區塊執行的秒數"""
+        return _Timer(self, labels)
+
+    def _samples(self, items):
+        lines = []
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._labels(key, [('le', str(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {counts[-1]}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("metric", "labels", "start")
+
+    def __init__(self, metric, labels):
+        self.metric = metric
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.metric.observe(time.monotonic() - self.start, **self.labels)
+
+
+REGISTRY = []
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def render():
+    """所有指標的Prometheus文字格式"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# 各階段的指標：用來分辨回覆變慢是來自LINE、Maximo還是模型
+WEBHOOK_REPLY_SECONDS = Histogram(
+    "linebot_webhook_reply_seconds", "收到webhook訊息到回覆送出的時間", ["server", "mode"]
+)
+MESSAGES = Counter("linebot_messages_total", "處理的訊息數", ["server", "result"])
+LINE_API_SECONDS = Histogram("linebot_line_api_seconds", "LINE Messaging API呼叫的時間", ["method"])
+OLLAMA_QUEUE_WAIT_SECONDS = Histogram(
+    "linebot_ollama_queue_wait_seconds", "等待Ollama生成名額的時間", ["priority"]
+)
+OLLAMA_PREFILL_SECONDS = Histogram(
+    "linebot_ollama_prefill_seconds", "Ollama回報的prompt_eval_duration", ["model"]
+)
+OLLAMA_GENERATION_SECONDS = Histogram(
+    "linebot_ollama_generation_seconds", "Ollama回報的eval_duration", ["model"]
+)
+OLLAMA_REQUEST_SECONDS = Histogram(
+    "linebot_ollama_request_seconds", "送出請求到取得完整回應的時間(含排隊與載入模型)", ["model"]
+)
+OLLAMA_TOKENS = Counter("linebot_ollama_tokens_total", "Ollama處理的token數", ["model", "kind"])
+PROMPT_CHARS = Histogram(
+    "linebot_prompt_chars", "送給模型的訊息字元數",
+    buckets=(500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+)
+PROMPT_TOKENS = Histogram(
+    "linebot_prompt_tokens", "Ollama回報的prompt token數(prompt_eval_count)",
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+)
+TOOL_CALL_SECONDS = Histogram("linebot_tool_call_seconds", "單次工具執行的時間(不含快取命中)", ["tool"])
+TOOL_CALLS = Counter("linebot_tool_calls_total", "實際執行的工具呼叫數", ["tool", "result"])
+TOOL_ROUNDS = Histogram(
+    "linebot_tool_rounds", "每則回覆經過的工具呼叫回合數", buckets=(0, 1, 2, 3, 4, 5)
+)
+TOOL_RETRIES = Counter("linebot_tool_retries_total", "工具查詢失敗後的重試次數", ["tool", "reason"])
+TOOL_HEDGES = Counter("linebot_tool_hedges_total", "第一個查詢等待過久而送出的備援查詢數", ["tool"])
+DEADLINE_EXCEEDED = Counter(
+    "linebot_deadline_exceeded_total", "因回覆時限而略過或放棄的步驟數", ["stage"]
+)
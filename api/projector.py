@@ -0,0 +1,113 @@
+import os
+import json
+import logging
+
+# 設定logging
+logger = logging.getLogger(__name__)
+
+# 工具結果放入對話前的格式：table(以|分隔的精簡表格)或json(單行JSON)
+TOOL_RESULT_FORMAT = os.getenv("TOOL_RESULT_FORMAT", default="table").lower()
+TOOL_RESULT_MAX_ROWS = int(os.getenv("TOOL_RESULT_MAX_ROWS", default=20))
+TOOL_RESULT_MAX_CELL = int(os.getenv("TOOL_RESULT_MAX_CELL", default=120))  # 單一欄位最多字元數
+
+# Maximo OSLC回應中包住資料列的key
+_MEMBER_KEYS = ("member", "rdfs:member", "items", "data")
+
+
+def get_field_list(env_name, default):
+    """從環境變數讀取以逗號分隔的欄位列表"""
+    return [field.strip() for field in os.getenv(env_name, default=default).split(",") if field.strip()]
+
+
+def _field_name(key):
+    # OSLC的欄位可能帶有namespace前綴，例如 spi:binnum
+    return key.rsplit(":", 1)[-1].lower()
+
+
+def _is_empty(value):
+    return value is None or value == "" or value == [] or value == {}
+
+
+def _records(data):
+    """把Maximo回應整理成資料列(dict)的列表"""
+    if isinstance(data, list):
+        return [record for record in data if isinstance(record, dict)]
+    if isinstance(data, dict):
+        for key in _MEMBER_KEYS:
+            if isinstance(data.get(key), list):
+                return _records(data[key])
+        return [data]
+    return []
+
+
+def project_record(record, fields):
+    """只保留指定欄位(不分大小寫、忽略namespace)，去除空值；沒有任何指定欄位時保留全部非空欄位"""
+    values = {_field_name(key): value for key, value in record.items() if not _is_empty(value)}
+    projected = {field: values[field.lower()] for field in fields if field.lower() in values}
+    if projected or not fields:
+        return projected
+    return {key: value for key, value in values.items() if not isinstance(value, (dict, list))}
+
+
+def _cell(value):
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+    text = str(value).replace("|", "/").replace("\n", " ").strip()
+    if len(text) > TOOL_RESULT_MAX_CELL:
+        text = text[:TOOL_RESULT_MAX_CELL] + "…"
+    return text
+
+
+def _render(rows, header, extra_columns=()):
+    """rows為[(前置欄位值tuple, 投影後的dict)]，輸出精簡表格或單行JSON"""
+    omitted = max(len(rows) - TOOL_RESULT_MAX_ROWS, 0)
+    rows = rows[:TOOL_RESULT_MAX_ROWS]
+    columns = list(extra_columns)
+    for _, projected in rows:
+        columns.extend(key for key in projected if key not in columns)
+
+    if TOOL_RESULT_FORMAT == "json":
+        payload = dict(header)
+        payload["rows"] = [
+            {**dict(zip(extra_columns, prefix)), **projected} for prefix, projected in rows
+        ]
+        if omitted:
+            payload["omitted"] = omitted
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+    lines = [" ".join(f"{key}={value}" for key, value in header.items())]
+    if rows:
+        lines.append("|".join(columns))
+        for prefix, projected in rows:
+            values = {**dict(zip(extra_columns, prefix)), **projected}
+            lines.append("|".join(_cell(values.get(column, "")) for column in columns))
+    else:
+        lines.append("(無資料)")
+    if omitted:
+        lines.append(f"...另有 {omitted} 筆未列出")
+    return "\n".join(lines)
+
+
+def project_result(result, fields):
+    """把工具結果整理成精簡文字；失敗的結果只保留錯誤訊息"""
+    if not isinstance(result, dict):
+        return json.dumps(result, ensure_ascii=False, separators=(",", ":"))
+    if not result.get("success"):
+        error = {key: result[key] for key in ("itemnum", "error", "not_found") if result.get(key) is not None}
+        return json.dumps(dict(success=False, **error), ensure_ascii=False, separators=(",", ":"))
+
+    header = {key: result[key] for key in ("type", "itemnum", "note") if result.get(key) is not None}
+    if result.get("columns") == ["itemnum", "success", "data"]:
+        # 批次結果：每個料號可能有多筆資料列，全部攤平成同一張表格
+        rows = []
+        for itemnum, success, data in result["data"]:
+            if not success:
+                rows.append(((itemnum,), {"error": data}))
+                continue
+            records = _records(data) or [{}]
+            rows.extend(((itemnum,), project_record(record, fields)) for record in records)
+        header["count"] = result.get("count", len(result["data"]))
+        return _render(rows, header, extra_columns=("itemnum",))
+
+    rows = [((), project_record(record, fields)) for record in _records(result.get("data"))]
+    return _render([row for row in rows if row[1]], header)
@@ -1,4 +1,7 @@
+from api.tool_registry import registry
+from collections import deque
 import os
+import json
 import logging
 
 # 設定logging
@@ -6,78 +9,318 @@ logger = logging.getLogger(__name__)
 
 chat_language = "zh-tw"  # 將默認語言設置為繁體中文
 MSG_LIST_LIMIT = int(os.getenv("MSG_LIST_LIMIT", default=20))
+# 對話紀錄(不含系統訊息)的token預算，越小prefill越快
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", default=3000))
+# 超過限制時的移除方式：sliding(預設)每次移除最舊的一則，保留最多的對話內容；
+# chunk一次移除最舊的一大段(EVICTION_CHUNK比例)，讓接下來多個回合的訊息前綴保持不變，
+# 適合Ollama會重複使用已快取KV cache的部署(同一段對話固定在同一台主機、OLLAMA_NUM_PARALLEL較小)
+PROMPT_EVICTION = os.getenv("PROMPT_EVICTION", default="sliding").lower()
+EVICTION_CHUNK = float(os.getenv("EVICTION_CHUNK", default=0.5))
+# 對話壓縮：被移除的舊訊息由背景工作摘要成一則系統訊息，保留在提示中
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "false").lower() == "true"
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", default=300))
+# 單次工具結果最多佔用的token數
+TOOL_RESULT_MAX_TOKENS = int(os.getenv("TOOL_RESULT_MAX_TOKENS", default=800))
 
 LANGUAGE_TABLE = {
     "zh-tw": "你好！我是一個 AI 助手。我會用繁體中文回答你的問題。",
 }
 
-# 工具使用說明
-TOOL_INSTRUCTIONS = """
-你現在擁有以下工具可以使用：
+# 工具使用說明，依已啟用的工具宣告產生
+TOOL_INSTRUCTIONS = registry.instructions()
 
-1. get_inventory_info - 查詢指定料號的庫存量與倉庫櫃位資訊
-2. get_item_info - 查詢指定料號的詳細內容與規格資訊
+# 原生function calling的訊息中，role與content以外需要一起保存的欄位
+EXTRA_FIELDS = ("tool_calls", "tool_name")
+
+# 舊格式字串前綴(例如 "user:你好")對應的role
+ROLE_PREFIXES = {
+    "system": "system",
+    "user": "user",
+    "Human": "user",
+    "assistant": "assistant",
+    "AI": "assistant",
+    "tool": "tool",
+}
+# generate_prompt產生純文字提示時使用的前綴
+PROMPT_PREFIXES = {"system": "system", "user": "Human", "assistant": "AI", "tool": "system"}
+TRUNCATED_SUFFIX = "...(內容過長已截斷)"
+
+
+def estimate_tokens(text):
+    """粗估token數：中文等非ASCII字元約1字1 token，ASCII約4字元1 token"""
+    non_ascii = sum(1 for c in text if ord(c) > 127)
+    return non_ascii + (len(text) - non_ascii + 3) // 4
 
-當用戶詢問關於料號、庫存、物料資訊時，你可以使用這些工具。
 
-使用工具的格式：
-[TOOL:工具名稱:參數]
+def truncate_text(text, max_tokens):
+    """將文字截斷到大約max_tokens以內"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens - estimate_tokens(TRUNCATED_SUFFIX)
+    # 二分搜尋可保留的最長前綴
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + TRUNCATED_SUFFIX
+
 
-例如：
-- 查詢料號 ABC123 的庫存：[TOOL:get_inventory_info:ABC123]
-- 查詢料號 DEF456 的詳細資訊：[TOOL:get_item_info:DEF456]
-- 同時查詢庫存和詳細資訊：[TOOL:get_inventory_info:ABC123] [TOOL:get_item_info:ABC123]
+def parse_msg(text, default_role="user"):
+    """將舊格式的 "role:內容" 字串拆成role與內容"""
+    prefix, sep, content = text.partition(":")
+    if sep and prefix in ROLE_PREFIXES:
+        return ROLE_PREFIXES[prefix], content.strip()
+    return default_role, text.strip()
 
-重要提醒：
-- 工具呼叫必須使用正確的格式
-- 參數就是料號，不需要加引號
-- 可以在同一個回應中呼叫多個工具
-- 工具執行完成後，你會收到結果，請根據結果回答用戶的問題
-"""
 
 class Prompt:
-    def __init__(self):
-        logger.info("🔧 初始化Prompt類別")
-        self.msg_list = []
-        system_msg1 = f"system:你是一個有幫助的 AI 助手。請始終使用繁體中文回答。"
-        system_msg2 = f"system:{LANGUAGE_TABLE[chat_language]}"
-        system_msg3 = f"system:{TOOL_INSTRUCTIONS}"
+    def __init__(self, session_id=None, storage=None):
+        logger.debug("🔧 初始化Prompt類別")
+        # 有設定storage時，對話紀錄會持久化，並在第一次使用時才載入
+        self.session_id = session_id
+        self.storage = storage
+        self._loaded = storage is None
+        self._seq = 0  # 記憶體中最後一則訊息在storage的序號
+        self._stale = False
         
-        self.msg_list.append(system_msg1)
-        self.msg_list.append(system_msg2)
-        self.msg_list.append(system_msg3)
+        # 系統訊息固定不變，對話訊息放在deque中，history本身從最舊的一端移除是O(1)；
+        # 但_messages列表也要同步刪除，成本與列表長度成正比，長度受MSG_LIST_LIMIT限制
+        self.system_msgs = [
+            {"role": "system", "content": "你是一個有幫助的 AI 助手。請始終使用繁體中文回答。"},
+            {"role": "system", "content": LANGUAGE_TABLE[chat_language]},
+        ]
+        # 沒有啟用任何工具時不附上工具說明
+        self.tool_instructions = bool(TOOL_INSTRUCTIONS)
+        if self.tool_instructions:
+            self.system_msgs.append({"role": "system", "content": TOOL_INSTRUCTIONS.strip()})
+        self.history = deque()
+        self._history_tokens = deque()  # 與history對應的每則token數
+        self.history_tokens = 0  # history的token總數
+        # 舊對話的摘要(SUMMARY_ENABLED)，以及已移除但尚未摘要的訊息
+        self.summary = None
+        self.evicted = deque()
+        self._evicted_tokens = 0
+        self.summary_job = None  # (Future, 摘要涵蓋的evicted則數)
+        # 可直接送給Ollama的訊息列表，隨add_msg/remove_msg同步更新，不需每次重建。
+        # 長度不超過MSG_LIST_LIMIT，所以移除最舊訊息(del)與_rebuild_messages最多搬動MSG_LIST_LIMIT個參照
+        self._messages = list(self.system_msgs)
         
-        logger.info(f"📝 已加入系統訊息1: {system_msg1}")
-        logger.info(f"📝 已加入系統訊息2: {system_msg2}")
-        logger.info(f"📝 已加入工具說明訊息")
-        logger.info(f"📋 訊息列表限制: {MSG_LIST_LIMIT}")
-        logger.info("✅ Prompt初始化完成")
-    
-    def add_msg(self, new_msg):
-        logger.info(f"📝 準備加入新訊息: {new_msg}")
+        logger.debug("📋 訊息列表限制: %s, token預算: %s", MSG_LIST_LIMIT, PROMPT_TOKEN_BUDGET)
+
+    def set_tool_instructions(self, enabled):
+        """是否在系統訊息中附上文字版工具說明；使用Ollama原生tools參數時不需要"""
+        enabled = enabled and bool(TOOL_INSTRUCTIONS)
+        if enabled == self.tool_instructions:
+            return
+        self.tool_instructions = enabled
+        if enabled:
+            self.system_msgs.append({"role": "system", "content": TOOL_INSTRUCTIONS.strip()})
+        else:
+            self.system_msgs.pop()
+        self._rebuild_messages()
+
+    def _rebuild_messages(self):
+        self._messages = list(self.system_msgs)
+        if self.summary:
+            self._messages.append({"role": "system", "content": f"先前對話摘要：{self.summary}"})
+        self._messages.extend(self.history)
+
+    def _keep_evicted(self, record, tokens):
+        """保留被移除的訊息等待摘要，總量以token預算為上限"""
+        if not SUMMARY_ENABLED:
+            return
+        self.evicted.append((record, tokens))
+        self._evicted_tokens += tokens
+        while len(self.evicted) > 1 and self._evicted_tokens > PROMPT_TOKEN_BUDGET:
+            _, dropped = self.evicted.popleft()
+            self._evicted_tokens -= dropped
+
+    def apply_summary(self):
+        """套用已完成的背景摘要（需在該對話的鎖內呼叫）"""
+        if self.summary_job is None:
+            return
+        future, consumed = self.summary_job
+        if not future.done():
+            return
+        self.summary_job = None
+        try:
+            summary = future.result()
+        except Exception as e:
+            logger.error(f"❌ 對話摘要失敗: {e}")
+            return
+        if not summary:
+            return
+        self.summary = truncate_text(summary, SUMMARY_MAX_TOKENS)
+        # 摘要進行期間可能有更多訊息被移除，只刪除已被摘要涵蓋的部分
+        for _ in range(min(consumed, len(self.evicted))):
+            _, tokens = self.evicted.popleft()
+            self._evicted_tokens -= tokens
+        self._rebuild_messages()
+        logger.info("🧾 已套用對話摘要，%s 字元", len(self.summary))
+
+    def get_messages(self):
+        """回傳要送給模型的訊息列表（內部快取，呼叫端請勿修改）"""
+        return self._messages
+
+    def __len__(self):
+        return len(self._messages)
+
+    def sync(self):
+        """與storage同步：第一次使用時載入歷史，其他worker寫入新訊息時重新載入"""
+        if self.storage is None:
+            return
+        if self._loaded and not self._stale and self.storage.last_seq(self.session_id) == self._seq:
+            return
+        self._load()
+
+    def _load(self):
+        rows = self.storage.load(self.session_id, MSG_LIST_LIMIT - len(self.system_msgs))
+        self.history.clear()
+        self._history_tokens.clear()
+        self.history_tokens = 0
+        self._rebuild_messages()
+        for seq, role, content, extra in rows:
+            record = {"role": ROLE_PREFIXES.get(role, role), "content": content}
+            if extra:
+                record.update(extra)
+            if not self.history and record["role"] == "tool":
+                # 只載入最後幾則時可能從工具呼叫的中間開始，對應的呼叫不在範圍內
+                continue
+            self._append_history(record)
+        self._seq = rows[-1][0] if rows else 0
+        self._loaded = True
+        self._stale = False
+        logger.info("📥 已載入對話紀錄 %s: %s 則", self.session_id, len(rows))
+
+    def _persist(self, record):
+        """只寫入新增的這一則訊息，不重寫整段歷史"""
+        extra = {field: record[field] for field in EXTRA_FIELDS if field in record}
+        seq = self.storage.append(self.session_id, record["role"], record["content"], extra or None)
+        if seq != self._seq + 1:
+            # 中間有其他worker寫入的訊息，下次sync時重新載入
+            self._stale = True
+        self._seq = seq
+
+    def _append_history(self, record):
+        """加入一則對話訊息，超過訊息數或token預算時從最舊的開始移除"""
+        tokens = estimate_tokens(record["content"])
+        if tokens > PROMPT_TOKEN_BUDGET:
+            record["content"] = truncate_text(record["content"], PROMPT_TOKEN_BUDGET)
+            tokens = estimate_tokens(record["content"])
+            logger.warning(f"✂️ 單則訊息超過token預算，已截斷為 {tokens} tokens")
         
-        if len(self.msg_list) >= MSG_LIST_LIMIT:
-            logger.warning(f"⚠️ 訊息列表達到限制 ({MSG_LIST_LIMIT})，需要移除舊訊息")
-            self.remove_msg()
+        if self.history and (
+            len(self._messages) >= MSG_LIST_LIMIT
+            or self.history_tokens + tokens > PROMPT_TOKEN_BUDGET
+        ):
+            if PROMPT_EVICTION == "chunk":
+                self._evict_chunk(tokens)
+            else:
+                while self.history and (
+                    len(self._messages) >= MSG_LIST_LIMIT
+                    or self.history_tokens + tokens > PROMPT_TOKEN_BUDGET
+                ):
+                    self.remove_msg()
         
-        if not new_msg.startswith(("Human:", "AI:", "system:")):
-            original_msg = new_msg
-            new_msg = f"Human:{new_msg}"
-            logger.info(f"🔄 訊息格式化: {original_msg} -> {new_msg}")
+        self.history.append(record)
+        self._history_tokens.append(tokens)
+        self.history_tokens += tokens
+        self._messages.append(record)
+        return record
+    
+    def _add_record(self, record):
+        """加入一筆訊息紀錄並寫入storage"""
+        if not self._loaded:
+            self._load()
+        record = self._append_history(record)
+        if self.storage is not None:
+            self._persist(record)
+        return record
+    
+    def add_msg(self, new_msg, role=None):
+        """加入一則訊息；未指定role時，接受舊格式的 "user:"/"assistant:"/"system:" 等前綴"""
+        if role is None:
+            role, content = parse_msg(new_msg)
+        else:
+            content = new_msg.strip()
         
-        self.msg_list.append(new_msg)
-        logger.info(f"✅ 訊息已加入，目前列表長度: {len(self.msg_list)}")
+        self._add_record({"role": role, "content": content})
+        logger.debug("✅ 已加入 %s 訊息，目前列表長度: %s, tokens: %s", role, len(self._messages), self.history_tokens)
+
+    def add_tool_calls(self, content, tool_calls):
+        """加入模型以原生function calling發出的工具呼叫(assistant訊息)"""
+        self._add_record({
+            "role": "assistant",
+            "content": content,
+            "tool_calls": [
+                {"function": {"name": call["name"], "arguments": call["parameters"]}}
+                for call in tool_calls
+            ]
+        })
+
+    def add_tool_result(self, tool_name, result, native=False):
+        """加入工具執行結果並限制長度；result可為已整理好的文字，其他以不縮排的JSON編碼
+
+        native=True時以role: tool訊息加入，對應add_tool_calls的呼叫。
+        """
+        if isinstance(result, str):
+            payload = result
+        else:
+            payload = json.dumps(result, ensure_ascii=False, separators=(",", ":"))
+        payload = truncate_text(payload, TOOL_RESULT_MAX_TOKENS)
+        if native:
+            self._add_record({"role": "tool", "content": payload, "tool_name": tool_name})
+        else:
+            self.add_msg(f"工具執行結果 [{tool_name}]: {payload}", role="system")
+
+    def _evict_chunk(self, incoming_tokens):
+        """一次移除最舊的一段對話，直到訊息數與token數都降到上限的(1 - EVICTION_CHUNK)以下"""
+        keep = 1 - EVICTION_CHUNK
+        max_msgs = max(int((MSG_LIST_LIMIT - len(self.system_msgs)) * keep), 0)
+        max_tokens = PROMPT_TOKEN_BUDGET * keep
+        removed = 0
+        while self.history and (
+            len(self.history) >= max_msgs
+            or self.history_tokens + incoming_tokens > max_tokens
+        ):
+            removed += self._pop_oldest()
+        self._rebuild_messages()
+        logger.info("🗑️ 一次移除 %s 則舊訊息，剩餘 %s 則", removed, len(self.history))
+
+    def _pop_oldest(self):
+        """從history移除最舊的一則，連同之後對應的工具結果(role: tool)，回傳移除則數
+
+        原生function calling的工具結果必須跟在發出呼叫的assistant訊息之後，
+        不能留下沒有對應呼叫的tool訊息。
+        """
+        removed = 0
+        while True:
+            record = self.history.popleft()
+            tokens = self._history_tokens.popleft()
+            self.history_tokens -= tokens
+            self._keep_evicted(record, tokens)
+            removed += 1
+            if not self.history or self.history[0]["role"] != "tool":
+                return removed
 
     def remove_msg(self):
-        if len(self.msg_list) > 3:
-            removed_msg = self.msg_list.pop(3)  # 保留三個系統消息，刪除最早的對話消息
-            logger.info(f"🗑️ 已移除舊訊息: {removed_msg}")
-            logger.info(f"📋 移除後列表長度: {len(self.msg_list)}")
+        if self.history:
+            # 保留系統消息，刪除最早的對話消息
+            first = len(self._messages) - len(self.history)
+            removed = self.history[0]
+            count = self._pop_oldest()
+            # 列表長度上限為MSG_LIST_LIMIT，這裡的搬移成本是O(MSG_LIST_LIMIT)而非O(1)
+            del self._messages[first:first + count]
+            logger.debug("🗑️ 已移除舊訊息 %s 則: %s:%.50s", count, removed['role'], removed['content'])
         else:
             logger.warning("⚠️ 無法移除訊息，列表中只有系統訊息")
 
     def generate_prompt(self):
-        logger.info("🔧 生成完整提示")
-        prompt = '\n'.join(self.msg_list) + "\n請用繁體中文回答。"
-        logger.info(f"📝 生成的提示長度: {len(prompt)} 字元")
+        logger.debug("🔧 生成完整提示")
+        lines = [f"{PROMPT_PREFIXES.get(m['role'], m['role'])}:{m['content']}" for m in self._messages]
+        prompt = '\n'.join(lines) + "\n請用繁體中文回答。"
+        logger.debug("📝 生成的提示長度: %s 字元", len(prompt))
         return prompt
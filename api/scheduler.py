@@ -0,0 +1,274 @@
+from concurrent.futures import Future
+from api.metrics import OLLAMA_QUEUE_WAIT_SECONDS
+import os
+import asyncio
+import json
+import heapq
+import hashlib
+import itertools
+import threading
+import time
+import logging
+
+# 設定logging
+logger = logging.getLogger(__name__)
+
+OLLAMA_MAX_CONCURRENT = int(os.getenv("OLLAMA_MAX_CONCURRENT", default=2))  # 每台主機的同時生成數，建議與Ollama的OLLAMA_NUM_PARALLEL相同
+OLLAMA_COALESCE = os.getenv("OLLAMA_COALESCE", "true").lower() == "true"
+
+# 數字越小越優先：工具結果回來後的最終回答先於新的對話
+PRIORITY_FOLLOWUP = 0
+PRIORITY_NEW = 1
+PRIORITY_BACKGROUND = 2  # 對話摘要等不影響回覆的工作
+
+
+class PrioritySemaphore:
+    """依優先順序(同優先依先來後到)分配名額的semaphore"""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self._free = slots
+        self._waiters = []  # (priority, 序號, Event)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def acquire(self, priority):
+        with self._lock:
+            if self._free > 0 and not self._waiters:
+                self._free -= 1
+                return
+            event = threading.Event()
+            heapq.heappush(self._waiters, (priority, next(self._counter), event))
+        # release時會直接把名額交給被喚醒的等待者
+        event.wait()
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                _, _, event = heapq.heappop(self._waiters)
+                event.set()
+            else:
+                self._free += 1
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    @property
+    def in_use(self):
+        return self.slots - self._free
+
+
+class AsyncPrioritySemaphore:
+    """PrioritySemaphore的asyncio版本，只能在同一個event loop中使用"""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self._free = slots
+        self._waiters = []  # (priority, 序號, Future)
+        self._counter = itertools.count()
+
+    async def acquire(self, priority):
+        if self._free > 0 and not self._waiters:
+            self._free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 名額已交給這個等待者但它被取消，轉交給下一個
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():  # 略過已取消的等待者
+                future.set_result(None)
+                return
+        self._free += 1
+
+    @property
+    def waiting(self):
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    @property
+    def in_use(self):
+        return self.slots - self._free
+
+
+class OllamaScheduler:
+    """位於ChatGPT與OllamaBalancer之間，限制每台主機的同時生成數量、依優先順序排隊並合併相同請求
+
+    先由balancer選定主機，再排隊取得該主機的名額；同一段對話固定在同一台主機上，
+    因此名額必須依主機分開計算，單一忙碌的主機才不會佔用其他主機的名額。
+    """
+
+    _semaphore_class = PrioritySemaphore
+
+    def __init__(self, client, max_concurrent=OLLAMA_MAX_CONCURRENT, coalesce=OLLAMA_COALESCE):
+        self.client = client
+        self.coalesce = coalesce
+        self.max_concurrent = max_concurrent
+        self._semaphores = {}  # 主機 -> 該主機的semaphore
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.coalesced = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        logger.info(f"🚦 Ollama排程器: 每台主機同時最多 {max_concurrent} 個生成, 合併相同請求: {coalesce}")
+
+    def _semaphore_for(self, backend):
+        with self._lock:
+            semaphore = self._semaphores.get(backend.host)
+            if semaphore is None:
+                semaphore = self._semaphores[backend.host] = self._semaphore_class(self.max_concurrent)
+            return semaphore
+
+    def _acquire(self, semaphore, priority):
+        start = time.monotonic()
+        semaphore.acquire(priority)
+        return self._record_wait(priority, time.monotonic() - start)
+
+    def _record_wait(self, priority, waited):
+        with self._lock:
+            self.requests += 1
+            self.queue_wait_total += waited
+            self.queue_wait_max = max(self.queue_wait_max, waited)
+        OLLAMA_QUEUE_WAIT_SECONDS.observe(waited, priority=priority)
+        if waited > 0.1:
+            logger.info(f"⏳ Ollama排隊等待 {waited:.2f} 秒 (priority={priority})")
+        return waited
+
+    def chat(self, priority=PRIORITY_NEW, **kwargs):
+        """與ollama.Client.chat相同的參數；stream=True時回傳會在結束時釋放名額的generator"""
+        if kwargs.get("stream"):
+            # 串流回應無法共用，不做合併
+            return self._chat_stream(priority, kwargs)
+
+        if not self.coalesce:
+            return self._chat(priority, kwargs)
+
+        # 完全相同的請求正在生成時，直接等待同一個結果
+        key = self._request_key(kwargs)
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            logger.info("♻️ 合併相同的Ollama請求")
+            return flight.result()
+
+        try:
+            response = self._chat(priority, kwargs)
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.set_exception(e)
+            raise
+        with self._lock:
+            self._inflight.pop(key, None)
+        flight.set_result(response)
+        return response
+
+    def _chat(self, priority, kwargs):
+        backend = self.client.pick(kwargs.get("route_key"))
+        semaphore = self._semaphore_for(backend)
+        self._acquire(semaphore, priority)
+        try:
+            return self.client.chat(backend=backend, **kwargs)
+        finally:
+            semaphore.release()
+
+    def _chat_stream(self, priority, kwargs):
+        # 開始讀取時才排隊取得名額，讀完或close()時釋放
+        backend = self.client.pick(kwargs.get("route_key"))
+        semaphore = self._semaphore_for(backend)
+        self._acquire(semaphore, priority)
+        try:
+            stream = self.client.chat(backend=backend, **kwargs)
+            try:
+                yield from stream
+            finally:
+                close = getattr(stream, "close", None)
+                if close:
+                    close()
+        finally:
+            semaphore.release()
+
+    @staticmethod
+    def _request_key(kwargs):
+        # route_key只用來選擇主機，不同對話的相同請求仍可合併
+        request = {k: v for k, v in kwargs.items() if k != "route_key"}
+        payload = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def stats(self):
+        with self._lock:
+            semaphores = list(self._semaphores.values())
+            return {
+                "max_concurrent_per_host": self.max_concurrent,
+                "in_flight": sum(semaphore.in_use for semaphore in semaphores),
+                "waiting": sum(semaphore.waiting for semaphore in semaphores),
+                "requests": self.requests,
+                "coalesced": self.coalesced,
+                "queue_wait_avg": round(self.queue_wait_total / self.requests, 3) if self.requests else 0.0,
+                "queue_wait_max": round(self.queue_wait_max, 3)
+            }
+
+
+class AsyncOllamaScheduler(OllamaScheduler):
+    """OllamaScheduler的asyncio版本，呼叫client.achat，排隊與合併都在event loop中進行"""
+
+    _semaphore_class = AsyncPrioritySemaphore
+
+    async def _acquire(self, semaphore, priority):
+        start = time.monotonic()
+        await semaphore.acquire(priority)
+        return self._record_wait(priority, time.monotonic() - start)
+
+    async def chat(self, priority=PRIORITY_NEW, **kwargs):
+        if kwargs.get("stream"):
+            raise ValueError("asyncio模式不支援串流請求")
+
+        if not self.coalesce:
+            return await self._chat(priority, kwargs)
+
+        key = self._request_key(kwargs)
+        flight = self._inflight.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            logger.info("♻️ 合併相同的Ollama請求")
+            # shield：等待者被取消時不影響正在生成的請求
+            return await asyncio.shield(flight)
+
+        flight = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            response = await self._chat(priority, kwargs)
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                flight.cancel()
+            else:
+                flight.set_exception(e)
+                flight.exception()  # 沒有其他等待者時避免 "exception was never retrieved"
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        flight.set_result(response)
+        return response
+
+    async def _chat(self, priority, kwargs):
+        # 選擇主機時可能需要探測斷路中的主機，放到執行緒中以免卡住event loop
+        backend = await asyncio.to_thread(self.client.pick, kwargs.get("route_key"))
+        semaphore = self._semaphore_for(backend)
+        await self._acquire(semaphore, priority)
+        try:
+            return await self.client.achat(backend=backend, **kwargs)
+        finally:
+            semaphore.release()
@@ -0,0 +1,98 @@
+from api.prompt import Prompt
+from api.storage import create_storage
+from collections import OrderedDict
+import os
+import asyncio
+import threading
+import time
+import logging
+
+# 設定logging
+logger = logging.getLogger(__name__)
+
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", default=5000))
+SESSION_TTL = int(os.getenv("SESSION_TTL", default=3600))  # 閒置多久(秒)後清除對話
+
+
+def get_session_id(source):
+    """依LINE事件來源決定對話ID，群組與聊天室共用同一段對話"""
+    source_type = getattr(source, "type", "user")
+    if source_type == "group":
+        return f"group:{source.group_id}"
+    if source_type == "room":
+        return f"room:{source.room_id}"
+    return f"user:{source.user_id}"
+
+
+class Session:
+    """單一用戶(或群組)的對話狀態"""
+
+    def __init__(self, session_id, storage=None):
+        self.session_id = session_id
+        self.prompt = Prompt(session_id, storage)
+        # 同一段對話同時間只允許一個請求修改，避免訊息交錯
+        self.lock = threading.Lock()
+        # asyncio模式(api/aio_server.py)使用的鎖，等待者依先來後到取得
+        self.async_lock = asyncio.Lock()
+        self.last_access = time.monotonic()
+
+    def touch(self):
+        self.last_access = time.monotonic()
+
+
+class SessionManager:
+    """以LRU + 閒置TTL管理所有對話，限制記憶體用量"""
+
+    def __init__(self, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL, storage=None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        # 被清除的對話若有持久化，下次使用時會從storage重新載入
+        self.storage = storage if storage is not None else create_storage()
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        logger.info(f"🗂️ 對話管理器初始化: 上限 {max_sessions} 個對話, TTL {ttl} 秒")
+
+    def get(self, session_id):
+        """取得(或建立)對話，並更新其LRU位置"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = Session(session_id, self.storage)
+                self._sessions[session_id] = session
+                logger.info(f"🆕 建立新對話: {session_id}")
+            else:
+                self._sessions.move_to_end(session_id)
+            session.touch()
+            self._evict()
+            return session
+
+    def remove(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def _evict(self):
+        """移除閒置過久與超過上限的對話（呼叫前需持有鎖）"""
+        # OrderedDict依存取順序排列，最舊的在最前面
+        now = time.monotonic()
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.last_access <= self.ttl:
+                break
+            del self._sessions[session_id]
+            logger.info(f"⌛ 對話閒置過久已清除: {session_id}")
+
+        while len(self._sessions) > self.max_sessions:
+            session_id, _ = self._sessions.popitem(last=False)
+            logger.info(f"🗑️ 對話數量達上限，已清除最久未使用的對話: {session_id}")
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active_sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "session_ttl": self.ttl,
+                "storage": type(self.storage).__name__ if self.storage is not None else None
+            }
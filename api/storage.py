@@ -0,0 +1,224 @@
+from collections import deque
+import os
+import re
+import json
+import fcntl
+import sqlite3
+import threading
+import logging
+
+# 設定logging
+logger = logging.getLogger(__name__)
+
+SESSION_STORAGE = os.getenv("SESSION_STORAGE", default="").lower()  # memory / sqlite / file，空字串表示不保存
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", default="sessions.db")
+SESSION_DIR = os.getenv("SESSION_DIR", default="sessions")
+MEMORY_STORAGE_LIMIT = int(os.getenv("MEMORY_STORAGE_LIMIT", default=200))  # 記憶體儲存每段對話最多保留幾則
+
+
+class SessionStorage:
+    """對話紀錄儲存介面
+
+    每段對話的訊息以連續的序號(seq)保存，序號從1開始。
+    Prompt依序號判斷記憶體中的紀錄是否落後(例如其他worker已寫入新訊息)。
+    extra是role與content以外的欄位(例如原生function calling的tool_calls、tool_name)，沒有時為None。
+    """
+
+    def append(self, session_id, role, content, extra=None):
+        """附加一則訊息，回傳其序號"""
+        raise NotImplementedError
+
+    def load(self, session_id, limit):
+        """讀取最後limit則訊息，回傳[(seq, role, content, extra), ...]，依序號遞增排列"""
+        raise NotImplementedError
+
+    def last_seq(self, session_id):
+        """目前最後一則訊息的序號，沒有訊息時為0"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryStorage(SessionStorage):
+    """存放在程序記憶體中，對話被LRU清除後仍可找回（不跨程序）"""
+
+    def __init__(self, limit=MEMORY_STORAGE_LIMIT):
+        self.limit = limit
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def append(self, session_id, role, content, extra=None):
+        with self._lock:
+            rows = self._data.get(session_id)
+            if rows is None:
+                rows = self._data[session_id] = deque(maxlen=self.limit)
+            seq = rows[-1][0] + 1 if rows else 1
+            rows.append((seq, role, content, extra))
+            return seq
+
+    def load(self, session_id, limit):
+        with self._lock:
+            rows = self._data.get(session_id, ())
+            return list(rows)[-limit:] if limit > 0 else []
+
+    def last_seq(self, session_id):
+        with self._lock:
+            rows = self._data.get(session_id)
+            return rows[-1][0] if rows else 0
+
+
+class SQLiteStorage(SessionStorage):
+    """SQLite(WAL模式)儲存，同一台主機上的多個worker可共用"""
+
+    def __init__(self, path=SESSION_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " session_id TEXT NOT NULL,"
+            " seq INTEGER NOT NULL,"
+            " role TEXT NOT NULL,"
+            " content TEXT NOT NULL,"
+            " extra TEXT,"
+            " created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+            " PRIMARY KEY (session_id, seq))"
+        )
+        # 舊版建立的資料表沒有extra欄位
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(messages)")]
+        if "extra" not in columns:
+            conn.execute("ALTER TABLE messages ADD COLUMN extra TEXT")
+        conn.commit()
+        logger.info(f"🗄️ SQLite對話儲存已就緒: {path}")
+
+    def _conn(self):
+        # sqlite3連線不能跨執行緒共用，每個執行緒各自建立
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def append(self, session_id, role, content, extra=None):
+        conn = self._conn()
+        extra = json.dumps(extra, ensure_ascii=False) if extra else None
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO messages (session_id, seq, role, content, extra) "
+                "SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ? FROM messages WHERE session_id = ?",
+                (session_id, role, content, extra, session_id)
+            )
+            # 不使用INSERT ... RETURNING(需要SQLite 3.35以上)，在同一個交易中以rowid查回序號
+            return conn.execute("SELECT seq FROM messages WHERE rowid = ?", (cursor.lastrowid,)).fetchone()[0]
+
+    def load(self, session_id, limit):
+        if limit <= 0:
+            return []
+        rows = self._conn().execute(
+            "SELECT seq, role, content, extra FROM messages WHERE session_id = ? ORDER BY seq DESC LIMIT ?",
+            (session_id, limit)
+        ).fetchall()
+        rows.reverse()
+        return [(seq, role, content, json.loads(extra) if extra else None) for seq, role, content, extra in rows]
+
+    def last_seq(self, session_id):
+        row = self._conn().execute(
+            "SELECT MAX(seq) FROM messages WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return row[0] or 0
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class FileStorage(SessionStorage):
+    """每段對話一個只附加(append-only)的JSON Lines檔案"""
+
+    def __init__(self, directory=SESSION_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        logger.info(f"🗄️ 檔案對話儲存已就緒: {directory}")
+
+    def _path(self, session_id):
+        return os.path.join(self.directory, re.sub(r"[^\w.-]", "_", session_id) + ".jsonl")
+
+    @staticmethod
+    def _read_last_line(f):
+        """從檔尾往回找最後一行，不需讀完整個檔案"""
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        if pos == 0:
+            return None
+        buf = b""
+        while pos > 0:
+            step = min(4096, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+            idx = buf.rfind(b"\n", 0, len(buf) - 1)  # 略過結尾的換行
+            if idx != -1:
+                return buf[idx + 1:]
+        return buf
+
+    def append(self, session_id, role, content, extra=None):
+        with open(self._path(session_id), "a+b") as f:
+            # 多個worker可能同時寫入同一個檔案，以檔案鎖確保序號連續
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                last = self._read_last_line(f)
+                seq = json.loads(last)["seq"] + 1 if last else 1
+                record = {"seq": seq, "role": role, "content": content}
+                if extra:
+                    record["extra"] = extra
+                line = json.dumps(record, ensure_ascii=False)
+                f.seek(0, os.SEEK_END)
+                f.write(line.encode("utf-8") + b"\n")
+                f.flush()
+                return seq
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self, session_id, limit):
+        if limit <= 0:
+            return []
+        try:
+            with open(self._path(session_id), "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                try:
+                    lines = deque(f, maxlen=limit)
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        except FileNotFoundError:
+            return []
+        rows = []
+        for line in lines:
+            record = json.loads(line)
+            rows.append((record["seq"], record["role"], record["content"], record.get("extra")))
+        return rows
+
+    def last_seq(self, session_id):
+        try:
+            with open(self._path(session_id), "rb") as f:
+                last = self._read_last_line(f)
+        except FileNotFoundError:
+            return 0
+        return json.loads(last)["seq"] if last else 0
+
+
+def create_storage(kind=SESSION_STORAGE):
+    """依SESSION_STORAGE環境變數建立對話儲存，未設定時回傳None(僅保留在Prompt記憶體中)"""
+    if not kind:
+        return None
+    if kind == "memory":
+        return MemoryStorage()
+    if kind == "sqlite":
+        return SQLiteStorage()
+    if kind == "file":
+        return FileStorage()
+    raise ValueError(f"未知的對話儲存類型: {kind}")
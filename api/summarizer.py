@@ -0,0 +1,118 @@
+from api.prompt import SUMMARY_ENABLED, SUMMARY_MAX_TOKENS, PROMPT_PREFIXES
+from api.scheduler import PRIORITY_BACKGROUND
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import os
+import threading
+import logging
+
+# 設定logging
+logger = logging.getLogger(__name__)
+
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", default=1))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL")  # 未設定時使用對話模型
+
+SUMMARY_INSTRUCTIONS = (
+    "請將以下對話濃縮成一段簡短的繁體中文摘要，供之後的對話參考。"
+    "保留用戶的需求、提到的料號與數量、工具查詢得到的重要結果以及尚未解決的問題，省略寒暄。"
+    "只輸出摘要內容。"
+)
+
+
+class ConversationSummarizer:
+    """在背景把被移除的舊對話摘要成一則系統訊息
+
+    摘要以最低優先順序經過排程器送出，不佔用回覆用戶的生成名額；
+    結果由Prompt.apply_summary在下一次處理該對話時(持有對話鎖)套用。
+    asyncio模式以schedule_async經過async_scheduler送出，與回覆共用同一組名額。
+    """
+
+    def __init__(self, scheduler, model, enabled=SUMMARY_ENABLED, max_workers=SUMMARY_WORKERS, async_scheduler=None):
+        self.scheduler = scheduler
+        self.async_scheduler = async_scheduler
+        self.model = SUMMARY_MODEL or model
+        self.enabled = enabled
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summary")
+        self._lock = threading.Lock()
+        self.scheduled = 0
+        self.failed = 0
+        logger.info(f"🧾 對話摘要: {'啟用' if enabled else '停用'}")
+
+    def _pending(self, prompt):
+        """待摘要的舊訊息；不需要摘要或已有進行中的摘要時回傳None"""
+        if not self.enabled or not prompt.evicted or prompt.summary_job is not None:
+            return None
+        return [record for record, _ in prompt.evicted]
+
+    def _scheduled(self, prompt, job, records):
+        prompt.summary_job = (job, len(records))
+        with self._lock:
+            self.scheduled += 1
+        logger.info(f"🧾 送出背景摘要工作: {len(records)} 則舊訊息")
+
+    def schedule(self, prompt):
+        """有待摘要的舊訊息且沒有進行中的摘要時，送出背景摘要工作（需在該對話的鎖內呼叫）"""
+        records = self._pending(prompt)
+        if records is None:
+            return False
+        future = self._executor.submit(contextvars.copy_context().run, self._summarize, prompt.session_id, prompt.summary, records)
+        self._scheduled(prompt, future, records)
+        return True
+
+    def schedule_async(self, prompt):
+        """schedule的asyncio版本，在event loop中以task執行（需在該對話的async_lock內呼叫）"""
+        records = self._pending(prompt)
+        if records is None:
+            return False
+        task = asyncio.ensure_future(self._summarize_async(prompt.session_id, prompt.summary, records))
+        # apply_summary會讀取結果；對話之後不再使用時也要取出例外，避免 "exception was never retrieved"
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        self._scheduled(prompt, task, records)
+        return True
+
+    def _request(self, session_id, previous, records):
+        """摘要請求的參數"""
+        lines = []
+        if previous:
+            lines.append(f"先前摘要:{previous}")
+        for record in records:
+            if record.get("tool_calls"):
+                names = ", ".join(call["function"]["name"] for call in record["tool_calls"])
+                lines.append(f"AI:(呼叫工具 {names})")
+            if record["content"]:
+                lines.append(f"{PROMPT_PREFIXES.get(record['role'], record['role'])}:{record['content']}")
+        return dict(
+            priority=PRIORITY_BACKGROUND,
+            route_key=session_id,
+            model=self.model,
+            messages=[
+                {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+                {"role": "user", "content": "\n".join(lines)},
+            ],
+            options={"num_predict": SUMMARY_MAX_TOKENS},
+            keep_alive=-1,
+            think=False
+        )
+
+    def _summarize(self, session_id, previous, records):
+        try:
+            response = self.scheduler.chat(**self._request(session_id, previous, records))
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        return response["message"]["content"].strip()
+
+    async def _summarize_async(self, session_id, previous, records):
+        try:
+            response = await self.async_scheduler.chat(**self._request(session_id, previous, records))
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        return response["message"]["content"].strip()
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": self.enabled, "scheduled": self.scheduled, "failed": self.failed}
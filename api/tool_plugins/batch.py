@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor
+from api.tools import execute_tool, execute_tool_async, ARRAY_VALUE_SEPARATOR
+from api.tool_registry import registry
+import os
+import asyncio
+import contextvars
+import logging
+
+# 設定logging
+logger = logging.getLogger(__name__)
+
+# 批次查詢：一次最多幾個料號、同時送出幾個Maximo請求
+TOOL_BATCH_MAX_ITEMS = int(os.getenv("TOOL_BATCH_MAX_ITEMS", default=50))
+TOOL_BATCH_CONCURRENCY = int(os.getenv("TOOL_BATCH_CONCURRENCY", default=4))
+# 批次工具本身在工具執行緒池中執行，展開的單筆查詢使用另一個執行緒池以免互相等待而卡死
+_batch_executor = ThreadPoolExecutor(max_workers=TOOL_BATCH_CONCURRENCY, thread_name_prefix="tool-batch")
+
+
+def _itemnums(spec, parameters):
+    """去除重複與空白，保留原本順序，最多TOOL_BATCH_MAX_ITEMS個"""
+    values = parameters[next(iter(spec["parameters"]["properties"]))]
+    if isinstance(values, str):
+        # 原生tool_calls或JSON標記可能以一個字串傳入多個料號，例如 "ABC123,DEF456"
+        values = ARRAY_VALUE_SEPARATOR.split(values)
+    itemnums = list(dict.fromkeys(str(i).strip() for i in values if str(i).strip()))
+    logger.debug("📦 批次查詢 %s: %s 個料號", spec['of'], len(itemnums))
+    return itemnums[:TOOL_BATCH_MAX_ITEMS], len(itemnums) > TOOL_BATCH_MAX_ITEMS
+
+
+def _batch_result(spec, itemnums, results, truncated):
+    """整理成一張精簡的表格"""
+    rows = []
+    for itemnum, result in zip(itemnums, results):
+        if result.get("success"):
+            rows.append([itemnum, True, result.get("data")])
+        else:
+            rows.append([itemnum, False, result.get("error")])
+
+    batch_result = {
+        "success": True,
+        "type": spec.get("result_type", spec["name"]),
+        "count": len(rows),
+        "columns": ["itemnum", "success", "data"],
+        "data": rows
+    }
+    if truncated:
+        batch_result["note"] = f"料號數量超過上限，只查詢前 {TOOL_BATCH_MAX_ITEMS} 個"
+    return batch_result
+
+
+def lookup(spec, **parameters):
+    """以有限的並行度逐一呼叫宣告中of指定的單筆工具(經過快取)"""
+    tool_name = spec["of"]
+    itemnums, truncated = _itemnums(spec, parameters)
+    param_name = registry.get(tool_name)["parameters"]["required"][0]
+    futures = [
+        _batch_executor.submit(contextvars.copy_context().run, execute_tool, tool_name, {param_name: itemnum})
+        for itemnum in itemnums
+    ]
+    results = [future.result() for future in futures]
+    return _batch_result(spec, itemnums, results, truncated)
+
+
+async def lookup_async(spec, **parameters):
+    """lookup的asyncio版本，以semaphore限制同時送出的查詢數"""
+    tool_name = spec["of"]
+    itemnums, truncated = _itemnums(spec, parameters)
+    param_name = registry.get(tool_name)["parameters"]["required"][0]
+    semaphore = asyncio.Semaphore(TOOL_BATCH_CONCURRENCY)
+
+    async def run(itemnum):
+        async with semaphore:
+            return await execute_tool_async(tool_name, {param_name: itemnum})
+
+    results = await asyncio.gather(*(run(itemnum) for itemnum in itemnums))
+    return _batch_result(spec, itemnums, results, truncated)
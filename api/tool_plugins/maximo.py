@@ -0,0 +1,244 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from api.transport import get_session, get_async_client, pool_config
+from api.metrics import TOOL_RETRIES, TOOL_HEDGES, DEADLINE_EXCEEDED
+from api import deadline
+import contextvars
+import asyncio
+import random
+import httpx
+import requests
+import time
+import os
+import logging
+
+# 設定logging
+logger = logging.getLogger(__name__)
+
+# Maximo的位址；script的URL預設為 <MAXIMO_BASE_URL>/oslc/script，工具宣告可用script_url覆寫
+MAXIMO_BASE_URL = os.getenv("MAXIMO_BASE_URL", default="http://tra.webtw.xyz:8888/maximo").rstrip("/")
+MAXIMO_SCRIPT_URL = os.getenv("MAXIMO_SCRIPT_URL", default=f"{MAXIMO_BASE_URL}/oslc/script").rstrip("/")
+
+# 預設的重試政策，工具宣告中的retries/hedge_after可覆寫
+MAXIMO_RETRIES = int(os.getenv("MAXIMO_RETRIES", default=2))  # 連線失敗、逾時、5xx/429時重試的次數
+MAXIMO_RETRY_BACKOFF = float(os.getenv("MAXIMO_RETRY_BACKOFF", default=0.2))  # 第一次重試前等待的上限(秒)，之後倍增
+MAXIMO_RETRY_BACKOFF_MAX = float(os.getenv("MAXIMO_RETRY_BACKOFF_MAX", default=2.0))
+# 第一個查詢超過這個秒數還沒回應時，再送出一個相同的查詢，取先成功的結果；0為停用
+MAXIMO_HEDGE_AFTER = float(os.getenv("MAXIMO_HEDGE_AFTER", default=3.0))
+
+# 需要送出備援查詢時，兩個查詢都在這裡執行，呼叫端的執行緒才能在等待逾時後送出第二個
+_hedge_executor = ThreadPoolExecutor(max_workers=pool_config("maximo")["pool_size"], thread_name_prefix="maximo-hedge")
+_maxauth_warned = False
+
+
+class _DeadlineExceeded(Exception):
+    pass
+
+
+def _request_options(spec):
+    """script的URL與必要的headers"""
+    url = f"{spec.get('script_url', MAXIMO_SCRIPT_URL).rstrip('/')}/{spec['script']}"
+
+    # 設定必要的headers
+    headers = {
+        "Content-Type": "application/json"
+    }
+
+    # 從環境變數取得maxauth
+    global _maxauth_warned
+    maxauth = os.getenv("MAXAUTH")
+    if maxauth:
+        headers["maxauth"] = maxauth
+    elif not _maxauth_warned:
+        # 每次查詢都會經過這裡，只提醒一次
+        _maxauth_warned = True
+        logger.warning("⚠️ 未設定MAXAUTH環境變數")
+
+    return url, headers
+
+
+def _policy(spec):
+    """(重試次數, 送出備援查詢前等待的秒數)"""
+    return spec.get("retries", MAXIMO_RETRIES), spec.get("hedge_after", MAXIMO_HEDGE_AFTER)
+
+
+def _timeout(spec):
+    """(連線timeout, 讀取timeout)；讀取timeout預設為宣告中的timeout，並且不超過這則回覆剩餘的工具時間"""
+    config = pool_config("maximo")
+    connect, read = config["connect_timeout"], spec.get("timeout") or config["read_timeout"]
+    budget = deadline.tool_budget()
+    if budget is None:
+        return connect, read
+    if budget <= 0:
+        raise _DeadlineExceeded()
+    return min(connect, budget), min(read, budget)
+
+
+def _backoff(attempt):
+    """full jitter：在0到(倍增後的上限)之間隨機等待，避免大量重試同時打到Maximo"""
+    return random.uniform(0, min(MAXIMO_RETRY_BACKOFF * 2 ** (attempt - 1), MAXIMO_RETRY_BACKOFF_MAX))
+
+
+def _retry_reason(status_code):
+    """值得重試的失敗原因，不重試時回傳None(例如404查無料號或認證失敗)"""
+    if status_code is None:
+        return "connection"
+    if status_code == 429 or status_code >= 500:
+        return str(status_code)
+    return None
+
+
+def _success(spec, parameters, data):
+    logger.debug("✅ %s查詢成功: %s", spec.get('label', spec['name']), parameters)
+    return dict(parameters, success=True, type=spec.get("result_type", spec["name"]), data=data)
+
+
+def _failure(spec, parameters, error, status_code):
+    logger.error(f"❌ {spec.get('label', spec['name'])}查詢失敗: {error}")
+    return dict(
+        parameters,
+        success=False,
+        type=spec.get("result_type", spec["name"]),
+        error=str(error) or type(error).__name__,
+        not_found=status_code == 404
+    )
+
+
+def _deadline_failure(spec, parameters):
+    DEADLINE_EXCEEDED.inc(stage="tool_request")
+    logger.warning(f"⏰ {spec.get('label', spec['name'])}查詢超過回覆時限，未取得結果: {parameters}")
+    return dict(
+        parameters,
+        success=False,
+        type=spec.get("result_type", spec["name"]),
+        error="查詢時間超過回覆時限，未取得結果",
+        timed_out=True
+    )
+
+
+def _give_up(spec, parameters, error, status_code):
+    # 讀取timeout已被回覆時限縮短時，逾時視為超過時限而不是Maximo故障
+    if status_code is None and deadline.tool_budget() == 0:
+        return _deadline_failure(spec, parameters)
+    return _failure(spec, parameters, error, status_code)
+
+
+def _retry_wait(spec, attempt, reason, retries):
+    """回傳重試前要等待的秒數；不值得重試、已達重試次數或剩餘時間不足時回傳None"""
+    if reason is None or attempt > retries:
+        return None
+    delay = _backoff(attempt)
+    budget = deadline.tool_budget()
+    if budget is not None and budget <= delay:
+        return None
+    TOOL_RETRIES.inc(tool=spec["name"], reason=reason)
+    logger.warning(f"🔁 {spec.get('label', spec['name'])}查詢失敗({reason})，{delay:.2f} 秒後第 {attempt} 次重試")
+    return delay
+
+
+def _hedged(spec, fetch, hedge_after):
+    """執行fetch；超過hedge_after秒沒有結果時再送出一次，回傳先成功的結果，都失敗時拋出最後的錯誤"""
+    if not hedge_after or hedge_after <= 0:
+        return fetch()
+    first = _hedge_executor.submit(contextvars.copy_context().run, fetch)
+    done, _ = wait([first], timeout=hedge_after)
+    if done:
+        return first.result()
+
+    TOOL_HEDGES.inc(tool=spec["name"])
+    logger.info(f"🐢 {spec.get('label', spec['name'])}查詢超過 {hedge_after} 秒未回應，送出備援查詢")
+    pending = {first, _hedge_executor.submit(contextvars.copy_context().run, fetch)}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def run_script(spec, **parameters):
+    """呼叫宣告中的Maximo OSLC script，參數以query string傳入
+
+    失敗時依宣告的政策重試(抖動的指數退避)，回應過慢時送出備援查詢；
+    所有等待都不超過這則回覆剩餘的工具時間。
+    """
+    url, headers = _request_options(spec)
+    retries, hedge_after = _policy(spec)
+    logger.debug("🔍 查詢%s資訊: %s %s", spec.get('label', spec['name']), url, parameters)
+    attempt = 0
+    while True:
+        try:
+            timeout = _timeout(spec)
+
+            def fetch():
+                # 共用連線池
+                response = get_session("maximo").get(url, params=parameters, headers=headers, timeout=timeout)
+                response.raise_for_status()
+                return response
+
+            return _success(spec, parameters, _hedged(spec, fetch, hedge_after).json())
+        except _DeadlineExceeded:
+            return _deadline_failure(spec, parameters)
+        except requests.RequestException as e:
+            status_code = getattr(e.response, "status_code", None)
+            attempt += 1
+            delay = _retry_wait(spec, attempt, _retry_reason(status_code), retries)
+            if delay is None:
+                return _give_up(spec, parameters, e, status_code)
+            time.sleep(delay)
+
+
+async def _hedged_async(spec, fetch, hedge_after):
+    """_hedged的asyncio版本，取得結果後取消另一個查詢"""
+    if not hedge_after or hedge_after <= 0:
+        return await fetch()
+    first = asyncio.ensure_future(fetch())
+    done, _ = await asyncio.wait({first}, timeout=hedge_after)
+    if done:
+        return first.result()
+
+    TOOL_HEDGES.inc(tool=spec["name"])
+    logger.info(f"🐢 {spec.get('label', spec['name'])}查詢超過 {hedge_after} 秒未回應，送出備援查詢")
+    pending = {first, asyncio.ensure_future(fetch())}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def run_script_async(spec, **parameters):
+    """run_script的asyncio版本，使用共用的httpx.AsyncClient"""
+    url, headers = _request_options(spec)
+    retries, hedge_after = _policy(spec)
+    logger.debug("🔍 查詢%s資訊: %s %s", spec.get('label', spec['name']), url, parameters)
+    attempt = 0
+    while True:
+        try:
+            connect, read = _timeout(spec)
+
+            async def fetch():
+                response = await get_async_client("maximo").get(
+                    url, params=parameters, headers=headers, timeout=httpx.Timeout(read, connect=connect)
+                )
+                response.raise_for_status()
+                return response
+
+            return _success(spec, parameters, (await _hedged_async(spec, fetch, hedge_after)).json())
+        except _DeadlineExceeded:
+            return _deadline_failure(spec, parameters)
+        except httpx.HTTPError as e:
+            status_code = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+            attempt += 1
+            delay = _retry_wait(spec, attempt, _retry_reason(status_code), retries)
+            if delay is None:
+                return _give_up(spec, parameters, e, status_code)
+            await asyncio.sleep(delay)
@@ -0,0 +1,204 @@
+from api.projector import get_field_list
+import os
+import json
+import asyncio
+import importlib
+import threading
+import logging
+
+# 設定logging
+logger = logging.getLogger(__name__)
+
+# 逗號分隔的工具名稱，只有這些工具會提供給模型並寫入工具說明；未設定時使用全部工具
+ENABLED_TOOLS = os.getenv("ENABLED_TOOLS", default="")
+# 額外的工具宣告(JSON列表)，同名時覆蓋內建宣告
+TOOL_REGISTRY_FILE = os.getenv("TOOL_REGISTRY_FILE", default="")
+
+# 有設定script的宣告預設使用Maximo OSLC script工具
+MAXIMO_SCRIPT_HANDLER = "api.tool_plugins.maximo:run_script"
+BATCH_HANDLER = "api.tool_plugins.batch:lookup"
+
+
+# 內建工具宣告
+# parameters: 參數名稱 -> JSON schema(全部為必要參數)，第一個參數對應工具標記中的文字參數
+# fields: 結果投影保留的欄位；cache_ttl: 結果快取秒數(0不快取)；timeout: 單次查詢的讀取逾時秒數
+# Maximo script工具另可設定 retries(重試次數)、hedge_after(送出備援查詢前等待的秒數)、script_url
+BUILTIN_TOOLS = [
+    {
+        "name": "get_inventory_info",
+        "description": "查詢指定料號的庫存量與倉庫櫃位資訊",
+        "label": "庫存",
+        "script": "ZZ_ITEM_GETINVB",
+        "result_type": "inventory",
+        "parameters": {"itemnum": {"type": "string", "description": "要查詢的料號"}},
+        "fields": get_field_list("TOOL_FIELDS_INVENTORY", "location,binnum,curbal"),
+        "cache_ttl": int(os.getenv("TOOL_CACHE_TTL_INVENTORY", default=120)),
+        "answer_cacheable": False,  # 庫存隨時變動，用到的回答不放入回答快取
+        "example": "ABC123"
+    },
+    {
+        "name": "get_item_info",
+        "description": "查詢指定料號的詳細內容與規格資訊",
+        "label": "料號",
+        "script": "ZZ_ITEM_GETITEM",
+        "result_type": "item",
+        "parameters": {"itemnum": {"type": "string", "description": "要查詢的料號"}},
+        "fields": get_field_list("TOOL_FIELDS_ITEM", "itemnum,description,orderunit,issueunit,description_longdescription,itemspec"),
+        "cache_ttl": int(os.getenv("TOOL_CACHE_TTL_ITEM", default=3600)),
+        "example": "DEF456"
+    },
+    # 批次工具的每個料號會經過單筆工具的快取，批次結果本身不再快取
+    {
+        "name": "get_inventory_info_batch",
+        "description": "一次查詢多個料號的庫存量與倉庫櫃位資訊",
+        "handler": BATCH_HANDLER,
+        "of": "get_inventory_info",
+        "result_type": "inventory_batch",
+        "parameters": {"itemnums": {"type": "array", "items": {"type": "string"}, "description": "要查詢的料號列表"}},
+        "cache_ttl": 0,
+        "answer_cacheable": False,
+        "example": "ABC123,DEF456,GHI789"
+    },
+    {
+        "name": "get_item_info_batch",
+        "description": "一次查詢多個料號的詳細內容與規格資訊",
+        "handler": BATCH_HANDLER,
+        "of": "get_item_info",
+        "result_type": "item_batch",
+        "parameters": {"itemnums": {"type": "array", "items": {"type": "string"}, "description": "要查詢的料號列表"}},
+        "cache_ttl": 0
+    },
+]
+
+
+def load_declarations(path=TOOL_REGISTRY_FILE):
+    """內建宣告加上TOOL_REGISTRY_FILE中的宣告"""
+    declarations = {spec["name"]: dict(spec) for spec in BUILTIN_TOOLS}
+    if path:
+        with open(path, encoding="utf-8") as f:
+            for spec in json.load(f):
+                declarations[spec["name"]] = spec
+        logger.info(f"📄 已讀取工具宣告檔: {path}")
+    return declarations
+
+
+class ToolRegistry:
+    """以宣告描述的工具，實作模組在第一次呼叫時才載入"""
+
+    def __init__(self, declarations=None, enabled=ENABLED_TOOLS):
+        declarations = declarations if declarations is not None else load_declarations()
+        names = [name.strip() for name in enabled.split(",") if name.strip()]
+        unknown = [name for name in names if name not in declarations]
+        if unknown:
+            logger.warning(f"⚠️ ENABLED_TOOLS中有未宣告的工具: {', '.join(unknown)}")
+        self._specs = {name: self._normalize(spec) for name, spec in declarations.items()}
+        # 未啟用的工具不提供給模型，但仍可被批次工具等其他工具呼叫
+        self.tools = {name: spec for name, spec in self._specs.items() if not names or name in names}
+        self._functions = {}
+        self._async_functions = {}
+        self._lock = threading.Lock()
+        logger.info(f"🧰 已註冊 {len(self.tools)} 個工具: {', '.join(self.tools)}")
+
+    @staticmethod
+    def _normalize(spec):
+        spec = dict(spec)
+        spec.setdefault("handler", MAXIMO_SCRIPT_HANDLER if spec.get("script") else None)
+        parameters = spec.get("parameters", {})
+        if "properties" not in parameters:
+            parameters = {"type": "object", "properties": parameters, "required": list(parameters)}
+        spec["parameters"] = parameters
+        spec.setdefault("fields", [])
+        spec.setdefault("cache_ttl", 0)
+        return spec
+
+    def __contains__(self, name):
+        # 包含未啟用的工具；提供給模型的工具請用tools
+        return name in self._specs
+
+    def get(self, name):
+        return self._specs[name]
+
+    def fields(self, name):
+        """結果投影保留的欄位；批次工具沒有設定時沿用單筆工具的欄位"""
+        spec = self._specs[name]
+        if not spec["fields"] and spec.get("of"):
+            return self._specs[spec["of"]]["fields"]
+        return spec["fields"]
+
+    def resolve(self, name):
+        """取得工具的實作函式，第一次使用時才import所屬模組"""
+        function = self._functions.get(name)
+        if function is not None:
+            return function
+        with self._lock:
+            if name not in self._functions:
+                module_name, _, attr = self.get(name)["handler"].partition(":")
+                self._functions[name] = getattr(importlib.import_module(module_name), attr)
+                logger.info(f"📦 已載入工具實作: {name} ({module_name})")
+            return self._functions[name]
+
+    def resolve_async(self, name):
+        """asyncio模式使用的實作：同一模組中名稱加上_async的coroutine函式，
+        沒有時把同步實作放到執行緒中執行"""
+        function = self._async_functions.get(name)
+        if function is not None:
+            return function
+        module_name, _, attr = self.get(name)["handler"].partition(":")
+        function = getattr(importlib.import_module(module_name), f"{attr}_async", None)
+        if function is None:
+            sync_function = self.resolve(name)
+
+            async def function(spec, **parameters):
+                return await asyncio.to_thread(sync_function, spec, **parameters)
+        self._async_functions[name] = function
+        return function
+
+    def schemas(self):
+        """Ollama原生function calling使用的工具定義(tools=參數)"""
+        return [
+            {
+                "type": "function",
+                "function": {"name": name, "description": spec["description"], "parameters": spec["parameters"]}
+            }
+            for name, spec in self.tools.items()
+        ]
+
+    def describe(self):
+        return "\n".join(f"- {name}: {spec['description']}" for name, spec in self.tools.items())
+
+    def instructions(self):
+        """依已啟用的工具產生文字標記模式的工具說明；沒有工具時回傳空字串"""
+        if not self.tools:
+            return ""
+        listing = "\n".join(
+            f"{i}. {name} - {spec['description']}" for i, (name, spec) in enumerate(self.tools.items(), 1)
+        )
+        examples = "\n".join(
+            f"- {spec['description']}：[TOOL:{name}:{spec['example']}]"
+            for name, spec in self.tools.items() if spec.get("example")
+        )
+        reminders = ["工具呼叫必須使用正確的格式", "參數就是料號，不需要加引號"]
+        if any(spec.get("of") for spec in self.tools.values()):
+            reminders[1] += "；批次工具的多個料號以逗號分隔"
+            reminders.append("查詢三個以上料號時請使用批次工具")
+        reminders += ["可以在同一個回應中呼叫多個工具", "工具執行完成後，你會收到結果，請根據結果回答用戶的問題"]
+        reminders = "\n".join(f"- {reminder}" for reminder in reminders)
+        return f"""
+你現在擁有以下工具可以使用：
+
+{listing}
+
+當用戶詢問關於料號、庫存、物料資訊時，你可以使用這些工具。
+
+使用工具的格式：
+[TOOL:工具名稱:參數]
+
+例如：
+{examples}
+
+重要提醒：
+{reminders}
+"""
+
+
+registry = ToolRegistry()
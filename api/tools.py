@@ -1,146 +1,254 @@
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from api.cache import TTLCache
+from api.projector import project_result
+from api.tool_registry import registry
+from api.metrics import TOOL_CALL_SECONDS, TOOL_CALLS, DEADLINE_EXCEEDED
+from api import deadline
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import asyncio
+import contextvars
 import json
 import logging
 import os
+import re
+import time
 
 logger = logging.getLogger(__name__)
 
-def get_inventory_info(itemnum):
-    """取得庫存量與倉庫櫃位"""
-    try:
-        url = f"http://tra.webtw.xyz:8888/maximo/oslc/script/ZZ_ITEM_GETINVB?itemnum={itemnum}"
-        logger.info(f"🔍 查詢庫存資訊: {url}")
-        
-        # 設定必要的headers
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
-        # 從環境變數取得maxauth
-        maxauth = os.getenv("MAXAUTH")
-        if maxauth:
-            headers["maxauth"] = maxauth
-            logger.info("🔑 已加入maxauth認證")
-        else:
-            logger.warning("⚠️ 未設定MAXAUTH環境變數")
-        
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        
-        data = response.json()
-        logger.info(f"✅ 庫存查詢成功: {itemnum}")
-        return {
-            "success": True,
-            "itemnum": itemnum,
-            "type": "inventory",
-            "data": data
-        }
-    except requests.RequestException as e:
-        logger.error(f"❌ 庫存查詢失敗: {e}")
-        return {
-            "success": False,
-            "itemnum": itemnum,
-            "type": "inventory",
-            "error": str(e)
-        }
+# 背景執行工具呼叫的執行緒池（串流模式在生成過程中就會送出工具呼叫）
+TOOL_MAX_WORKERS = int(os.getenv("TOOL_MAX_WORKERS", default=8))
+_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+
+# 工具結果快取：料號主檔很少變動，庫存可接受幾分鐘的延遲
+TOOL_CACHE_ENABLED = os.getenv("TOOL_CACHE_ENABLED", "true").lower() == "true"
+TOOL_CACHE_SIZE = int(os.getenv("TOOL_CACHE_SIZE", default=2000))
+TOOL_NEGATIVE_CACHE_TTL = int(os.getenv("TOOL_NEGATIVE_CACHE_TTL", default=300))  # 查無料號的結果保存秒數
+_tool_cache = TTLCache(TOOL_CACHE_SIZE, name="tool")
+
+# asyncio模式下進行中的工具呼叫(key -> asyncio.Future)，相同查詢只送出一次
+_async_inflight = {}
+
+# 陣列參數以字串傳入時(工具標記或模型給了字串)，多個值之間的分隔符號
+ARRAY_VALUE_SEPARATOR = re.compile(r"[,，、\s]+")
+
+# 已啟用的工具宣告(名稱 -> 宣告)，實作在第一次執行時才由registry載入
+AVAILABLE_TOOLS = registry.tools
+
+def _is_not_found(result):
+    """查無資料：Maximo回傳404或成功但沒有任何資料"""
+    if result.get("not_found"):
+        return True
+    return result.get("success") and not result.get("data")
+
+def _cache_ttl(tool_name, result):
+    """決定工具結果的快取秒數，失敗(例如逾時)的結果不快取"""
+    if _is_not_found(result):
+        return TOOL_NEGATIVE_CACHE_TTL
+    if not result.get("success"):
+        return 0
+    return registry.get(tool_name).get("cache_ttl", 0)
 
-def get_item_info(itemnum):
-    """取得料號內容"""
+def _record_tool_call(tool_name, result, start):
+    TOOL_CALL_SECONDS.observe(time.monotonic() - start, tool=tool_name)
+    TOOL_CALLS.inc(tool=tool_name, result="success" if result.get("success") else "error")
+
+def _run_tool(tool_name, parameters):
+    """實際呼叫工具函式"""
+    start = time.monotonic()
     try:
-        url = f"http://tra.webtw.xyz:8888/maximo/oslc/script/ZZ_ITEM_GETITEM?itemnum={itemnum}"
-        logger.info(f"🔍 查詢料號資訊: {url}")
-        
-        # 設定必要的headers
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
-        # 從環境變數取得maxauth
-        maxauth = os.getenv("MAXAUTH")
-        if maxauth:
-            headers["maxauth"] = maxauth
-            logger.info("🔑 已加入maxauth認證")
-        else:
-            logger.warning("⚠️ 未設定MAXAUTH環境變數")
-        
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        
-        data = response.json()
-        logger.info(f"✅ 料號查詢成功: {itemnum}")
-        return {
-            "success": True,
-            "itemnum": itemnum,
-            "type": "item",
-            "data": data
-        }
-    except requests.RequestException as e:
-        logger.error(f"❌ 料號查詢失敗: {e}")
-        return {
+        result = registry.resolve(tool_name)(registry.get(tool_name), **parameters)
+        logger.debug("✅ 工具執行成功: %s", tool_name)
+    except Exception as e:
+        logger.error(f"❌ 工具執行失敗: {tool_name}, 錯誤: {e}")
+        result = {
             "success": False,
-            "itemnum": itemnum,
-            "type": "item",
             "error": str(e)
         }
+    _record_tool_call(tool_name, result, start)
+    return result
 
-# 工具定義
-AVAILABLE_TOOLS = {
-    "get_inventory_info": {
-        "function": get_inventory_info,
-        "description": "查詢指定料號的庫存量與倉庫櫃位資訊",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "itemnum": {
-                    "type": "string",
-                    "description": "要查詢的料號"
-                }
-            },
-            "required": ["itemnum"]
-        }
-    },
-    "get_item_info": {
-        "function": get_item_info,
-        "description": "查詢指定料號的詳細內容與規格資訊",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "itemnum": {
-                    "type": "string",
-                    "description": "要查詢的料號"
-                }
-            },
-            "required": ["itemnum"]
-        }
-    }
-}
+def _shared_timeout(tool_name, result):
+    """共用查詢的發起者因自己的回覆時限而放棄：結果不代表其他等待者，由等待者依自己的時限重新查詢"""
+    if not result.get("timed_out"):
+        return False
+    logger.debug("🔁 共用的查詢因其他請求的回覆時限而放棄，重新查詢: %s", tool_name)
+    return True
 
 def execute_tool(tool_name, parameters):
-    """執行指定的工具"""
-    logger.info(f"🛠️ 執行工具: {tool_name}, 參數: {parameters}")
+    """執行指定的工具，結果會依工具的cache_ttl快取"""
+    logger.debug("🛠️ 執行工具: %s, 參數: %s", tool_name, parameters)
     
-    if tool_name not in AVAILABLE_TOOLS:
+    if tool_name not in registry:
         logger.error(f"❌ 未知的工具: {tool_name}")
         return {
             "success": False,
             "error": f"未知的工具: {tool_name}"
         }
     
-    tool_func = AVAILABLE_TOOLS[tool_name]["function"]
+    if not TOOL_CACHE_ENABLED or not registry.get(tool_name).get("cache_ttl"):
+        return _run_tool(tool_name, parameters)
+    
+    # 同一個料號同時多個查詢時只會送出一次Maximo請求
+    key = tool_call_key(tool_name, parameters)
+    while True:
+        led = []  # 這次是否由自己實際執行查詢
+        def load():
+            led.append(True)
+            return _run_tool(tool_name, parameters)
+        result = _tool_cache.get_or_load(key, load, lambda result: _cache_ttl(tool_name, result))
+        if led or not _shared_timeout(tool_name, result):
+            return result
+
+async def _run_tool_async(tool_name, parameters):
+    start = time.monotonic()
     try:
-        result = tool_func(**parameters)
-        logger.info(f"✅ 工具執行成功: {tool_name}")
-        return result
+        result = await registry.resolve_async(tool_name)(registry.get(tool_name), **parameters)
+        logger.debug("✅ 工具執行成功: %s", tool_name)
     except Exception as e:
         logger.error(f"❌ 工具執行失敗: {tool_name}, 錯誤: {e}")
-        return {
+        result = {
             "success": False,
             "error": str(e)
         }
+    _record_tool_call(tool_name, result, start)
+    return result
+
+async def execute_tool_async(tool_name, parameters):
+    """execute_tool的asyncio版本，共用同一個結果快取"""
+    logger.debug("🛠️ 執行工具: %s, 參數: %s", tool_name, parameters)
+    
+    if tool_name not in registry:
+        logger.error(f"❌ 未知的工具: {tool_name}")
+        return {
+            "success": False,
+            "error": f"未知的工具: {tool_name}"
+        }
+    
+    if not TOOL_CACHE_ENABLED or not registry.get(tool_name).get("cache_ttl"):
+        return await _run_tool_async(tool_name, parameters)
+    
+    key = tool_call_key(tool_name, parameters)
+    result = _tool_cache.get(key)
+    if result is not None:
+        return result
+    flight = _async_inflight.get(key)
+    if flight is not None:
+        result = await asyncio.shield(flight)
+        if not _shared_timeout(tool_name, result):
+            return result
+        return await execute_tool_async(tool_name, parameters)
+    
+    flight = _async_inflight[key] = asyncio.get_running_loop().create_future()
+    try:
+        result = await _run_tool_async(tool_name, parameters)
+    except asyncio.CancelledError:
+        flight.cancel()
+        raise
+    finally:
+        _async_inflight.pop(key, None)
+    ttl = _cache_ttl(tool_name, result)
+    if ttl > 0:
+        _tool_cache.set(key, result, ttl)
+    flight.set_result(result)
+    return result
+
+def parse_tool_arguments(tool_name, params_str):
+    """將工具標記中的簡單字串參數(或JSON陣列)轉成參數dict
+
+    參數對應到工具的第一個必要參數；陣列型別的參數以逗號或空白分隔多個值。
+    """
+    parameters = registry.get(tool_name)["parameters"]
+    param_name = parameters["required"][0]
+    schema = parameters["properties"][param_name]
+    if isinstance(params_str, list):
+        if schema.get("type") != "array":
+            raise ValueError(f"工具 {tool_name} 的參數 {param_name} 不接受陣列")
+        return {param_name: [str(value) for value in params_str]}
+    if schema.get("type") == "array":
+        return {param_name: [value for value in ARRAY_VALUE_SEPARATOR.split(params_str) if value]}
+    return {param_name: params_str.strip()}
+
+def format_tool_result(tool_name, result):
+    """依工具設定的欄位把結果整理成放入對話的精簡文字"""
+    return project_result(result, registry.fields(tool_name) if tool_name in registry else [])
+
+def get_tool_cache_stats():
+    """工具快取的命中統計"""
+    stats = _tool_cache.stats()
+    stats["enabled"] = TOOL_CACHE_ENABLED
+    return stats
+
+def submit_tool(tool_name, parameters):
+    """在背景執行緒池中執行工具，回傳Future"""
+    return _executor.submit(contextvars.copy_context().run, execute_tool, tool_name, parameters)
+
+def _deadline_result(tool_name, parameters):
+    """超過回覆時限仍未完成的工具呼叫；查詢在背景繼續，完成後仍會寫入快取"""
+    DEADLINE_EXCEEDED.inc(stage="tool_wait")
+    logger.warning(f"⏰ 工具 {tool_name} 超過回覆時限仍未完成，以目前的結果回答")
+    return dict(parameters, success=False, error="查詢時間超過回覆時限，未取得結果", timed_out=True)
+
+def _wait_tool(future, tool_call):
+    """等待工具結果，最多等到這則回覆剩餘的工具時間"""
+    try:
+        return future.result(timeout=deadline.tool_budget())
+    except FutureTimeoutError:
+        return _deadline_result(tool_call["name"], tool_call["parameters"])
+
+def tool_call_key(tool_name, parameters):
+    """相同工具與參數的呼叫視為同一個，用於去除重複"""
+    return (tool_name, json.dumps(parameters, sort_keys=True, ensure_ascii=False))
+
+def execute_tools(tool_calls):
+    """同時執行同一回合的多個工具呼叫，依原本順序回傳結果
+
+    重複的(工具, 參數)只會執行一次；已在串流中送出的呼叫(帶有future)直接等待其結果。
+    """
+    futures = {}
+    for tool_call in tool_calls:
+        key = tool_call_key(tool_call["name"], tool_call["parameters"])
+        if key in futures:
+            continue
+        future = tool_call.get("future")
+        if future is None:
+            future = submit_tool(tool_call["name"], tool_call["parameters"])
+        futures[key] = future
+    
+    if len(futures) < len(tool_calls):
+        logger.info(f"♻️ 合併重複的工具呼叫: {len(tool_calls)} -> {len(futures)}")
+    
+    results = {}
+    for tool_call in tool_calls:
+        key = tool_call_key(tool_call["name"], tool_call["parameters"])
+        if key not in results:
+            results[key] = _wait_tool(futures[key], tool_call)
+    return [results[tool_call_key(tool_call["name"], tool_call["parameters"])] for tool_call in tool_calls]
+
+async def execute_tools_async(tool_calls):
+    """execute_tools的asyncio版本：同一回合的工具呼叫同時在event loop上等待"""
+    tasks = {}
+    for tool_call in tool_calls:
+        key = tool_call_key(tool_call["name"], tool_call["parameters"])
+        if key not in tasks:
+            tasks[key] = asyncio.ensure_future(execute_tool_async(tool_call["name"], tool_call["parameters"]))
+    
+    if len(tasks) < len(tool_calls):
+        logger.info(f"♻️ 合併重複的工具呼叫: {len(tool_calls)} -> {len(tasks)}")
+    
+    # 超過回覆時限的查詢不取消，完成後仍會寫入快取
+    await asyncio.wait(tasks.values(), timeout=deadline.tool_budget())
+    results = {}
+    for tool_call in tool_calls:
+        key = tool_call_key(tool_call["name"], tool_call["parameters"])
+        if key not in results:
+            task = tasks[key]
+            results[key] = task.result() if task.done() else _deadline_result(tool_call["name"], tool_call["parameters"])
+    return [results[tool_call_key(tool_call["name"], tool_call["parameters"])] for tool_call in tool_calls]
+
+def get_tool_schemas():
+    """Ollama原生function calling使用的工具定義(tools=參數)"""
+    return registry.schemas()
 
 def get_tools_description():
     """取得所有可用工具的描述"""
-    tools_desc = []
-    for tool_name, tool_info in AVAILABLE_TOOLS.items():
-        tools_desc.append(f"- {tool_name}: {tool_info['description']}")
-    return "\n".join(tools_desc) 
\ No newline at end of file
+    return registry.describe()
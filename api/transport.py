@@ -0,0 +1,152 @@
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+from api.metrics import LINE_API_SECONDS
+import os
+import threading
+import httpx
+import requests
+import logging
+
+# 設定logging
+logger = logging.getLogger(__name__)
+
+
+def _pool_setting(pool, name, default, cast=float):
+    """讀取連線池設定，可用 HTTP_<NAME>_<POOL> 針對單一服務覆寫，例如 HTTP_READ_TIMEOUT_MAXIMO"""
+    value = os.getenv(f"HTTP_{name}_{pool.upper()}", os.getenv(f"HTTP_{name}", default))
+    return cast(value)
+
+
+# 各外部服務的預設值：(連線池大小, 連線timeout, 讀取timeout, 重試次數)
+# Maximo的重試由api.tool_plugins.maximo依工具宣告與回覆時限進行，連線池本身不重試
+POOL_DEFAULTS = {
+    "maximo": (20, 3, 10, 0),
+    "ollama": (10, 3, 300, 1),
+    "line": (10, 3, 10, 2),
+}
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """呼叫端沒有指定timeout時，套用連線池的預設timeout"""
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def pool_config(pool):
+    pool_size, connect_timeout, read_timeout, retries = POOL_DEFAULTS.get(pool, (10, 3, 30, 1))
+    return {
+        "pool_size": _pool_setting(pool, "POOL_SIZE", pool_size, int),
+        "connect_timeout": _pool_setting(pool, "CONNECT_TIMEOUT", connect_timeout),
+        "read_timeout": _pool_setting(pool, "READ_TIMEOUT", read_timeout),
+        "retries": _pool_setting(pool, "RETRIES", retries, int),
+    }
+
+
+def get_session(pool):
+    """取得指定服務共用的requests.Session，重複使用keep-alive連線"""
+    session = _sessions.get(pool)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(pool)
+        if session is None:
+            config = pool_config(pool)
+            # 只重試連線失敗與閘道錯誤；POST(例如LINE reply)不會在讀取失敗後重送
+            retry = Retry(
+                total=config["retries"],
+                connect=config["retries"],
+                read=config["retries"],
+                status=config["retries"],
+                backoff_factor=0.2,
+                status_forcelist=(502, 503, 504),
+                raise_on_status=False,
+            )
+            adapter = TimeoutHTTPAdapter(
+                timeout=(config["connect_timeout"], config["read_timeout"]),
+                pool_connections=config["pool_size"],
+                pool_maxsize=config["pool_size"],
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[pool] = session
+            logger.info(f"🔌 建立 {pool} 連線池: {config}")
+    return session
+
+
+def _httpx_options(pool, asynchronous=False):
+    config = pool_config(pool)
+    limits = httpx.Limits(
+        max_connections=config["pool_size"],
+        max_keepalive_connections=config["pool_size"],
+    )
+    transport_class = httpx.AsyncHTTPTransport if asynchronous else httpx.HTTPTransport
+    return {
+        "timeout": httpx.Timeout(config["read_timeout"], connect=config["connect_timeout"]),
+        # httpx只會重試連線失敗
+        "transport": transport_class(limits=limits, retries=config["retries"]),
+    }
+
+
+def ollama_client_options(asynchronous=False):
+    """ollama.Client / ollama.AsyncClient(httpx)的連線池與timeout設定"""
+    return _httpx_options("ollama", asynchronous)
+
+
+_async_clients = {}
+
+
+def get_async_client(pool):
+    """asyncio模式下指定服務共用的httpx.AsyncClient，只能在同一個event loop中使用"""
+    client = _async_clients.get(pool)
+    if client is None:
+        client = _async_clients[pool] = httpx.AsyncClient(**_httpx_options(pool, asynchronous=True))
+        logger.info(f"🔌 建立 {pool} 非同步連線池: {pool_config(pool)}")
+    return client
+
+
+async def close_async_clients():
+    for client in _async_clients.values():
+        await client.aclose()
+    _async_clients.clear()
+
+
+def line_api_name(url):
+    """LINE API的名稱(reply、push等)，作為指標的label；含ID的路徑歸為other"""
+    name = url.rstrip("/").rsplit("/", 1)[-1]
+    return name if name in ("reply", "push", "multicast", "broadcast", "loading") else "other"
+
+
+class PooledRequestsHttpClient(RequestsHttpClient):
+    """LINE SDK的HttpClient，改用共用連線池而非每次呼叫requests.get/post"""
+
+    def _request(self, method, url, timeout, **kwargs):
+        with LINE_API_SECONDS.time(method=line_api_name(url)):
+            response = get_session("line").request(method, url, timeout=timeout or self.timeout, **kwargs)
+        return RequestsHttpResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request("GET", url, timeout, headers=headers, params=params, stream=stream)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request("POST", url, timeout, headers=headers, data=data)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request("DELETE", url, timeout, headers=headers, data=data)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request("PUT", url, timeout, headers=headers, data=data)
@@ -0,0 +1,119 @@
+from collections import deque
+import contextvars
+import os
+import queue
+import threading
+import time
+import atexit
+import functools
+import logging
+
+# 設定logging
+logger = logging.getLogger(__name__)
+
+MESSAGE_WORKERS = int(os.getenv("MESSAGE_WORKERS", default=4))
+MESSAGE_QUEUE_SIZE = int(os.getenv("MESSAGE_QUEUE_SIZE", default=100))  # 排隊中的訊息上限，超過時回覆忙碌
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", default=30))
+
+
+class MessageQueue:
+    """固定數量worker的訊息佇列
+
+    同一段對話的訊息依序(FIFO)處理，同時間只會有一個worker處理同一段對話；
+    不同對話之間輪流執行，避免單一用戶連續發訊息時佔住所有worker。
+    """
+
+    def __init__(self, num_workers=MESSAGE_WORKERS, max_depth=MESSAGE_QUEUE_SIZE):
+        self.num_workers = num_workers
+        self.max_depth = max_depth
+        self._ready = queue.Queue()  # 有待處理訊息且沒有worker在處理的對話ID
+        self._pending = {}  # 對話ID -> 待處理的工作deque
+        self._depth = 0  # 所有排隊中與處理中的工作數
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._accepting = True
+        self.rejected = 0
+        self.completed = 0
+        self._workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._run, name=f"message-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        logger.info(f"🧵 訊息佇列啟動: {num_workers} 個worker, 佇列上限 {max_depth}")
+
+    def submit(self, session_id, job):
+        """加入一個工作，佇列已滿或正在關閉時回傳False"""
+        with self._lock:
+            if not self._accepting or self._depth >= self.max_depth:
+                self.rejected += 1
+                logger.warning(f"⚠️ 訊息佇列已滿({self._depth}/{self.max_depth})，拒絕新訊息")
+                return False
+            self._depth += 1
+            # 在worker執行緒中沿用提交時的context(log的correlation ID)
+            job = functools.partial(contextvars.copy_context().run, job)
+            pending = self._pending.get(session_id)
+            if pending is None:
+                # 這段對話目前沒有在排隊或處理中，交給下一個空閒的worker
+                self._pending[session_id] = deque([job])
+                self._ready.put(session_id)
+            else:
+                pending.append(job)
+        return True
+
+    def _run(self):
+        while True:
+            session_id = self._ready.get()
+            if session_id is None:
+                return
+            with self._lock:
+                job = self._pending[session_id].popleft()
+            try:
+                job()
+            except Exception as e:
+                logger.error(f"❌ 背景工作執行失敗 ({session_id}): {e}")
+            with self._lock:
+                self._depth -= 1
+                self.completed += 1
+                if self._pending[session_id]:
+                    # 同一對話還有訊息，排到最後面讓其他對話先處理
+                    self._ready.put(session_id)
+                else:
+                    del self._pending[session_id]
+                if self._depth == 0:
+                    self._idle.notify_all()
+
+    def shutdown(self, timeout=SHUTDOWN_DRAIN_TIMEOUT):
+        """停止接收新訊息，等待已排隊的訊息處理完後結束worker"""
+        with self._lock:
+            if not self._accepting:
+                return
+            self._accepting = False
+            logger.info(f"🛑 訊息佇列關閉中，等待 {self._depth} 個工作完成")
+            deadline = time.monotonic() + timeout
+            while self._depth > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f"⚠️ 等待逾時，仍有 {self._depth} 個工作未完成")
+                    break
+                self._idle.wait(remaining)
+        for _ in self._workers:
+            self._ready.put(None)
+        logger.info("✅ 訊息佇列已關閉")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.num_workers,
+                "depth": self._depth,
+                "max_depth": self.max_depth,
+                "active_sessions": len(self._pending),
+                "completed": self.completed,
+                "rejected": self.rejected
+            }
+
+
+def create_message_queue():
+    """建立訊息佇列，並在程序結束時先處理完已排隊的訊息"""
+    message_queue = MessageQueue()
+    atexit.register(message_queue.shutdown)
+    return message_queue
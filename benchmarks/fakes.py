@@ -0,0 +1,324 @@
+"""壓力測試用的本機替身服務：Ollama、Maximo OSLC script與LINE Messaging API
+
+每個替身都是一個ThreadingHTTPServer，回應前依設定的延遲分布等待，
+讓benchmark不需連到任何實際服務就能重現生成、查詢與回覆各階段的耗時。
+
+延遲分布的格式：
+    fixed:0.2            固定0.2秒
+    uniform:0.1,0.5      0.1到0.5秒均勻分布
+    lognormal:0.8,0.4    中位數0.8秒、sigma 0.4的對數常態分布(長尾)
+    exp:0.3              平均0.3秒的指數分布
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import threading
+import random
+import json
+import math
+import time
+import sys
+import re
+
+# 料號：英文字母開頭、含數字的代碼，例如 ABC123、PN-1002(前後常直接接中文，不能用\b)
+ITEMNUM_PATTERN = re.compile(r"(?<![A-Za-z0-9])[A-Z]{1,4}-?\d{3,8}(?![A-Za-z0-9])")
+
+
+class Latency:
+    """可重現的延遲分布，sample()回傳秒數"""
+
+    def __init__(self, spec="fixed:0", seed=None):
+        self.spec = spec
+        kind, _, args = spec.partition(":")
+        self.kind = kind
+        self.args = [float(arg) for arg in args.split(",") if arg]
+        if kind not in ("fixed", "uniform", "lognormal", "exp"):
+            raise ValueError(f"未知的延遲分布: {spec}")
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self):
+        with self._lock:
+            if self.kind == "fixed":
+                return self.args[0] if self.args else 0.0
+            if self.kind == "uniform":
+                return self._random.uniform(*self.args)
+            if self.kind == "lognormal":
+                median, sigma = self.args
+                return self._random.lognormvariate(math.log(median), sigma)
+            return self._random.expovariate(1 / self.args[0])
+
+    def sleep(self):
+        seconds = self.sample()
+        if seconds > 0:
+            time.sleep(seconds)
+        return seconds
+
+    def __str__(self):
+        return self.spec
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 呼叫端逾時或取消(例如備援查詢取得結果後)時關閉連線，不需輸出traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeServer:
+    """在背景執行緒中執行的HTTP替身，記錄收到的請求數"""
+
+    def __init__(self, handler_class, host="127.0.0.1", port=0):
+        # 每個替身各自一個handler子類別，同一種替身可以同時啟動多個(例如多台Ollama)
+        handler = type(handler_class.__name__, (handler_class,), {"fake": self})
+        self.server = _Server((host, port), handler)
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive，與實際服務一樣重用連線
+    fake = None
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeOllama(FakeServer):
+    """模擬Ollama的/api/chat
+
+    最後一則是用戶訊息且提到料號時回傳工具呼叫(有tools參數時為原生tool_calls，否則為文字標記)，
+    收到工具結果後回傳最終回答。延遲分為prefill與生成兩段，並回報在duration欄位中。
+    """
+
+    def __init__(self, prefill="lognormal:0.3,0.3", generation="lognormal:1.0,0.4", tokens_per_second=30.0, **kwargs):
+        self.prefill = prefill if isinstance(prefill, Latency) else Latency(prefill, seed=1)
+        self.generation = generation if isinstance(generation, Latency) else Latency(generation, seed=2)
+        self.tokens_per_second = tokens_per_second
+        self.tool_calls = 0
+        super().__init__(_OllamaHandler, **kwargs)
+
+    def respond(self, request):
+        """依請求內容決定回應的訊息"""
+        messages = request.get("messages") or []
+        last = messages[-1] if messages else {"role": "user", "content": ""}
+        itemnums = list(dict.fromkeys(ITEMNUM_PATTERN.findall(last.get("content") or "")))
+        if last.get("role") != "user" or not itemnums:
+            return {"role": "assistant", "content": "根據查詢結果，" + "相關資訊如上所述。" * 4}
+
+        with self._lock:
+            self.tool_calls += 1
+        detail = "規格" in last["content"] or "說明" in last["content"]
+        if len(itemnums) > 1:
+            name = "get_item_info_batch" if detail else "get_inventory_info_batch"
+            arguments = {"itemnums": itemnums}
+        else:
+            name = "get_item_info" if detail else "get_inventory_info"
+            arguments = {"itemnum": itemnums[0]}
+        if request.get("tools"):
+            return {"role": "assistant", "content": "", "tool_calls": [{"function": {"name": name, "arguments": arguments}}]}
+        marker = ",".join(itemnums) if len(itemnums) > 1 else itemnums[0]
+        return {"role": "assistant", "content": f"[TOOL:{name}:{marker}]"}
+
+
+class _OllamaHandler(_Handler):
+
+    def do_GET(self):
+        self.fake.count()
+        if self.path == "/api/ps":
+            self._json({"models": []})
+        elif self.path == "/api/tags":
+            self._json({"models": [{"name": "benchmark"}]})
+        else:
+            self._json({"version": "0.0.0"})
+
+    def do_POST(self):
+        self.fake.count()
+        request = self._body()
+        if self.path != "/api/chat":
+            self._json({"done": True})
+            return
+
+        fake = self.fake
+        prompt_chars = sum(len(message.get("content") or "") for message in request.get("messages") or [])
+        prefill = fake.prefill.sleep()
+        message = fake.respond(request)
+        generation = fake.generation.sleep()
+        eval_count = max(int(generation * fake.tokens_per_second), 1)
+        final = {
+            "model": request.get("model", "benchmark"),
+            "created_at": "2024-01-01T00:00:00Z",
+            "done": True,
+            "done_reason": "stop",
+            "prompt_eval_count": max(prompt_chars // 2, 1),
+            "prompt_eval_duration": int(prefill * 1e9),
+            "eval_count": eval_count,
+            "eval_duration": int(generation * 1e9),
+        }
+        if not request.get("stream", True):
+            self._json(dict(final, message=message))
+            return
+
+        # 串流：先逐段送出內容，最後一個chunk帶有duration
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        content = message.get("content") or ""
+        pieces = [content[i:i + 8] for i in range(0, len(content), 8)]
+        chunks = [
+            {"model": final["model"], "created_at": final["created_at"], "done": False,
+             "message": {"role": "assistant", "content": piece}}
+            for piece in pieces
+        ]
+        chunks.append(dict(final, message=dict(message, content="")))
+        for chunk in chunks:
+            data = json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n"
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class FakeMaximo(FakeServer):
+    """模擬Maximo OSLC script：GET /maximo/oslc/script/<script>?itemnum=..."""
+
+    def __init__(self, latency="lognormal:0.15,0.5", not_found_rate=0.05, **kwargs):
+        self.latency = latency if isinstance(latency, Latency) else Latency(latency, seed=3)
+        self.not_found_rate = not_found_rate
+        self._random = random.Random(4)
+        super().__init__(_MaximoHandler, **kwargs)
+
+    @property
+    def script_url(self):
+        return f"{self.url}/maximo/oslc/script"
+
+    def lookup(self, script, itemnum):
+        """回傳(狀態碼, 內容)；同一料號的結果固定，方便快取生效"""
+        with self._lock:
+            missing = self._random.random() < self.not_found_rate
+        if missing:
+            return 404, {"Error": {"message": f"BMXAA4214E - 找不到料號 {itemnum}"}}
+        seed = sum(map(ord, itemnum))
+        if script == "ZZ_ITEM_GETITEM":
+            return 200, {"member": [{
+                "spi:itemnum": itemnum,
+                "spi:description": f"{itemnum} 六角螺栓 M{8 + seed % 8}",
+                "spi:orderunit": "PCS",
+                "spi:issueunit": "PCS",
+                "spi:description_longdescription": "不鏽鋼材質，適用於一般機械固定。" * 3,
+                "spi:itemspec": [{"assetattrid": "LENGTH", "alnvalue": f"{20 + seed % 40}mm"}],
+                "spi:status": "ACTIVE",
+                "spi:rowstamp": str(seed * 7919),
+            }]}
+        return 200, {"member": [
+            {
+                "spi:itemnum": itemnum,
+                "spi:location": f"WH{index + 1:02d}",
+                "spi:binnum": f"{chr(65 + (seed + index) % 6)}-{(seed * (index + 3)) % 40:02d}",
+                "spi:curbal": (seed * (index + 1)) % 500,
+                "spi:siteid": "TRA",
+                "spi:rowstamp": str(seed * (index + 11)),
+            }
+            for index in range(1 + seed % 4)
+        ]}
+
+
+class _MaximoHandler(_Handler):
+
+    def do_GET(self):
+        self.fake.count()
+        url = urlparse(self.path)
+        script = url.path.rstrip("/").rsplit("/", 1)[-1]
+        itemnum = (parse_qs(url.query).get("itemnum") or [""])[0]
+        self.fake.latency.sleep()
+        status, payload = self.fake.lookup(script, itemnum)
+        self._json(payload, status)
+
+
+class FakeLine(FakeServer):
+    """模擬LINE的reply/push API，記錄每個reply token與用戶收到訊息的時間
+
+    wait_reply/wait_push讓壓力測試等待某則訊息的回覆送達。
+    """
+
+    def __init__(self, latency="fixed:0.02", **kwargs):
+        self.latency = latency if isinstance(latency, Latency) else Latency(latency, seed=5)
+        self._replies = {}  # reply token -> [(時間, 文字)]
+        self._pushes = {}  # user ID -> [(時間, 文字)]
+        self._condition = threading.Condition()
+        super().__init__(_LineHandler, **kwargs)
+
+    def record(self, kind, key, texts):
+        target = self._replies if kind == "reply" else self._pushes
+        with self._condition:
+            target.setdefault(key, []).extend((time.monotonic(), text) for text in texts)
+            self._condition.notify_all()
+
+    def _wait(self, target, key, timeout, count=1):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while len(target.get(key, [])) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            return target[key][count - 1]
+
+    def wait_reply(self, reply_token, timeout):
+        """等待reply token收到回覆，回傳(時間, 文字)，逾時回傳None"""
+        return self._wait(self._replies, reply_token, timeout)
+
+    def wait_push(self, user_id, count, timeout):
+        """等待用戶收到第count則push訊息"""
+        return self._wait(self._pushes, user_id, timeout, count)
+
+    def pushes(self, user_id):
+        with self._condition:
+            return len(self._pushes.get(user_id, []))
+
+
+class _LineHandler(_Handler):
+
+    def do_POST(self):
+        self.fake.count()
+        body = self._body()
+        self.fake.latency.sleep()
+        texts = [message.get("text", "") for message in body.get("messages", [])]
+        if self.path.endswith("/message/reply"):
+            self.fake.record("reply", body.get("replyToken"), texts)
+        elif self.path.endswith("/message/push"):
+            self.fake.record("push", body.get("to"), texts)
+        self._json({})
+
+    def do_GET(self):
+        self.fake.count()
+        self._json({"displayName": "benchmark", "userId": self.path.rsplit("/", 1)[-1]})
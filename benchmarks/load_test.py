@@ -0,0 +1,346 @@
+"""離線壓力測試：以本機替身取代LINE、Ollama與Maximo，對/webhook重播對話
+
+啟動Ollama/Maximo/LINE替身(benchmarks/fakes.py)，在子程序中啟動webhook服務
+(Flask或asyncio模式)並指向這些替身，再由多個虛擬用戶依對話腳本送出帶簽章的webhook，
+等待每則訊息的回覆送達LINE替身。結束後報告：
+
+- 吞吐量(每秒完成的回覆數)與成功/忙碌/錯誤/逾時的數量
+- 收到webhook到回覆送達的延遲 p50/p95/p99，以及webhook本身的回應時間
+- 服務程序的執行緒數與記憶體(RSS)峰值
+- 從服務的/metrics讀出各階段的平均時間
+
+    python -m benchmarks.load_test
+    python -m benchmarks.load_test --server aio --users 200 --rounds 3
+    python -m benchmarks.load_test --ollama-generation lognormal:2,0.5 --maximo-latency exp:0.4
+    python -m benchmarks.load_test --trace traces.jsonl --reply-mode async
+
+對話腳本(--trace)為JSONL，每行一段對話(訊息字串的列表)；訊息中的 {item}、{item2}、{item3}
+會替換成料號池(--items)中隨機的料號，料號池越小，工具與回答快取的命中率越高。
+服務本身的其他設定(例如 OLLAMA_MAX_CONCURRENT、MESSAGE_WORKERS)沿用目前的環境變數。
+"""
+from benchmarks.fakes import FakeOllama, FakeMaximo, FakeLine, Latency
+from concurrent.futures import ThreadPoolExecutor
+import urllib.request
+import argparse
+import subprocess
+import threading
+import hashlib
+import base64
+import random
+import socket
+import hmac
+import json
+import math
+import time
+import uuid
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHANNEL_SECRET = "benchmark-secret"
+
+# 預設的對話腳本：庫存/料號查詢、批次查詢、追問與閒聊
+DEFAULT_TRACES = [
+    ["{item} 的庫存還有多少?", "那 {item2} 呢?", "謝謝"],
+    ["請問 {item} 的規格", "{item} 放在哪個櫃位?"],
+    ["幫我查 {item}、{item2}、{item3} 的庫存"],
+    ["你好", "你可以做什麼?"],
+    ["{item} 的規格和說明", "{item} 庫存多少?", "好的"],
+]
+
+# 子程序：啟動指定模式的webhook服務
+FLASK_CHILD = """
+import sys
+import api.index as index
+index.app.run(host="127.0.0.1", port=int(sys.argv[1]), threaded=True)
+"""
+
+BUSY_MARK = "人數眾多"
+ERROR_MARK = "❌"
+THINKING_MARK = "正在思考"
+
+
+def percentile(values, q):
+    """nearest-rank百分位數"""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(max(math.ceil(q / 100 * len(ordered)) - 1, 0), len(ordered) - 1)]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def load_traces(path):
+    if not path:
+        return DEFAULT_TRACES
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class ProcessSampler:
+    """定期讀取/proc/<pid>/status，記錄執行緒數與RSS的峰值(非Linux時不提供)"""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak_threads = None
+        self.peak_rss_mb = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                fields = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError:
+            return
+        threads = int(fields["Threads"])
+        rss_mb = int(fields["VmRSS"].split()[0]) / 1024
+        self.peak_threads = max(self.peak_threads or 0, threads)
+        self.peak_rss_mb = max(self.peak_rss_mb or 0, rss_mb)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+class LoadTest:
+
+    def __init__(self, args):
+        self.args = args
+        self.traces = load_traces(args.trace)
+        self.items = [f"PN-{1000 + i}" for i in range(args.items)]
+        self.think = Latency(args.think, seed=6)
+        self.ollama = FakeOllama(args.ollama_prefill, args.ollama_generation).start()
+        self.maximo = FakeMaximo(args.maximo_latency, not_found_rate=args.not_found_rate).start()
+        self.line = FakeLine(args.line_latency).start()
+        self.port = args.port or free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.process = None
+        self.results = []  # (結果, 回覆延遲, webhook回應時間)
+        self._lock = threading.Lock()
+
+    # 服務程序
+
+    def server_env(self):
+        env = dict(
+            os.environ,
+            PYTHONPATH=ROOT,
+            LINE_CHANNEL_SECRET=CHANNEL_SECRET,
+            LINE_CHANNEL_ACCESS_TOKEN="benchmark",
+            LINE_API_ENDPOINT=self.line.url,
+            OLLAMA_HOST=self.ollama.url,
+            OLLAMA_HOSTS="",
+            MAXIMO_SCRIPT_URL=self.maximo.script_url,
+            MAXAUTH="benchmark",
+            USE_SYNC_MODE="true" if self.args.reply_mode == "sync" else "false",
+            AIO_HOST="127.0.0.1",
+            AIO_PORT=str(self.port),
+        )
+        env.setdefault("LOG_LEVEL", "WARNING")
+        return env
+
+    def start_server(self):
+        if self.args.server == "aio":
+            command = [sys.executable, "-m", "api.aio_server"]
+        else:
+            command = [sys.executable, "-c", FLASK_CHILD, str(self.port)]
+        log = open(self.args.server_log, "w") if self.args.server_log else subprocess.DEVNULL
+        self.process = subprocess.Popen(command, env=self.server_env(), cwd=ROOT, stdout=log, stderr=log)
+
+        deadline = time.monotonic() + self.args.startup_timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"服務啟動失敗(exit {self.process.returncode})，可用 --server-log 查看輸出")
+            try:
+                if self.get_json("/status").get("model_ready"):
+                    return
+            except OSError:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError("等待服務就緒逾時")
+
+    def stop_server(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+    def get_json(self, path):
+        with urllib.request.urlopen(self.base_url + path, timeout=5) as response:
+            return json.loads(response.read())
+
+    def get_text(self, path):
+        with urllib.request.urlopen(self.base_url + path, timeout=5) as response:
+            return response.read().decode("utf-8")
+
+    # 虛擬用戶
+
+    def webhook(self, user_id, text):
+        """送出一則帶簽章的文字訊息事件，回傳(reply token, 送出時間, webhook回應時間)"""
+        reply_token = uuid.uuid4().hex
+        body = json.dumps({
+            "destination": "Ubenchmark",
+            "events": [{
+                "type": "message",
+                "mode": "active",
+                "timestamp": int(time.time() * 1000),
+                "webhookEventId": uuid.uuid4().hex.upper()[:26],
+                "deliveryContext": {"isRedelivery": False},
+                "source": {"type": "user", "userId": user_id},
+                "replyToken": reply_token,
+                "message": {"id": str(random.randrange(10 ** 15)), "type": "text", "text": text},
+            }],
+        }, ensure_ascii=False).encode("utf-8")
+        signature = base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body, hashlib.sha256).digest()).decode()
+        request = urllib.request.Request(
+            self.base_url + "/webhook", data=body, method="POST",
+            headers={"Content-Type": "application/json", "X-Line-Signature": signature},
+        )
+        start = time.monotonic()
+        with urllib.request.urlopen(request, timeout=self.args.timeout) as response:
+            response.read()
+        return reply_token, start, time.monotonic() - start
+
+    def wait_answer(self, user_id, reply_token, pushes_before):
+        """等待最終回覆：同步模式為reply，異步模式先收到"正在思考"的reply，回答以push送達"""
+        reply = self.line.wait_reply(reply_token, self.args.timeout)
+        if reply is None or self.args.reply_mode == "sync" or THINKING_MARK not in reply[1]:
+            return reply
+        return self.line.wait_push(user_id, pushes_before + 1, self.args.timeout)
+
+    def send(self, user_id, text):
+        pushes_before = self.line.pushes(user_id)
+        try:
+            reply_token, start, ack = self.webhook(user_id, text)
+        except OSError:
+            return "error", None, None
+        answer = self.wait_answer(user_id, reply_token, pushes_before)
+        if answer is None:
+            return "timeout", None, ack
+        at, reply_text = answer
+        if BUSY_MARK in reply_text:
+            outcome = "busy"
+        elif reply_text.startswith(ERROR_MARK):
+            outcome = "error"
+        else:
+            outcome = "ok"
+        return outcome, at - start, ack
+
+    def run_user(self, index):
+        rng = random.Random(index)
+        user_id = f"U{index:032x}"
+        for round_ in range(self.args.rounds):
+            trace = self.traces[(index + round_) % len(self.traces)]
+            items = rng.sample(self.items, min(3, len(self.items)))
+            for template in trace:
+                text = template.format(item=items[0], item2=items[1 % len(items)], item3=items[2 % len(items)])
+                result = self.send(user_id, text)
+                with self._lock:
+                    self.results.append(result)
+                self.think.sleep()
+
+    def run(self):
+        self.start_server()
+        sampler = ProcessSampler(self.process.pid)
+        sampler.start()
+        start = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=self.args.users) as pool:
+                for future in [pool.submit(self.run_user, i) for i in range(self.args.users)]:
+                    future.result()
+            elapsed = time.monotonic() - start
+            sampler.stop()
+            metrics = self.get_text("/metrics")
+        finally:
+            self.stop_server()
+        self.report(elapsed, sampler, metrics)
+
+    # 報告
+
+    def report(self, elapsed, sampler, metrics):
+        args = self.args
+        outcomes = {}
+        for outcome, _, _ in self.results:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        latencies = [latency for outcome, latency, _ in self.results if outcome == "ok"]
+        acks = [ack for _, _, ack in self.results if ack is not None]
+
+        print(f"server={args.server} reply_mode={args.reply_mode} users={args.users} rounds={args.rounds} items={args.items}")
+        print(f"ollama prefill={args.ollama_prefill} generation={args.ollama_generation} "
+              f"maximo={args.maximo_latency} line={args.line_latency} think={args.think}")
+        print()
+        print(f"messages     {len(self.results)} in {elapsed:.1f}s  "
+              + "  ".join(f"{key}={outcomes.get(key, 0)}" for key in ("ok", "busy", "error", "timeout")))
+        print(f"throughput   {len(latencies) / elapsed:.2f} replies/s")
+        print(f"{'':<12} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+        for name, values in (("reply", latencies), ("webhook ack", acks)):
+            if values:
+                print(f"{name:<12} " + " ".join(f"{percentile(values, q):>7.3f}s" for q in (50, 95, 99, 100)))
+        if sampler.peak_threads is not None:
+            print(f"server peak  threads={sampler.peak_threads} rss={sampler.peak_rss_mb:.1f}MB")
+        print(f"fake calls   ollama={self.ollama.requests} maximo={self.maximo.requests} line={self.line.requests}")
+
+        stages = stage_means(metrics)
+        if stages:
+            print()
+            print("stage means (from /metrics)")
+            for name, (mean, count) in stages.items():
+                print(f"  {name:<40} {mean:>9.3f}  (n={count})")
+
+
+def stage_means(metrics):
+    """彙總/metrics中每個histogram的_sum/_count(不分label)，回傳 名稱 -> (平均, 次數)"""
+    sums, counts = {}, {}
+    for line in metrics.splitlines():
+        if line.startswith("#") or not line.strip():
+            continue
+        series, value = line.rsplit(" ", 1)
+        name = series.split("{", 1)[0]
+        if name.endswith("_sum"):
+            sums[name[:-4]] = sums.get(name[:-4], 0.0) + float(value)
+        elif name.endswith("_count"):
+            counts[name[:-6]] = counts.get(name[:-6], 0) + int(float(value))
+    return {name: (sums[name] / counts[name], counts[name]) for name in sums if counts.get(name)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", choices=("flask", "aio"), default="flask")
+    parser.add_argument("--reply-mode", choices=("sync", "async"), default="sync",
+                        help="sync: reply_message回覆；async: 先回覆正在思考，再以push_message送出回答")
+    parser.add_argument("--users", type=int, default=20, help="同時進行對話的虛擬用戶數")
+    parser.add_argument("--rounds", type=int, default=2, help="每個用戶重播幾段對話")
+    parser.add_argument("--items", type=int, default=200, help="料號池大小")
+    parser.add_argument("--trace", help="對話腳本JSONL")
+    parser.add_argument("--think", default="fixed:0", help="用戶收到回覆後到下一則訊息的間隔")
+    parser.add_argument("--ollama-prefill", default="lognormal:0.3,0.3")
+    parser.add_argument("--ollama-generation", default="lognormal:1.0,0.4")
+    parser.add_argument("--maximo-latency", default="lognormal:0.15,0.5")
+    parser.add_argument("--not-found-rate", type=float, default=0.05, help="Maximo回傳404的比例")
+    parser.add_argument("--line-latency", default="fixed:0.02")
+    parser.add_argument("--timeout", type=float, default=120.0, help="每則訊息等待回覆的秒數")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--server-log", help="服務程序的輸出寫入這個檔案")
+    args = parser.parse_args()
+    LoadTest(args).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""比較 sliding 與 chunk 兩種訊息移除方式對Ollama prompt快取(KV cache)的影響
+
+離線模式(預設)：模擬一段長對話，計算每回合送出的訊息與上一回合相同的前綴長度，
+估算每回合需要重新prefill的token數。
+
+連線模式(--ollama-host)：實際將每回合的訊息送到Ollama(只生成1個token)，
+統計回應中的 prompt_eval_count 與 prompt_eval_duration。
+
+    python -m benchmarks.prefix_stability --turns 60
+    python -m benchmarks.prefix_stability --turns 30 --ollama-host http://localhost:11434
+"""
+import argparse
+import statistics
+import sys
+import os
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api.prompt as prompt_module
+from api.prompt import Prompt, estimate_tokens
+
+
+def render(messages):
+    """以接近聊天模板的方式把訊息串成文字，用於比較前綴"""
+    return "".join(f"<|{m['role']}|>{m['content']}\n" for m in messages)
+
+
+def common_prefix_length(a, b):
+    limit = min(len(a), len(b))
+    i = 0
+    while i < limit and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def simulate(mode, turns):
+    """模擬一段對話，回傳每回合的(prompt token數, 需重新prefill的token數, 送出的訊息)"""
+    prompt_module.PROMPT_EVICTION = mode
+    prompt = Prompt()
+    previous = ""
+    results = []
+    for turn in range(turns):
+        prompt.add_msg(f"請問料號 PART-{turn:04d} 的庫存還有多少？另外它放在哪個倉庫櫃位？", role="user")
+        messages = list(prompt.get_messages())
+        text = render(messages)
+        shared = common_prefix_length(previous, text)
+        results.append((estimate_tokens(text), estimate_tokens(text[shared:]), messages))
+        previous = text
+        prompt.add_msg(f"料號 PART-{turn:04d} 目前庫存 {turn * 7 % 50} 個，位於 A 倉 {turn % 12} 號櫃。" * 3, role="assistant")
+        previous = render(prompt.get_messages())
+    return results
+
+
+def measure_ollama(host, model, results):
+    """實際送到Ollama，回傳每回合的(prompt_eval_count, prompt_eval_duration秒)"""
+    import ollama
+    client = ollama.Client(host=host)
+    measured = []
+    for _, _, messages in results:
+        response = client.chat(
+            model=model,
+            messages=messages,
+            options={"num_predict": 1, "temperature": 0},
+            keep_alive=-1
+        )
+        measured.append((response.prompt_eval_count or 0, (response.prompt_eval_duration or 0) / 1e9))
+    return measured
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=60)
+    parser.add_argument("--ollama-host", help="指定時實際向Ollama量測prefill時間")
+    parser.add_argument("--model", default=os.getenv("OLLAMA_MODEL", "qwen3:7b-instruct-q4_0"))
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    print(f"{'mode':<8} {'avg prompt':>11} {'avg prefill':>12} {'p95 prefill':>12} {'max prefill':>12} {'cached %':>9}")
+    for mode in ("sliding", "chunk"):
+        results = simulate(mode, args.turns)
+        totals = [r[0] for r in results]
+        prefill = [r[1] for r in results]
+        cached = 1 - sum(prefill) / sum(totals)
+        p95 = sorted(prefill)[int(len(prefill) * 0.95) - 1]
+        print(f"{mode:<8} {statistics.mean(totals):>11.0f} {statistics.mean(prefill):>12.0f} {p95:>12} {max(prefill):>12} {cached:>8.1%}")
+
+        if args.ollama_host:
+            measured = measure_ollama(args.ollama_host, args.model, results)
+            counts = [m[0] for m in measured]
+            durations = [m[1] for m in measured]
+            print(f"         ollama: 平均prefill {statistics.mean(counts):.0f} tokens, "
+                  f"平均 {statistics.mean(durations) * 1000:.0f} ms/回合, "
+                  f"總計 {sum(durations):.1f} 秒")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""量測服務啟動到可以回應請求的時間
+
+啟動一個模擬的Ollama(預載入的生成請求會延遲 --warmup 秒)，在子程序中匯入api.index，
+分別量測：匯入完成、第一個/status回應、模型預載入完成(model_ready)所需的時間。
+
+ChatGPT現在都在chatgpt-init執行緒中建立，並在釋放鎖之後才開始預載入，OLLAMA_PRELOAD=sync
+只讓該執行緒等待預載入完成，匯入時間與第一個請求都與background相同。baseline一列重現原本的行為：
+以OLLAMA_PRELOAD=sync在匯入後等到模型預載入完成並計入匯入時間，等同原本在匯入時建立ChatGPT並同步預載入模型。
+
+    python -m benchmarks.startup_time
+    python -m benchmarks.startup_time --warmup 5 --runs 3
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import argparse
+import statistics
+import subprocess
+import threading
+import json
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子程序：匯入api.index並回報各階段的時間(秒)
+CHILD = """
+import json, time, sys
+start = time.monotonic()
+import api.index as index
+if sys.argv[1] == "baseline":
+    index.get_chatgpt().ready.wait()
+imported = time.monotonic() - start
+client = index.app.test_client()
+client.get("/status")
+first_request = time.monotonic() - start
+while not client.get("/status").json["model_ready"]:
+    time.sleep(0.01)
+ready = time.monotonic() - start
+print(json.dumps({"import": imported, "first_request": first_request, "ready": ready}))
+"""
+
+
+def fake_ollama(warmup):
+    """只實作預載入會用到的API：/api/ps回報沒有已載入的模型，/api/chat延遲warmup秒"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _json(self, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._json({"models": []} if self.path == "/api/ps" else {"version": "0.0.0"})
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path == "/api/chat":
+                time.sleep(warmup)
+                self._json({
+                    "model": "m", "created_at": "2024-01-01T00:00:00Z",
+                    "message": {"role": "assistant", "content": "ready"}, "done": True
+                })
+            else:
+                self._json({"done": True})
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# 列名 -> OLLAMA_PRELOAD
+MODES = {"baseline": "sync", "sync": "sync", "background": "background"}
+
+
+def measure(mode, host):
+    env = dict(
+        os.environ,
+        OLLAMA_PRELOAD=MODES[mode],
+        OLLAMA_HOST=host,
+        OLLAMA_HOSTS="",
+        OLLAMA_HEALTH_INTERVAL="0",
+        LINE_CHANNEL_ACCESS_TOKEN=os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "benchmark"),
+        LINE_CHANNEL_SECRET=os.getenv("LINE_CHANNEL_SECRET", "benchmark"),
+        PYTHONPATH=ROOT,
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD, mode], env=env, cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--warmup", type=float, default=3.0, help="模擬的模型載入時間(秒)")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    server = fake_ollama(args.warmup)
+    host = f"http://127.0.0.1:{server.server_address[1]}"
+    print(f"{'preload':<11} {'import':>8} {'first request':>14} {'model ready':>12}")
+    for mode in MODES:
+        runs = [measure(mode, host) for _ in range(args.runs)]
+        print(
+            f"{mode:<11} "
+            f"{statistics.median(r['import'] for r in runs):>7.2f}s "
+            f"{statistics.median(r['first_request'] for r in runs):>13.2f}s "
+            f"{statistics.median(r['ready'] for r in runs):>11.2f}s"
+        )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+from api import balancer as balancer_module
+from api.balancer import OllamaBalancer
+import pytest
+
+
+@pytest.fixture
+def balancer(monkeypatch):
+    monkeypatch.setattr(balancer_module, "BREAKER_THRESHOLD", 3)
+    monkeypatch.setattr(balancer_module, "BREAKER_COOLDOWN", 30)
+    return OllamaBalancer(["http://a:11434", "http://b:11434"])
+
+
+def expire(backend):
+    """讓斷路立即到期"""
+    backend.open_until = 1e-9
+
+
+def test_breaker_opens_after_threshold(balancer):
+    a, b = balancer.backends
+    balancer.record_failure(a)
+    balancer.record_failure(a)
+    assert a.available
+    balancer.record_failure(a)
+    assert not a.available
+    assert balancer._candidates() == [b]
+    assert balancer.pick("user-1") is b
+    assert balancer.healthy
+
+
+def test_success_resets_failure_count(balancer):
+    a, _ = balancer.backends
+    balancer.record_failure(a)
+    balancer.record_failure(a)
+    balancer.record_success(a, 0.5)
+    balancer.record_failure(a)
+    assert a.available
+    assert a.failures == 1
+
+
+def test_half_open_probe_restores_backend(balancer, monkeypatch):
+    a, b = balancer.backends
+    balancer.record_failure(a, force_open=True)
+    probes = []
+    monkeypatch.setattr(balancer, "probe", lambda backend: probes.append(backend) or True)
+
+    # 冷卻中不探測
+    assert balancer._candidates() == [b]
+    assert probes == []
+
+    expire(a)
+    assert balancer._candidates() == [a, b]
+    assert probes == [a]
+    assert a.available and a.failures == 0
+
+
+def test_failed_probe_keeps_backend_open(balancer, monkeypatch):
+    a, b = balancer.backends
+    balancer.record_failure(a, force_open=True)
+    expire(a)
+    probes = []
+    monkeypatch.setattr(balancer, "probe", lambda backend: probes.append(backend) or False)
+
+    assert balancer._candidates() == [b]
+    # 探測失敗後重新冷卻，下一個請求不會再探測
+    assert balancer._candidates() == [b]
+    assert probes == [a]
+    assert not a.available
+
+
+def test_can_serve_after_cooldown(balancer, monkeypatch):
+    a, b = balancer.backends
+    balancer.record_failure(a, force_open=True)
+    balancer.record_failure(b, force_open=True)
+    assert not balancer.healthy
+    assert not balancer.can_serve()
+
+    # 沒有背景健康檢查時，斷路到期即可接受請求，由pick()探測恢復
+    expire(b)
+    assert balancer.can_serve()
+    monkeypatch.setattr(balancer, "probe", lambda backend: True)
+    assert balancer.pick() is b
+    assert balancer.healthy
+
+
+def test_check_health_updates_breakers(balancer, monkeypatch):
+    a, b = balancer.backends
+    monkeypatch.setattr(balancer, "probe", lambda backend: backend is b)
+    assert balancer.check_health() == 1
+    assert not a.available and b.available
+    assert balancer.healthy
@@ -0,0 +1,88 @@
+from api.cache import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import pytest
+
+
+def test_get_or_load_caches_by_ttl():
+    cache = TTLCache(maxsize=10)
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return len(calls)
+
+    assert cache.get_or_load("a", loader, lambda value: 60) == 1
+    assert cache.get_or_load("a", loader, lambda value: 60) == 1
+    assert len(calls) == 1
+    assert cache.stats()["hits"] == 1
+
+
+def test_get_or_load_does_not_keep_zero_ttl():
+    cache = TTLCache(maxsize=10)
+    values = iter([1, 2])
+    assert cache.get_or_load("a", lambda: next(values), lambda value: 0) == 1
+    assert cache.get_or_load("a", lambda: next(values), lambda value: 0) == 2
+
+
+def test_entries_expire():
+    cache = TTLCache(maxsize=10)
+    cache.set("a", 1, ttl=0.05)
+    assert cache.get("a") == 1
+    time.sleep(0.1)
+    assert cache.get("a") is None
+
+
+def test_lru_limit():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1, 60)
+    cache.set("b", 2, 60)
+    cache.get("a")
+    cache.set("c", 3, 60)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_concurrent_misses_share_one_load():
+    cache = TTLCache(maxsize=10)
+    release = threading.Event()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        release.wait(5)
+        return "value"
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        futures = [pool.submit(cache.get_or_load, "a", loader, lambda value: 60) for _ in range(5)]
+        # 等所有呼叫者都進入等待後才讓載入完成
+        deadline = time.monotonic() + 5
+        while cache.stats()["coalesced"] < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        assert [future.result() for future in futures] == ["value"] * 5
+    assert len(calls) == 1
+    assert cache.stats()["coalesced"] == 4
+
+
+def test_load_error_reaches_waiters_and_is_not_cached():
+    cache = TTLCache(maxsize=10)
+    release = threading.Event()
+
+    def failing():
+        release.wait(5)
+        raise RuntimeError("upstream down")
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(cache.get_or_load, "a", failing, lambda value: 60)
+        while not cache._inflight:
+            time.sleep(0.01)
+        waiter = pool.submit(cache.get_or_load, "a", failing, lambda value: 60)
+        while cache.stats()["coalesced"] < 1:
+            time.sleep(0.01)
+        release.set()
+        for future in (leader, waiter):
+            with pytest.raises(RuntimeError):
+                future.result()
+    assert cache.get_or_load("a", lambda: "recovered", lambda value: 60) == "recovered"
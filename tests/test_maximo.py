@@ -0,0 +1,159 @@
+from api.tool_plugins import maximo
+from api import deadline, tools
+from benchmarks.fakes import FakeMaximo
+import asyncio
+import contextvars
+import threading
+import time
+import requests
+import pytest
+
+SPEC = {"name": "get_item_info", "label": "料號", "script": "ZZ_ITEM_GETITEM", "result_type": "item"}
+
+
+class StubSession:
+    """依序回傳預先設定的結果：狀態碼或要拋出的例外；(秒數, 結果)會先等待"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        with self._lock:
+            outcome = self.outcomes[min(self.calls, len(self.outcomes) - 1)]
+            self.calls += 1
+        if isinstance(outcome, tuple):
+            delay, outcome = outcome
+            time.sleep(delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        response = requests.Response()
+        response.status_code = outcome
+        response.url = url
+        response._content = b'{"member": []}'
+        return response
+
+
+@pytest.fixture
+def session(monkeypatch):
+    monkeypatch.setattr(maximo, "MAXIMO_RETRY_BACKOFF", 0.01)
+
+    def install(*outcomes):
+        stub = StubSession(*outcomes)
+        monkeypatch.setattr(maximo, "get_session", lambda name: stub)
+        return stub
+    return install
+
+
+@pytest.fixture
+def fake_maximo(monkeypatch):
+    fake = FakeMaximo("fixed:1.0", not_found_rate=0).start()
+    monkeypatch.setattr(maximo, "MAXIMO_SCRIPT_URL", fake.script_url)
+    monkeypatch.setattr(maximo, "MAXIMO_HEDGE_AFTER", 0)
+    monkeypatch.setattr(maximo, "MAXIMO_RETRIES", 0)
+    tools._tool_cache.clear()
+    yield fake
+    tools._tool_cache.clear()
+    fake.stop()
+
+
+def run_with_budget(budget, func, *args, **kwargs):
+    """在新的context中設定工具時間剩下budget秒後執行"""
+    def run():
+        deadline.start_deadline(deadline.REPLY_DEADLINE_RESERVE + budget)
+        return func(*args, **kwargs)
+    return contextvars.Context().run(run)
+
+
+@pytest.mark.parametrize("failure", [503, 429, requests.ConnectionError("refused")])
+def test_retries_transient_failures(session, failure):
+    stub = session(failure, failure, 200)
+    result = maximo.run_script(dict(SPEC, retries=2, hedge_after=0), itemnum="A123")
+    assert result["success"]
+    assert stub.calls == 3
+
+
+def test_gives_up_after_retries(session):
+    stub = session(502)
+    result = maximo.run_script(dict(SPEC, retries=2, hedge_after=0), itemnum="A123")
+    assert not result["success"] and not result["not_found"]
+    assert stub.calls == 3
+
+
+def test_does_not_retry_not_found(session):
+    stub = session(404, 200)
+    result = maximo.run_script(dict(SPEC, retries=2, hedge_after=0), itemnum="A123")
+    assert not result["success"] and result["not_found"]
+    assert stub.calls == 1
+
+
+def test_hedge_fires_when_first_request_is_slow(session):
+    stub = session((1.0, 200), 200)
+    start = time.monotonic()
+    result = maximo.run_script(dict(SPEC, retries=0, hedge_after=0.1), itemnum="A123")
+    assert result["success"]
+    assert stub.calls == 2
+    assert time.monotonic() - start < 0.8
+
+
+def test_no_hedge_when_first_request_is_fast(session):
+    stub = session(200)
+    assert maximo.run_script(dict(SPEC, retries=0, hedge_after=0.5), itemnum="A123")["success"]
+    assert stub.calls == 1
+
+
+def test_timed_out_when_budget_runs_out(fake_maximo):
+    spec = dict(SPEC, retries=2, hedge_after=0)
+    start = time.monotonic()
+    result = run_with_budget(0.3, maximo.run_script, spec, itemnum="A123")
+    assert result["timed_out"] and not result["success"]
+    # 讀取timeout被縮短到剩餘的時間，也不會在時限後重試
+    assert time.monotonic() - start < 0.8
+    assert fake_maximo.requests == 1
+
+    result = run_with_budget(0, maximo.run_script, spec, itemnum="A123")
+    assert result["timed_out"]
+    assert fake_maximo.requests == 1
+
+
+def test_waiter_reruns_after_leader_timed_out(fake_maximo):
+    results = {}
+
+    def leader():
+        results["leader"] = run_with_budget(0.3, tools.execute_tool, "get_item_info", {"itemnum": "PN-1001"})
+
+    def waiter():
+        # 沒有回覆時限的呼叫端不應收到其他請求因時限產生的失敗
+        results["waiter"] = contextvars.Context().run(tools.execute_tool, "get_item_info", {"itemnum": "PN-1001"})
+
+    threads = [threading.Thread(target=leader), threading.Thread(target=waiter)]
+    threads[0].start()
+    time.sleep(0.1)
+    threads[1].start()
+    for thread in threads:
+        thread.join()
+
+    assert results["leader"]["timed_out"]
+    assert results["waiter"]["success"]
+    assert fake_maximo.requests == 2
+
+
+def test_async_waiter_reruns_after_leader_timed_out(fake_maximo):
+    async def leader():
+        deadline.start_deadline(deadline.REPLY_DEADLINE_RESERVE + 0.3)
+        return await tools.execute_tool_async("get_item_info", {"itemnum": "PN-1002"})
+
+    async def waiter():
+        await asyncio.sleep(0.1)
+        return await tools.execute_tool_async("get_item_info", {"itemnum": "PN-1002"})
+
+    async def main():
+        return await asyncio.gather(
+            asyncio.create_task(leader(), context=contextvars.Context()),
+            asyncio.create_task(waiter(), context=contextvars.Context()),
+        )
+
+    led, waited = asyncio.run(main())
+    assert led["timed_out"]
+    assert waited["success"]
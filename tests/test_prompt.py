@@ -0,0 +1,52 @@
+from api import prompt as prompt_module
+from api.prompt import Prompt
+from api.storage import MemoryStorage
+import pytest
+
+
+def add_tool_turn(prompt, i):
+    """一個原生function calling的回合：問題、工具呼叫、兩個結果、回答"""
+    prompt.add_msg(f"料號A{i}與B{i}的庫存？", role="user")
+    prompt.add_tool_calls("", [
+        {"name": "get_inventory_info", "parameters": {"itemnum": f"A{i}"}},
+        {"name": "get_inventory_info", "parameters": {"itemnum": f"B{i}"}},
+    ])
+    prompt.add_tool_result("get_inventory_info", {"itemnum": f"A{i}", "quantity": i}, native=True)
+    prompt.add_tool_result("get_inventory_info", {"itemnum": f"B{i}", "quantity": i}, native=True)
+    prompt.add_msg(f"A{i}與B{i}各有{i}個", role="assistant")
+
+
+def assert_consistent(prompt):
+    history = list(prompt.history)
+    assert prompt.get_messages() == prompt.system_msgs + history
+    assert history[0]["role"] != "tool"
+    for before, record in zip(history, history[1:]):
+        if record["role"] == "tool":
+            assert before["role"] == "tool" or before.get("tool_calls")
+
+
+@pytest.mark.parametrize("eviction", ["sliding", "chunk"])
+def test_eviction_keeps_tool_results_with_their_call(monkeypatch, eviction):
+    monkeypatch.setattr(prompt_module, "PROMPT_EVICTION", eviction)
+    prompt = Prompt()
+    monkeypatch.setattr(prompt_module, "MSG_LIST_LIMIT", len(prompt.system_msgs) + 6)
+    for i in range(6):
+        add_tool_turn(prompt, i)
+        assert_consistent(prompt)
+        assert len(prompt.get_messages()) <= prompt_module.MSG_LIST_LIMIT
+    assert len(prompt.history) == len(prompt._history_tokens)
+    assert prompt.history_tokens == sum(prompt._history_tokens)
+
+
+def test_load_skips_tool_results_without_their_call(monkeypatch):
+    storage = MemoryStorage()
+    writer = Prompt("user:a", storage)
+    add_tool_turn(writer, 0)
+    writer.add_msg("謝謝", role="user")
+
+    reader = Prompt("user:a", storage)
+    # 只載入最後4則時從第二個工具結果開始
+    monkeypatch.setattr(prompt_module, "MSG_LIST_LIMIT", len(reader.system_msgs) + 3)
+    reader.sync()
+    assert [record["role"] for record in reader.history] == ["assistant", "user"]
+    assert_consistent(reader)
@@ -0,0 +1,186 @@
+from api.scheduler import (
+    AsyncOllamaScheduler,
+    AsyncPrioritySemaphore,
+    OllamaScheduler,
+    PrioritySemaphore,
+)
+import asyncio
+import threading
+import time
+import pytest
+
+
+class Backend:
+    def __init__(self, host):
+        self.host = host
+
+
+class StubClient:
+    """只提供排程器用到的pick/chat/achat"""
+
+    def __init__(self, error=None, delay=0.2):
+        self.error = error
+        self.delay = delay
+        self.calls = 0
+        self.started = threading.Event()
+
+    def pick(self, route_key=None):
+        return Backend("http://a")
+
+    def chat(self, backend=None, **kwargs):
+        self.calls += 1
+        self.started.set()
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return {"message": {"content": "ok"}}
+
+    async def achat(self, backend=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return {"message": {"content": "ok"}}
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_priority_order_and_hand_off_on_release():
+    semaphore = PrioritySemaphore(1)
+    semaphore.acquire(1)
+    order = []
+
+    def waiter(name, priority):
+        semaphore.acquire(priority)
+        order.append(name)
+
+    threads = []
+    for name, priority in [("new-1", 1), ("background", 2), ("new-2", 1), ("followup", 0)]:
+        thread = threading.Thread(target=waiter, args=(name, priority))
+        thread.start()
+        threads.append(thread)
+        wait_for(lambda: semaphore.waiting == len(threads))
+
+    for expected in range(1, 5):
+        semaphore.release()
+        wait_for(lambda: len(order) == expected)
+        # 名額直接交給等待者，不會回到可用名額讓新來的插隊
+        assert semaphore.in_use == 1
+    for thread in threads:
+        thread.join()
+    assert order == ["followup", "new-1", "new-2", "background"]
+    semaphore.release()
+    assert semaphore.in_use == 0
+
+
+def test_async_priority_order():
+    async def main():
+        semaphore = AsyncPrioritySemaphore(1)
+        await semaphore.acquire(1)
+        order = []
+
+        async def waiter(name, priority):
+            await semaphore.acquire(priority)
+            order.append(name)
+            semaphore.release()
+
+        tasks = [asyncio.create_task(waiter(name, priority))
+                 for name, priority in [("new", 1), ("background", 2), ("followup", 0)]]
+        await asyncio.sleep(0)
+        assert semaphore.waiting == 3
+        semaphore.release()
+        await asyncio.gather(*tasks)
+        assert order == ["followup", "new", "background"]
+        assert semaphore.in_use == 0
+
+    asyncio.run(main())
+
+
+def test_cancelled_async_waiter_passes_slot_on():
+    async def main():
+        semaphore = AsyncPrioritySemaphore(1)
+        await semaphore.acquire(1)
+        first = asyncio.create_task(semaphore.acquire(0))
+        second = asyncio.create_task(semaphore.acquire(1))
+        await asyncio.sleep(0)
+
+        # 名額交給first後、first執行前被取消，名額應轉交給second
+        semaphore.release()
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        await asyncio.wait_for(second, 1)
+        assert semaphore.in_use == 1
+
+        # 還在排隊時被取消的等待者會被略過
+        third = asyncio.create_task(semaphore.acquire(1))
+        await asyncio.sleep(0)
+        third.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await third
+        assert semaphore.waiting == 0
+        semaphore.release()
+        assert semaphore.in_use == 0
+
+    asyncio.run(main())
+
+
+def test_coalesced_waiters_get_leader_error():
+    client = StubClient(error=RuntimeError("ollama down"))
+    scheduler = OllamaScheduler(client, max_concurrent=2, coalesce=True)
+    request = {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+    errors = []
+
+    def call(route_key):
+        try:
+            scheduler.chat(route_key=route_key, **request)
+        except RuntimeError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=call, args=("user-a",))
+    leader.start()
+    client.started.wait(1)
+    waiters = [threading.Thread(target=call, args=(f"user-{i}",)) for i in range(3)]
+    for thread in waiters:
+        thread.start()
+    wait_for(lambda: scheduler.coalesced == 3)
+    for thread in [leader, *waiters]:
+        thread.join()
+
+    assert client.calls == 1
+    assert len(errors) == 4
+    assert all(str(e) == "ollama down" for e in errors)
+    assert not scheduler._inflight
+
+
+def test_async_coalesced_waiters_get_leader_error():
+    async def main():
+        client = StubClient(error=RuntimeError("ollama down"))
+        scheduler = AsyncOllamaScheduler(client, max_concurrent=2, coalesce=True)
+        request = {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+        results = await asyncio.gather(
+            *(scheduler.chat(route_key=f"user-{i}", **request) for i in range(3)),
+            return_exceptions=True,
+        )
+        assert client.calls == 1
+        assert scheduler.coalesced == 2
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert not scheduler._inflight
+
+    asyncio.run(main())
+
+
+def test_slots_are_per_host():
+    scheduler = OllamaScheduler(StubClient(), max_concurrent=1)
+    busy = scheduler._semaphore_for(Backend("http://a"))
+    busy.acquire(1)
+    # 一台主機的名額用完，不影響其他主機
+    other = scheduler._semaphore_for(Backend("http://b"))
+    assert other is not busy
+    other.acquire(1)
+    assert scheduler.stats()["in_flight"] == 2
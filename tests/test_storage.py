@@ -0,0 +1,125 @@
+from api.storage import MemoryStorage, SQLiteStorage, FileStorage
+from api.prompt import Prompt
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+import pytest
+
+
+@pytest.fixture(params=["memory", "sqlite", "file"])
+def storage(request, tmp_path):
+    if request.param == "memory":
+        storage = MemoryStorage()
+    elif request.param == "sqlite":
+        storage = SQLiteStorage(str(tmp_path / "sessions.db"))
+    else:
+        storage = FileStorage(str(tmp_path / "sessions"))
+    yield storage
+    storage.close()
+
+
+def test_append_returns_consecutive_seq(storage):
+    assert storage.last_seq("user:a") == 0
+    assert [storage.append("user:a", "user", f"訊息{i}") for i in range(3)] == [1, 2, 3]
+    assert storage.append("user:b", "user", "另一段對話") == 1
+    assert storage.last_seq("user:a") == 3
+
+
+def test_load_returns_tail_in_order(storage):
+    for i in range(5):
+        storage.append("user:a", "user", f"訊息{i}")
+    assert storage.load("user:a", 2) == [(4, "user", "訊息3", None), (5, "user", "訊息4", None)]
+    assert storage.load("user:a", 0) == []
+    assert storage.load("user:missing", 10) == []
+
+
+@pytest.mark.parametrize("kind", ["sqlite", "file"])
+def test_concurrent_appends_from_several_workers(kind, tmp_path):
+    # 每個執行緒各自一個storage物件，模擬共用同一個資料庫/目錄的多個worker
+    def make():
+        if kind == "sqlite":
+            return SQLiteStorage(str(tmp_path / "sessions.db"))
+        return FileStorage(str(tmp_path / "sessions"))
+
+    def write(worker):
+        storage = make()
+        try:
+            return [storage.append("group:g", "user", f"{worker}-{i}") for i in range(20)]
+        finally:
+            storage.close()
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        seqs = sorted(seq for result in pool.map(write, range(4)) for seq in result)
+    assert seqs == list(range(1, 81))
+
+    storage = make()
+    rows = storage.load("group:g", 100)
+    assert [seq for seq, _, _, _ in rows] == list(range(1, 81))
+    assert storage.last_seq("group:g") == 80
+
+
+def test_file_storage_reads_long_last_line(tmp_path):
+    storage = FileStorage(str(tmp_path))
+    storage.append("user:a", "user", "短")
+    long_text = "很長的回答" * 3000  # 超過一次往回讀取的4096 bytes
+    assert storage.append("user:a", "assistant", long_text) == 2
+    assert storage.append("user:a", "user", "下一則") == 3
+    assert storage.last_seq("user:a") == 3
+    assert storage.load("user:a", 2)[0] == (2, "assistant", long_text, None)
+
+
+def test_prompt_reloads_after_another_worker_writes():
+    storage = MemoryStorage()
+    first, second = Prompt("user:a", storage), Prompt("user:a", storage)
+    first.sync()
+    first.add_msg("你好", role="user")
+    second.sync()
+    second.add_msg("哈囉", role="assistant")
+
+    first.sync()
+    assert [m["content"] for m in first.history] == ["你好", "哈囉"]
+    first.add_msg("再見", role="user")
+    second.sync()
+    assert [m["content"] for m in second.history] == ["你好", "哈囉", "再見"]
+
+
+def test_extra_fields_round_trip(storage):
+    tool_calls = [{"function": {"name": "get_item_info", "arguments": {"itemnum": "ABC123"}}}]
+    storage.append("user:a", "assistant", "", {"tool_calls": tool_calls})
+    storage.append("user:a", "tool", "查詢結果", {"tool_name": "get_item_info"})
+    assert storage.load("user:a", 2) == [
+        (1, "assistant", "", {"tool_calls": tool_calls}),
+        (2, "tool", "查詢結果", {"tool_name": "get_item_info"}),
+    ]
+
+
+def test_sqlite_adds_extra_column_to_old_table(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE messages (session_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL,"
+        " content TEXT NOT NULL, created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+        " PRIMARY KEY (session_id, seq))"
+    )
+    conn.execute("INSERT INTO messages (session_id, seq, role, content) VALUES ('user:a', 1, 'user', '舊訊息')")
+    conn.commit()
+    conn.close()
+
+    storage = SQLiteStorage(path)
+    assert storage.append("user:a", "tool", "結果", {"tool_name": "get_item_info"}) == 2
+    assert storage.load("user:a", 2) == [
+        (1, "user", "舊訊息", None),
+        (2, "tool", "結果", {"tool_name": "get_item_info"}),
+    ]
+
+
+def test_prompt_restores_native_tool_messages(storage):
+    prompt = Prompt("user:a", storage)
+    prompt.add_msg("ABC123 的規格?", role="user")
+    prompt.add_tool_calls("", [{"name": "get_item_info", "parameters": {"itemnum": "ABC123"}}])
+    prompt.add_tool_result("get_item_info", "規格資料", native=True)
+
+    reloaded = Prompt("user:a", storage)
+    reloaded.sync()
+    assert list(reloaded.history) == list(prompt.history)
+    assert reloaded.history[1]["tool_calls"][0]["function"]["name"] == "get_item_info"
+    assert reloaded.history[2]["tool_name"] == "get_item_info"
@@ -0,0 +1,50 @@
+from api.chatgpt import ChatGPT, find_tool_markers, strip_tool_markers
+
+
+def parse_all(text, complete=True):
+    return [
+        ChatGPT._parse_tool_call(name, params)
+        for name, params, _, _ in find_tool_markers(text, complete=complete)
+    ]
+
+
+def test_json_object_with_array_argument():
+    text = '查詢中 [TOOL:get_item_info_batch:{"itemnums":["A123","B456"]}] 請稍候'
+    assert parse_all(text) == [
+        {"name": "get_item_info_batch", "parameters": {"itemnums": ["A123", "B456"]}}
+    ]
+    assert strip_tool_markers(text) == "查詢中  請稍候"
+
+
+def test_json_array_maps_to_main_parameter():
+    text = '[TOOL:get_inventory_info_batch:["A123","B456"]][TOOL:get_item_info:A123]'
+    assert parse_all(text) == [
+        {"name": "get_inventory_info_batch", "parameters": {"itemnums": ["A123", "B456"]}},
+        {"name": "get_item_info", "parameters": {"itemnum": "A123"}},
+    ]
+
+
+def test_json_array_rejected_for_scalar_parameter():
+    assert parse_all('[TOOL:get_item_info:["A123","B456"]]') == [None]
+
+
+def test_simple_string_arguments():
+    assert parse_all("[TOOL:get_item_info_batch:A123, B456]") == [
+        {"name": "get_item_info_batch", "parameters": {"itemnums": ["A123", "B456"]}}
+    ]
+
+
+def test_partial_json_waits_for_more_content():
+    partial = '[TOOL:get_item_info_batch:{"itemnums":["A123"]'
+    assert list(find_tool_markers(partial, complete=False)) == []
+    done = partial + "}]"
+    assert [params for _, params, _, _ in find_tool_markers(done, complete=False)] == [
+        '{"itemnums":["A123"]}'
+    ]
+
+
+def test_malformed_json_falls_back_when_complete():
+    text = '[TOOL:get_item_info:{"itemnum": A123}] 其他文字'
+    assert list(find_tool_markers(text, complete=False)) == []
+    assert parse_all(text) == [None]
+    assert strip_tool_markers(text) == " 其他文字"
@@ -0,0 +1,87 @@
+from api.worker import MessageQueue
+import contextvars
+import threading
+import time
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+
+def wait_idle(message_queue, timeout=5):
+    deadline = time.monotonic() + timeout
+    while message_queue.stats()["depth"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_messages_of_one_session_run_in_order_and_one_at_a_time():
+    message_queue = MessageQueue(num_workers=4, max_depth=100)
+    order, active, overlaps = [], set(), []
+    lock = threading.Lock()
+
+    def job(session_id, i):
+        def run():
+            with lock:
+                if session_id in active:
+                    overlaps.append(session_id)
+                active.add(session_id)
+            time.sleep(0.005)
+            with lock:
+                active.discard(session_id)
+                order.append((session_id, i))
+        return run
+
+    for i in range(10):
+        for session_id in ("user:a", "user:b", "user:c"):
+            assert message_queue.submit(session_id, job(session_id, i))
+    wait_idle(message_queue)
+    message_queue.shutdown()
+
+    assert overlaps == []
+    for session_id in ("user:a", "user:b", "user:c"):
+        assert [i for s, i in order if s == session_id] == list(range(10))
+
+
+def test_rejects_when_full():
+    message_queue = MessageQueue(num_workers=1, max_depth=2)
+    release = threading.Event()
+    assert message_queue.submit("user:a", lambda: release.wait(5))
+    assert message_queue.submit("user:b", lambda: None)
+    assert not message_queue.submit("user:c", lambda: None)
+    assert message_queue.stats()["rejected"] == 1
+    release.set()
+    message_queue.shutdown()
+
+
+def test_shutdown_drains_queued_jobs_and_stops_accepting():
+    message_queue = MessageQueue(num_workers=1, max_depth=10)
+    done = []
+    for i in range(3):
+        message_queue.submit("user:a", lambda i=i: (time.sleep(0.01), done.append(i)))
+    message_queue.shutdown(timeout=5)
+    assert done == [0, 1, 2]
+    assert not message_queue.submit("user:a", lambda: None)
+
+
+def test_job_runs_in_submitters_context():
+    message_queue = MessageQueue(num_workers=1, max_depth=10)
+    seen = []
+    token = request_id.set("req-1")
+    try:
+        message_queue.submit("user:a", lambda: seen.append(request_id.get()))
+    finally:
+        request_id.reset(token)
+    message_queue.shutdown(timeout=5)
+    assert seen == ["req-1"]
+
+
+def test_failing_job_does_not_stop_the_session():
+    message_queue = MessageQueue(num_workers=1, max_depth=10)
+    done = []
+
+    def fail():
+        raise RuntimeError("boom")
+
+    message_queue.submit("user:a", fail)
+    message_queue.submit("user:a", lambda: done.append(1))
+    message_queue.shutdown(timeout=5)
+    assert done == [1]
+    assert message_queue.stats()["completed"] == 2